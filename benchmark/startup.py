@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+cgpmgrの起動時間のベンチマーク
+python -X importtime で import cgpmgr の時間と読み込まれたモジュールを計測し, 予算を超えたら終了コード1を返す.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# import cgpmgr の時点で読み込んではいけないモジュール. サブコマンド内で必要になった時に読み込む.
+deferred_modules = [
+    'smbus2', 'docopt', 'subprocess', 'hashlib', 'datetime', 're', 'json', 'socket', 'ctypes', 'threading',
+    'http.server', 'socketserver', 'mmap', 'asyncio', 'concurrent.futures'
+]
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time():
+  """
+  python -X importtime で import cgpmgr を実行
+
+  Returns:
+    tuple: (import cgpmgrの累積時間[us], 読み込まれたモジュール名のリスト)
+  """
+  res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import cgpmgr'],
+                       cwd=root,
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE,
+                       encoding='utf-8',
+                       check=True)
+  total = 0
+  modules = []
+  for line in res.stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    modules.append(name.strip())
+    if name.strip() == 'cgpmgr':
+      total = int(cumulative)
+  return total, modules
+
+
+def parse_time(count):
+  """
+  parse_args()の平均実行時間
+
+  Returns:
+    float: 1回あたりの時間[us]
+  """
+  sys.path.insert(0, root)
+  import cgpmgr
+  argv = ['me', '-a', '-L', '-f', 'log.csv', '--from', '10']
+  t = time.perf_counter()
+  for i in range(count):
+    cgpmgr.parse_args(argv)
+  return (time.perf_counter() - t) / count * 1e6
+
+
+def main():
+  parser = argparse.ArgumentParser(description='cgpmgr startup benchmark')
+  parser.add_argument('--runs', type=int, default=10, help='number of import measurements')
+  parser.add_argument('--import-budget', type=float, default=15, help='import budget in ms')
+  parser.add_argument('--parse-budget', type=float, default=1, help='argument parsing budget in ms')
+  args = parser.parse_args()
+
+  # 最初の1回は.pycの生成が含まれるので除外
+  import_time()
+  results = [import_time() for i in range(args.runs)]
+  best = min(total for total, modules in results) / 1000
+  loaded = [name for name in deferred_modules if name in results[0][1]]
+  parse = parse_time(1000) / 1000
+
+  print('import cgpmgr: {:.2f} ms (budget {} ms)'.format(best, args.import_budget))
+  print('parse_args: {:.3f} ms (budget {} ms)'.format(parse, args.parse_budget))
+  ok = True
+  if best > args.import_budget:
+    print('import time exceeds the budget')
+    ok = False
+  if parse > args.parse_budget:
+    print('argument parsing exceeds the budget')
+    ok = False
+  if len(loaded) > 0:
+    print('modules that should be deferred: {}'.format(', '.join(loaded)))
+    ok = False
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1 +1,7 @@
 from .cli import *
+from .pmgr import *
+from .exporter import exporter
+from .emulator import Emulator
+from .archive import LogArchive, ArchiveError, archive, csv_to_archive, archive_to_csv
+from .archiver import LogArchiver, archiver
+from .aio import AsyncPowerMGR
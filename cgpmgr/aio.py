@@ -0,0 +1,231 @@
+"""
+RPZ-PowerMGRをasyncioから制御するクライアント
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+
+I2C転送はI2Cバス毎に1つのスレッドで実行するので, イベントループを止めない.
+同じバスの操作は1つずつ実行し, 異なるバスは並列に実行する. Python 3.7以降が必要.
+"""
+
+import time
+from .pmgr import *
+
+bus_executors = {}  # I2Cバス -> I2C転送を実行するスレッド1つのThreadPoolExecutor. 同じバスを使う全てのAsyncPowerMGRで共有する.
+
+
+def bus_executor(bus):
+  """
+  I2Cバスの操作を実行するスレッドプールを返す. 初めて使うバスの場合は作成する.
+  スレッドはバス毎に1つなので, 同じバスの操作は投入順に1つずつ実行し, 他のバスの操作を待たせない.
+
+  Args:
+    bus: I2Cバス番号かバスのオブジェクト
+
+  Returns:
+    ThreadPoolExecutor: スレッドプール
+  """
+  from concurrent.futures import ThreadPoolExecutor
+
+  if bus not in bus_executors:
+    # 同時に作成した場合は先に登録されたものを使う. スレッドは最初の実行まで起動しないので, 使わない方は何もしない.
+    bus_executors.setdefault(bus, ThreadPoolExecutor(max_workers=1, thread_name_prefix='cgpmgr-i2c'))
+  return bus_executors[bus]
+
+
+class AsyncPowerMGR:
+  """
+  PowerMGRの操作をawaitできるようにする. 各操作はI2Cバス毎のスレッドで実行する.
+  複数のI2C転送からなる操作(スケジュールの読み出しなど)も1回の実行にまとめるので, 途中に他の操作が入らない.
+  電流値の記録はread_log()でまとめた転送毎に返すので, 読み出し中も同じバスの他の操作を待たせない.
+
+    async with AsyncPowerMGR() as apm:
+      print(await apm.current())
+      async for samples in apm.read_log():
+        print(samples)
+
+  Attributes:
+    pm: 操作を実行するPowerMGR
+  """
+
+  def __init__(self, bus=1, address=0x20, retries=i2c_retries, retry_delay=i2c_retry_delay):
+    """
+    Args:
+      bus: I2Cバス番号. PowerMGRと同じくバスのオブジェクトも指定可能.
+      address: RPZ-PowerMGRのI2Cアドレス
+      retries: I2C転送に失敗した場合にやり直す回数
+      retry_delay: 1回目のやり直しまでの待ち時間[s]
+    """
+    self.pm = PowerMGR(bus, address, retries, retry_delay)
+    self.executor = bus_executor(bus)
+
+  async def __aenter__(self):
+    await self.open()
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+  async def call(self, func, *args, **kwargs):
+    """
+    funcをI2Cバスのスレッドで実行する. PowerMGRのメソッドをまとめて実行する場合に使う.
+
+    Args:
+      func: 実行する関数
+      args: funcの引数
+      kwargs: funcのキーワード引数
+
+    Returns:
+      funcの戻り値
+    """
+    import asyncio
+    import functools
+
+    return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+  async def open(self, check=True):
+    """
+    I2Cバスを開く. PowerMGR.open()を参照.
+    """
+    await self.call(self.pm.open, check)
+
+  async def close(self):
+    """
+    I2Cバスを閉じる
+    """
+    await self.call(self.pm.close)
+
+  async def config(self):
+    """
+    Returns:
+      Config: コンフィグ情報
+    """
+    return await self.call(self.pm.config)
+
+  async def write_config(self, **values):
+    """
+    コンフィグを書き込む. PowerMGR.write_config()を参照.
+    """
+    await self.call(self.pm.write_config, **values)
+
+  async def schedule_count(self):
+    """
+    Returns:
+      int: 登録済みスケジュールの数
+    """
+    return await self.call(self.pm.schedule_count)
+
+  async def schedules(self):
+    """
+    Returns:
+      list: 登録済みスケジュールのリスト. 登録番号順.
+    """
+    return await self.call(self.pm.schedules)
+
+  async def add_schedules(self, sch_list, atomic=False):
+    """
+    スケジュールを追加する. PowerMGR.add_schedules()を参照.
+    """
+    await self.call(self.pm.add_schedules, sch_list, None, atomic)
+
+  async def delete_schedule(self, num):
+    """
+    スケジュールを削除する. 0xFFで全て削除.
+    """
+    await self.call(self.pm.delete_schedule, num)
+
+  async def sync_schedules(self, target):
+    """
+    登録済みスケジュールがtargetと一致するように, 差分だけを削除, 追加する. PowerMGR.sync_schedules()を参照.
+
+    Returns:
+      tuple: (削除したスケジュール番号のリスト, 追加したスケジュールのリスト)
+    """
+    return await self.call(self.pm.sync_schedules, target)
+
+  async def current(self):
+    """
+    Returns:
+      int: 直近の電流測定値[mA]
+    """
+    return await self.call(self.pm.current)
+
+  async def watch_current(self, hz):
+    """
+    直近の電流測定値を一定周期で読み出し続ける非同期イテレーター. 待ち時間はイベントループに返す.
+    周期に間に合わなかった場合は, その分の読み出しを飛ばして次の周期に合わせる.
+
+    Args:
+      hz: 読み出す周波数[Hz]
+
+    Yields:
+      tuple: (読み出した時刻 time.time(), 電流値[mA], 前回から飛ばした読み出しの回数)
+    """
+    import asyncio
+
+    for delay, missed in periodic_ticks(hz):
+      if delay > 0:
+        await asyncio.sleep(delay)
+      yield time.time(), await self.current(), missed
+
+  async def log_count(self):
+    """
+    Returns:
+      int: 記録されている電流値の数
+    """
+    return await self.call(self.pm.log_count)
+
+  async def read_log(self, start=0, length=None, chunk=rdwr_chunk):
+    """
+    記録されている電流値をstartからlength個読み出す非同期イテレーター.
+    chunk個ずつの転送毎にスレッドに投入するので, 同じバスの他の操作は転送1回分しか待たない.
+
+    Args:
+      start: 読み出しを開始するインデックス
+      length: 読み出すサンプル数. Noneの場合は記録されている最後まで.
+      chunk: 1回の転送でまとめて読み出すサンプル数. 0の場合は1サンプルずつ読み出す.
+
+    Yields:
+      list: 電流値[mA]のリスト
+    """
+    if length == None:
+      length = await self.log_count() - start
+    samples = self.pm.read_log(start, length, chunk)
+    while True:
+      data = await self.call(next, samples, None)
+      if data == None:
+        return
+      yield data
+
+  async def log(self, start=0):
+    """
+    記録されている電流値を全て読み出す
+
+    Args:
+      start: 読み出しを開始するインデックス
+
+    Returns:
+      list: 電流値[mA]のリスト. 1秒ごと.
+    """
+    data = []
+    async for samples in self.read_log(start):
+      data += samples
+    return data
+
+  async def reset_log(self):
+    """
+    電流値の記録をリセットして再スタート
+    """
+    await self.call(self.pm.reset_log)
+
+  async def read_rtc(self, utc=False):
+    """
+    Returns:
+      datetime: RTC時刻. PowerMGR.read_rtc()を参照.
+    """
+    return await self.call(self.pm.read_rtc, utc)
+
+  async def request_shutdown(self):
+    """
+    すぐにシャットダウン要求を開始する
+    """
+    await self.call(self.pm.request_shutdown)
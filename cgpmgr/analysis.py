@@ -0,0 +1,185 @@
+"""
+記録した電流値の統計, 電荷量, スパイク検出, ダウンサンプリング
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+
+NumPyがインストールされていれば配列演算で処理し, なければPythonだけで同じ結果を計算する.
+"""
+
+import collections
+import math
+
+analysis_percentiles = [50, 90, 95, 99]
+spike_sigma = 3  # 閾値を指定しない場合, 平均 + 標準偏差のこの倍数を超えた値をスパイクとする
+
+# 解析結果. percentilesは(パーセント, 値)のリスト, spikesは(開始インデックス, 長さ, 最大値)のリスト,
+# resampledは(最初の電流値からの時間[s], 平均, 最小, 最大)のリスト.
+LogStats = collections.namedtuple('LogStats', [
+    'count', 'interval', 'min', 'max', 'mean', 'std', 'percentiles', 'charge', 'energy', 'threshold', 'spikes',
+    'resampled'
+])
+
+
+def import_numpy():
+  """
+  NumPyをインポートする. 起動時間に影響しないように解析する時だけ読み込む.
+
+  Returns:
+    module: numpy. インストールされていなければNone.
+  """
+  try:
+    import numpy
+    return numpy
+  except ImportError:
+    return None
+
+
+def analyze_log(samples, interval=1, voltage=None, spike=None, resolution=None, numpy=None):
+  """
+  電流値を解析する
+
+  Args:
+    samples: 電流値[mA]のリスト
+    interval: 記録間隔[s]
+    voltage: 電力量の計算に使う電圧[V]. Noneの場合は電力量を計算しない.
+    spike: スパイクとする電流値の閾値[mA]. Noneの場合は平均 + 標準偏差 * spike_sigma.
+    resolution: ダウンサンプリングする間隔[s]. Noneの場合はダウンサンプリングしない.
+    numpy: 使用するnumpyモジュール. Noneの場合はインストールされていれば使う. Falseの場合は使わない.
+
+  Returns:
+    LogStats: 解析結果. 電流値がない場合はNone.
+  """
+  if len(samples) == 0:
+    return None
+  if numpy == None:
+    numpy = import_numpy()
+
+  n = len(samples)
+  if numpy:
+    data = numpy.asarray(samples, dtype=numpy.float64)
+    total = float(data.sum())
+    low = int(data.min())
+    high = int(data.max())
+    std = float(data.std())
+    percentiles = [float(v) for v in numpy.percentile(data, analysis_percentiles)]
+  else:
+    data = samples
+    total = float(sum(samples))
+    low = min(samples)
+    high = max(samples)
+    mean = total / n
+    std = math.sqrt(sum((v - mean)**2 for v in samples) / n)
+    ordered = sorted(samples)
+    percentiles = [percentile(ordered, q) for q in analysis_percentiles]
+  mean = total / n
+
+  threshold = mean + std * spike_sigma if spike == None else spike
+  charge = total * interval / 3600
+  bucket = None if resolution == None else max(1, int(round(resolution / interval)))
+  return LogStats(n, interval, low, high, mean, std, list(zip(analysis_percentiles, percentiles)), charge,
+                  None if voltage == None else charge * voltage / 1000, threshold,
+                  find_spikes(data, threshold, numpy),
+                  None if bucket == None else resample(data, bucket, interval, numpy))
+
+
+def percentile(ordered, q):
+  """
+  ソート済みのリストのパーセンタイルを線形補間で求める. numpy.percentileのデフォルトと同じ.
+
+  Args:
+    ordered: ソート済みの数値のリスト
+    q: パーセント 0 - 100
+  """
+  pos = (len(ordered) - 1) * q / 100
+  i = int(pos)
+  if i + 1 >= len(ordered):
+    return float(ordered[-1])
+  return ordered[i] + (ordered[i + 1] - ordered[i]) * (pos - i)
+
+
+def find_spikes(data, threshold, numpy=None):
+  """
+  閾値を超えた電流値が連続する区間を探す
+
+  Args:
+    data: 電流値[mA]のリスト. numpyを使う場合は配列.
+    threshold: 閾値[mA]
+    numpy: numpyモジュール. Noneの場合は使わない.
+
+  Returns:
+    list: (開始インデックス, 長さ, 最大値[mA])のリスト
+  """
+  if numpy:
+    over = numpy.concatenate(([0], (data > threshold).astype(numpy.int8), [0]))
+    edges = numpy.diff(over)
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    if len(starts) == 0:
+      return []
+    peaks = numpy.maximum.reduceat(data, starts)
+    return [(int(s), int(e - s), int(p)) for s, e, p in zip(starts, ends, peaks)]
+
+  spikes = []
+  start = None
+  for i, value in enumerate(list(data) + [threshold]):
+    if value > threshold:
+      if start == None:
+        start = i
+        peak = value
+      peak = max(peak, value)
+    elif start != None:
+      spikes.append((start, i - start, peak))
+      start = None
+  return spikes
+
+
+def resample(data, bucket, interval=1, numpy=None):
+  """
+  bucket個ずつの平均, 最小, 最大にダウンサンプリングする. 最後の区間はbucket個未満の場合がある.
+
+  Args:
+    data: 電流値[mA]のリスト. numpyを使う場合は配列.
+    bucket: 1区間の電流値の数
+    interval: 記録間隔[s]
+    numpy: numpyモジュール. Noneの場合は使わない.
+
+  Returns:
+    list: (最初の電流値からの時間[s], 平均[mA], 最小[mA], 最大[mA])のリスト
+  """
+  rows = []
+  if numpy:
+    full = len(data) // bucket * bucket
+    if full > 0:
+      blocks = data[:full].reshape(-1, bucket)
+      rows = list(zip(blocks.mean(axis=1).tolist(), blocks.min(axis=1).tolist(), blocks.max(axis=1).tolist()))
+    if full < len(data):
+      tail = data[full:]
+      rows.append((float(tail.mean()), float(tail.min()), float(tail.max())))
+  else:
+    for i in range(0, len(data), bucket):
+      block = data[i:i + bucket]
+      rows.append((sum(block) / len(block), min(block), max(block)))
+  return [(i * bucket * interval, mean, int(low), int(high)) for i, (mean, low, high) in enumerate(rows)]
+
+
+def load_log(path):
+  """
+  me -Lで保存したcsvファイルかアーカイブから電流値を読み出す
+
+  Args:
+    path: ファイル. 拡張子が.cgplならアーカイブ, それ以外はcsv.
+
+  Returns:
+    tuple: (電流値[mA]のリスト, 記録間隔[s])
+
+  Raises:
+    OSError: ファイルを読み出せない
+    ArchiveError: アーカイブの形式が正しくない
+  """
+  from .archive import LogArchive, is_archive, read_csv
+
+  if is_archive(path):
+    with LogArchive(path) as archive:
+      interval = archive.blocks[0].interval if len(archive.blocks) > 0 else 1
+      return list(archive.samples()), interval
+  return read_csv(path)[1], 1
@@ -0,0 +1,328 @@
+"""
+電流値の記録を保存するバイナリ形式のアーカイブ
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+
+ファイルはブロックの連続で, 追記する場合は末尾にブロックを追加する. 各ブロックはヘッダーと電流値からなる.
+ヘッダー(リトルエンディアン, header_formatの順):
+  マジック 'CGPL', 形式のバージョン, 電流値のエンコード, I2Cバス番号, I2Cアドレス, デバイスID,
+  ファームウェアバージョン(マイナー, メジャー), タイムゾーン[分], 最初の電流値のRTC時刻(UTCのUNIX時間[s]),
+  記録間隔[s], 電流値の数, 電流値のバイト数
+電流値のエンコード:
+  raw: uint16の配列. mmapしてそのまま読み出せる.
+  varint: 前の値との差分をzigzag符号化し, 7bitずつ可変長で格納. 1Hzの電流値はほぼ1バイトになる.
+"""
+
+import collections
+import struct
+import sys
+
+archive_magic = b'CGPL'
+archive_version = 1
+archive_ext = '.cgpl'  # me -L -f でこの拡張子を指定するとアーカイブ形式で保存する
+archive_encodings = ['raw', 'varint']
+header_format = '<4sBBBBIBBhqHII'
+header_size = struct.calcsize(header_format)
+
+# アーカイブのブロック. dataは電流値のバイト列のmemoryview.
+Block = collections.namedtuple('Block', [
+    'bus', 'address', 'dev_id', 'fw_ver', 'time_zone', 'start', 'interval', 'encoding', 'count', 'data'
+])
+
+
+class ArchiveError(ValueError):
+  """
+  アーカイブの形式が正しくない
+  """
+
+
+def encode_samples(samples, encoding='raw'):
+  """
+  電流値をバイト列にする
+
+  Args:
+    samples: 電流値[mA]のリスト
+    encoding: raw, varint のいずれか
+
+  Returns:
+    bytes: エンコードした電流値
+  """
+  if encoding == 'raw':
+    return struct.pack('<{}H'.format(len(samples)), *samples)
+
+  out = bytearray()
+  prev = 0
+  for value in samples:
+    delta = value - prev
+    prev = value
+    zz = delta * 2 if delta >= 0 else -delta * 2 - 1
+    while zz >= 0x80:
+      out.append(zz & 0x7F | 0x80)
+      zz >>= 7
+    out.append(zz)
+  return bytes(out)
+
+
+def decode_samples(data, count, encoding='raw'):
+  """
+  バイト列から電流値を取り出す
+
+  Args:
+    data: エンコードした電流値のバイト列
+    count: 電流値の数
+    encoding: raw, varint のいずれか
+
+  Returns:
+    list: 電流値[mA]のリスト. rawでリトルエンディアンの環境ではコピーしないmemoryview.
+
+  Raises:
+    ArchiveError: データが壊れている
+  """
+  if encoding == 'raw':
+    if len(data) != count * 2:
+      raise ArchiveError('電流値のバイト数が正しくありません. ')
+    if sys.byteorder == 'little':
+      return memoryview(data).cast('B').cast('H')
+    return list(struct.unpack('<{}H'.format(count), data))
+
+  samples = []
+  prev = 0
+  zz = 0
+  shift = 0
+  for b in bytes(data):
+    zz |= (b & 0x7F) << shift
+    if b & 0x80:
+      shift += 7
+      continue
+    prev += zz >> 1 if zz & 1 == 0 else -(zz >> 1) - 1
+    samples.append(prev)
+    zz = 0
+    shift = 0
+  if len(samples) != count or shift != 0:
+    raise ArchiveError('電流値の数が正しくありません. ')
+  return samples
+
+
+def write_block(f, samples, start, interval=1, encoding='raw', dev_id=0x52474D50, fw_ver=(0, 0), time_zone=0,
+                bus=0, address=0):
+  """
+  1ブロックを書き込む. 追記モードで開いたファイルに書き込むと既存のアーカイブに追加できる.
+
+  Args:
+    f: バイナリモードで開いたファイル
+    samples: 電流値[mA]のリスト
+    start: 最初の電流値のRTC時刻. UTCのUNIX時間[s].
+    interval: 記録間隔[s]
+    encoding: raw, varint のいずれか
+    dev_id: デバイスID
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]
+    time_zone: タイムゾーン設定[分]
+    bus: I2Cバス番号
+    address: I2Cアドレス
+  """
+  data = encode_samples(samples, encoding)
+  f.write(
+      struct.pack(header_format, archive_magic, archive_version, archive_encodings.index(encoding), bus, address,
+                  dev_id, fw_ver[0], fw_ver[1], time_zone, int(start), interval, len(samples), len(data)))
+  f.write(data)
+
+
+class LogArchive:
+  """
+  アーカイブをmmapで開いて読み出す. rawの電流値はファイルからコピーせずに参照する.
+
+    with LogArchive('log.cgpl') as archive:
+      for t, curr in archive:
+        print(t, curr)
+
+  Attributes:
+    blocks: Blockのリスト. ファイル内の順.
+  """
+
+  def __init__(self, path):
+    """
+    Args:
+      path: アーカイブのファイル
+
+    Raises:
+      ArchiveError: アーカイブの形式が正しくない
+    """
+    import mmap
+
+    self.file = open(path, 'rb')
+    self.map = None
+    self.blocks = []
+    if self.file.seek(0, 2) == 0:
+      return
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    pos = 0
+    while pos < len(self.map):
+      error = None
+      if pos + header_size > len(self.map):
+        error = 'ヘッダーが途中で終わっています. '
+      else:
+        (magic, version, encoding, bus, address, dev_id, fw_minor, fw_major, time_zone, start, interval, count,
+         size) = struct.unpack_from(header_format, self.map, pos)
+        if magic != archive_magic or version != archive_version or encoding >= len(archive_encodings):
+          error = 'アーカイブの形式が正しくありません. '
+        elif pos + header_size + size > len(self.map):
+          error = '電流値が途中で終わっています. '
+      if error != None:
+        self.close()
+        raise ArchiveError('{} {}'.format(path, error))
+      pos += header_size
+      self.blocks.append(
+          Block(bus, address, dev_id, [fw_minor, fw_major], time_zone, start, interval,
+                archive_encodings[encoding], count, memoryview(self.map)[pos:pos + size]))
+      pos += size
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __iter__(self):
+    """
+    Yields:
+      tuple: (RTC時刻. UTCのUNIX時間[s], 電流値[mA])
+    """
+    for block in self.blocks:
+      for i, curr in enumerate(decode_samples(block.data, block.count, block.encoding)):
+        yield block.start + i * block.interval, curr
+
+  def samples(self):
+    """
+    全てのブロックの電流値を読み出す
+
+    Returns:
+      list: 電流値[mA]のリスト
+    """
+    data = []
+    for block in self.blocks:
+      data += decode_samples(block.data, block.count, block.encoding)
+    return data
+
+  def close(self):
+    """
+    ファイルを閉じる. 取り出した電流値のmemoryviewが残っている場合, mmapはその参照がなくなった時に解放される.
+    """
+    for block in self.blocks:
+      block.data.release()
+    self.blocks = []
+    if self.map != None:
+      try:
+        self.map.close()
+      except BufferError:
+        pass
+      self.map = None
+    self.file.close()
+
+
+def is_archive(path):
+  """
+  ファイル名がアーカイブの拡張子ならTrue
+  """
+  return path.lower().endswith(archive_ext)
+
+
+def read_csv(path):
+  """
+  me -Lで保存したcsvファイルから電流値を読み出す
+
+  Args:
+    path: csvファイル. "時間[s], 電流[mA]"の行. 数値でない行は無視する.
+
+  Returns:
+    tuple: (最初の行の時間[s]. 電流値がなければNone, 電流値[mA]のリスト)
+  """
+  samples = []
+  first = None
+  with open(path) as f:
+    for line in f:
+      data = [item.strip() for item in line.split(',')]
+      if len(data) < 2 or not data[0].isdigit() or not data[1].isdigit():
+        continue
+      if first == None:
+        first = int(data[0])
+      samples.append(int(data[1]))
+  return first, samples
+
+
+def csv_to_archive(src, dst, start=0, interval=1, encoding='varint'):
+  """
+  me -Lで保存したcsvファイルをアーカイブに変換する. csvには時刻がないので開始時刻を指定する.
+
+  Args:
+    src: csvファイル. "時間[s], 電流[mA]"の行. 数値でない行は無視する.
+    dst: アーカイブのファイル. 存在すれば追記する.
+    start: csvの時間0のRTC時刻. UTCのUNIX時間[s].
+    interval: 記録間隔[s]
+    encoding: raw, varint のいずれか
+
+  Returns:
+    int: 変換した電流値の数
+  """
+  first, samples = read_csv(src)
+  with open(dst, 'ab') as f:
+    write_block(f, samples, start + (0 if first == None else first) * interval, interval, encoding)
+  return len(samples)
+
+
+def archive_to_csv(src, dst):
+  """
+  アーカイブをme -Lと同じ形式のcsvファイルに変換する. 時間は最初の電流値からの秒数.
+
+  Args:
+    src: アーカイブのファイル
+    dst: csvファイル
+
+  Returns:
+    int: 変換した電流値の数
+  """
+  count = 0
+  with LogArchive(src) as archive, open(dst, 'w') as f:
+    f.write('時間[s], 電流[mA]\n')
+    first = archive.blocks[0].start if len(archive.blocks) > 0 else 0
+    for t, curr in archive:
+      f.write('{}, {}\n'.format(t - first, curr))
+      count += 1
+  return count
+
+
+def archive():
+  """
+  cgpmgr-archiveを実行. アーカイブの内容表示, csvとの変換を行う.
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(description='current log archive tool for RPZ-PowerMGR')
+  sub = parser.add_subparsers(dest='command')
+  info = sub.add_parser('info', help='show blocks in an archive')
+  info.add_argument('archive')
+  to_csv = sub.add_parser('to-csv', help='convert an archive to CSV')
+  to_csv.add_argument('archive')
+  to_csv.add_argument('csv')
+  from_csv = sub.add_parser('from-csv', help='append a CSV saved by cgpmgr me -L to an archive')
+  from_csv.add_argument('csv')
+  from_csv.add_argument('archive')
+  from_csv.add_argument('--start', type=int, default=0, help='UNIX time of the first sample')
+  from_csv.add_argument('--encoding', choices=archive_encodings, default='varint')
+  opts = parser.parse_args()
+
+  try:
+    if opts.command == 'info':
+      with LogArchive(opts.archive) as archive:
+        for i, block in enumerate(archive.blocks):
+          print('#{} i2c-{} 0x{:02X} fw {}.{} tz {} start {} interval {}s {} samples ({}, {} bytes)'.format(
+              i, block.bus, block.address, block.fw_ver[1], block.fw_ver[0], block.time_zone, block.start,
+              block.interval, block.count, block.encoding, len(block.data)))
+    elif opts.command == 'to-csv':
+      print('{} samples'.format(archive_to_csv(opts.archive, opts.csv)))
+    elif opts.command == 'from-csv':
+      print('{} samples'.format(csv_to_archive(opts.csv, opts.archive, opts.start, 1, opts.encoding)))
+    else:
+      parser.print_help()
+  except (OSError, ArchiveError) as e:
+    print(e)
+    sys.exit(1)
@@ -0,0 +1,231 @@
+"""
+RPZ-PowerMGRに記録された電流値を継続して読み出し, アーカイブに保存する
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+"""
+
+import os
+import time
+from .pmgr import *
+from .archive import archive_ext, write_block
+
+archiver_interval = 60  # 記録数を確認する間隔[s]
+archiver_reset_at = 3000  # 記録数がこれ以上になったら読み出してリセットする. 最大3600.
+archiver_tolerance = 5  # 記録開始時刻がこれ以上ずれていたら別の記録と判断する[s]
+
+
+class LogArchiver:
+  """
+  前回読み出した位置(カーソル)以降の電流値だけを読み出し, 日毎のアーカイブファイルに追記する.
+  記録数がreset_atに達したら, 新しい電流値が記録された直後に残りを読み出してリセットするので, 電流値を取りこぼさない.
+  カーソルと記録開始時刻は状態ファイルに保存し, 再起動後も続きから読み出す.
+
+  Attributes:
+    cursor: 次に読み出す記録のインデックス
+    log_start: インデックス0のRTC時刻. UTCのUNIX時間[s]. 不明な場合はNone.
+  """
+
+  def __init__(self, pm, directory, reset_at=archiver_reset_at, keep=0):
+    """
+    Args:
+      pm: open()したPowerMGR
+      directory: アーカイブと状態ファイルを保存するディレクトリ
+      reset_at: 記録数がこれ以上になったらリセットする
+      keep: 残すアーカイブファイルの数. 0の場合は全て残す.
+    """
+    self.pm = pm
+    self.directory = directory
+    self.reset_at = reset_at
+    self.keep = keep
+    self.prefix = 'current-i2c{}-0x{:02X}-'.format(pm.bus if isinstance(pm.bus, int) else 0, pm.address)
+    self.state_file = os.path.join(directory, self.prefix + 'state.json')
+    self.cursor = 0
+    self.log_start = None
+    self.checked = False
+    self.cfg = None
+    os.makedirs(directory, exist_ok=True)
+    self.load_state()
+
+  def load_state(self):
+    """
+    状態ファイルからカーソルと記録開始時刻を読み込む
+    """
+    import json
+
+    try:
+      with open(self.state_file) as f:
+        state = json.load(f)
+      self.cursor = state['cursor']
+      self.log_start = state['log_start']
+    except (OSError, ValueError, KeyError):
+      self.cursor = 0
+      self.log_start = None
+
+  def save_state(self):
+    """
+    カーソルと記録開始時刻を状態ファイルに保存する. 途中で停止しても壊れないように置き換える.
+    """
+    import json
+
+    tmp = self.state_file + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'cursor': self.cursor, 'log_start': self.log_start}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, self.state_file)
+
+  def poll(self):
+    """
+    記録数を確認し, 新しい電流値を読み出して保存する. 記録数がreset_atに達していればリセットする.
+
+    Returns:
+      int: 保存した電流値の数
+    """
+    count = self.pm.log_count()
+
+    # 記録開始時刻を毎回確認する. 外部でリセットされた後に記録数がカーソルを超えていても, 開始時刻のずれで判断できる.
+    # 記録数が上限に達すると記録が止まり, 開始時刻が毎回進んで見えるので, 保存した開始時刻をそのまま使う.
+    start = self.pm.read_rtc(utc=True).timestamp() - count + 1
+    full = count >= max_log
+    if self.log_start == None or count < self.cursor or (not full and abs(start - self.log_start) > archiver_tolerance):
+      if self.log_start != None:
+        print('電流値の記録がリセットされていました. インデックス0から読み出します. ')
+      self.cursor = 0
+      self.log_start = start
+    if not self.checked:
+      self.cfg = self.pm.config()
+      self.checked = True
+
+    if full and self.cursor < count:
+      print('記録数が上限の{}に達していました. 電流値を取りこぼした可能性があります. '.format(max_log))
+    saved = self.fetch(count)
+    if count >= self.reset_at:
+      saved += self.reset()
+    return saved
+
+  def fetch(self, count):
+    """
+    カーソルからcount未満のインデックスまで読み出して保存し, カーソルを進める.
+
+    Returns:
+      int: 保存した電流値の数
+    """
+    if count <= self.cursor:
+      return 0
+    samples = []
+    for data in self.pm.read_log(self.cursor, count - self.cursor):
+      samples += data
+    self.append(samples, self.log_start + self.cursor)
+    self.cursor = count
+    self.save_state()
+    return len(samples)
+
+  def reset(self):
+    """
+    新しい電流値が記録された直後に残りを読み出し, 記録をリセットする.
+    次の記録までの1秒以内に読み出しとリセットを終えるので, 電流値を取りこぼさない.
+
+    Returns:
+      int: 保存した電流値の数
+    """
+    count = self.pm.log_count()
+    deadline = time.monotonic() + 1.5
+    while time.monotonic() < deadline:
+      time.sleep(0.02)
+      latest = self.pm.log_count()
+      if latest != count:
+        count = latest
+        break
+    saved = self.fetch(count)
+    self.pm.reset_log()
+    self.cursor = 0
+    self.log_start = None
+    self.save_state()
+    return saved
+
+  def append(self, samples, start):
+    """
+    電流値をUTCの日付毎のアーカイブファイルに追記する. 日付をまたぐ場合はファイルを分ける.
+
+    Args:
+      samples: 電流値[mA]のリスト. 1秒ごと.
+      start: 最初の電流値のRTC時刻. UTCのUNIX時間[s].
+    """
+    cfg = self.cfg
+    while len(samples) > 0:
+      day = int(start) // 86400
+      n = min(len(samples), (day + 1) * 86400 - int(start))
+      path = os.path.join(self.directory, '{}{}{}'.format(self.prefix, time.strftime('%Y%m%d', time.gmtime(start)),
+                                                          archive_ext))
+      with open(path, 'ab') as f:
+        write_block(f, samples[:n], start, 1, 'varint', cfg.dev_id, cfg.fw_ver,
+                    0 if cfg.time_zone == None else cfg.time_zone, self.pm.bus if isinstance(self.pm.bus, int) else 0,
+                    self.pm.address)
+        f.flush()
+        os.fsync(f.fileno())
+      samples = samples[n:]
+      start += n
+    self.rotate()
+
+  def rotate(self):
+    """
+    keepより古いアーカイブファイルを削除する
+    """
+    if self.keep <= 0:
+      return
+    files = sorted(name for name in os.listdir(self.directory)
+                   if name.startswith(self.prefix) and name.endswith(archive_ext))
+    for name in files[:-self.keep]:
+      os.remove(os.path.join(self.directory, name))
+
+  def run(self, interval=archiver_interval):
+    """
+    interval秒ごとにpoll()を繰り返す. 通信に失敗した場合は次の周期でやり直す.
+
+    Args:
+      interval: 記録数を確認する間隔[s]
+    """
+    while True:
+      try:
+        self.poll()
+      except PowerMGRError as e:
+        print(e)
+        self.checked = False
+      time.sleep(interval)
+
+
+def archiver():
+  """
+  cgpmgr-archiverを実行. 電流値の記録を継続して読み出し, アーカイブに保存する.
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(description='continuous current log archiver for RPZ-PowerMGR')
+  parser.add_argument('--dir', default='/var/lib/cgpmgr', help='directory for archives and state')
+  parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+  parser.add_argument('--address', type=lambda s: int(s, 0), default=0x20, help='I2C address')
+  parser.add_argument('--interval', type=float, default=archiver_interval, help='polling interval in seconds')
+  parser.add_argument('--reset-at',
+                      type=int,
+                      default=archiver_reset_at,
+                      help='reset the on-board log when it holds this many samples (max {})'.format(max_log))
+  parser.add_argument('--keep', type=int, default=0, help='number of daily archive files to keep (0: all)')
+  parser.add_argument('--emulator', action='store_true', help='use the register-level emulator instead of I2C')
+  opts = parser.parse_args()
+  if opts.emulator:
+    os.environ['CGPMGR_EMULATOR'] = '1'
+  if not 0 < opts.reset_at <= max_log or opts.reset_at + opts.interval * 2 > max_log:
+    parser.error('--reset-at must leave at least two polling intervals before {} samples'.format(max_log))
+
+  pm = PowerMGR(opts.bus, opts.address)
+  try:
+    pm.open()
+  except (OSError, PowerMGRError) as e:
+    print(e)
+    return
+  try:
+    LogArchiver(pm, opts.dir, opts.reset_at, opts.keep).run(opts.interval)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    pm.close()
@@ -13,16 +13,25 @@ Version 1.12
   製品ページ https://www.indoorcorgielec.com/products/rpz-powermgr/
 
 Usage:
-  cgpmgr cf [-a] [-u <sec>] [-d <sec>] [-r <num>] [-c <num>] [-z <num>] [-p <num>] [-w <num>] [-b <num>]
-  cgpmgr sc [-a] [-o] [-D <date>] <time> (on | off)
-  cgpmgr sc [-a] -l <min> (on | off)
-  cgpmgr sc [-a] -R <num>
-  cgpmgr sc [-a] [-i] -f <file>
-  cgpmgr sc [-a]
-  cgpmgr me [-a] -L [-f <file>]
-  cgpmgr me [-a] -s
-  cgpmgr me [-a]
-  cgpmgr fw -f <file>
+  cgpmgr cf [-a] [--target <list> | --discover] [--stats <fmt>] [-u <sec>] [-d <sec>] [-r <num>] [-c <num>] [-z <num>] [-p <num>] [-w <num>] [-b <num>]
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] [-o] [-D <date>] <time> (on | off)
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] -l <min> (on | off)
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] -R <num>
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] [-i] -f <file>
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] --sync -f <file>
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] --next <num> [-f <file>]
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] --simulate <from>,<to> [-f <file>]
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] --optimize [-f <file>]
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>] --import <file>
+  cgpmgr sc [-a] [--target <list> | --discover] [--stats <fmt>]
+  cgpmgr me [-a] [--target <list> | --discover] [--stats <fmt>] -L [-f <file>] [--from <idx>] [--chunk <num>]
+  cgpmgr me [-a] [--target <list> | --discover] [--stats <fmt>] -s
+  cgpmgr me [-a] [--target <list> | --discover] [--stats <fmt>] --watch <hz> [--format <fmt>] [-f <file>]
+  cgpmgr me [-a] [--target <list> | --discover] [--stats <fmt>] --analyze [-f <file>] [--voltage <volt>] [--spike <mA>] [--resample <sec>]
+  cgpmgr me [-a] [--target <list> | --discover] [--stats <fmt>]
+  cgpmgr rtc [-a] [--stats <fmt>] [--sync | --restore] [--threshold <sec>]
+  cgpmgr rtc [-a] [--stats <fmt>] --drift <sec>
+  cgpmgr fw [-a] [--force] [--version <ver>] -f <file>
   cgpmgr -h --help
 
 Options:
@@ -54,130 +63,521 @@ Options:
   -R <num>   指定すると登録済みスケジュールから指定番号のものを削除. 255を指定すると全て削除. 
   -i         スケジュールをcsvファイルから読み出して追加する. 
              省略すると登録済みスケジュールをcsvファイルに保存する.
+  --sync     登録済みスケジュールをcsvファイルと比較し, 差分だけを削除, 追加して一致させる.
+  --next <num>  RTCの現在時刻から, 次に電源ON/OFFする日時を 1 - 1000 個表示する. 
+  --simulate <from>,<to>  年/月/日で指定した期間に電源ON/OFFする日時を全て表示する. 例)2025/1/1,2025/12/31
+             --next, --simulateで-fを指定すると, 登録済みスケジュールの代わりにcsvファイルを評価する. 
+  --optimize 電源ON/OFFする日時が同じになるように, 重複や他に含まれるスケジュールを削除し, 
+             全ての曜日, 日, 時, 月が揃ったものをワイルドカードにまとめる. 全ての日付で一致することを確認してから登録する. 
+             -fを指定すると, csvファイルを最適化して登録済みスケジュールと置き換える. 
+  --import <file>  cron形式かsystemdのOnCalendar形式で書いたファイルから, できるだけ少ないスケジュールを追加する. 
+             各行は on|off <指定>. 例)on 30 7 * * 1-5, off Mon..Fri *-*-* 22:00
+             表現できない指定がある場合や上限を超える場合は1つも追加しない. 
 
   me         Raspberry Pi/Jetson Nanoの消費電流測定, 結果ログを行うサブコマンド. 
              オプションを指定しないと直近の電流測定値を表示. 
   -L         記録されている消費電流値を読み出す. 
              電源ONから1秒ごとに最大1時間まで記録可能.  
+  --from <idx>   指定したインデックスから読み出しを再開する. -fで指定したファイルに追記する. 
+  --chunk <num>  まとめて読み出すサンプル数を 0 - 14 の範囲で指定. デフォルトは14. 
+                 環境変数CGPMGR_RDWR=1を設定すると1回の転送にまとめる. 0を指定すると常に1サンプルずつ読み出す. 
   -s         消費電流の記録をリセットして再スタート. 1秒ごと最大1時間まで記録可能.
-
-  fw         ファームウェアを-fで指定したものに書き換える.
+  --watch <hz>    直近の電流測定値を指定した周波数 0.1 - 100[Hz] で読み出し続ける. Ctrl+Cで終了.
+                  -fで指定したファイルに追記する.
+  --format <fmt>  --watchの出力形式を csv, ndjson から指定. デフォルトはcsv.
+  --analyze  記録されている電流値の最小, 最大, 平均, パーセンタイル, 電荷量[mAh], スパイクを表示. 
+             -fで指定した場合はRPZ-PowerMGRから読み出さずに, me -Lで保存したcsvかアーカイブを解析する. 
+  --voltage <volt>  電力量[Wh]の計算に使う電圧[V]を指定. 
+  --spike <mA>      スパイクとする電流値の閾値[mA]を指定. 省略すると平均 + 標準偏差の3倍. 
+  --resample <sec>  指定した秒数毎の平均, 最小, 最大にダウンサンプリングして表示. 
+
+  rtc        RTCの時刻と, システム時刻とのずれを表示する. RTCの秒が変わる瞬間を捉えて1ミリ秒程度の精度で測る. 
+  --sync     ずれが閾値を超えていれば, システム時刻の秒の境目に合わせてRTCに書き込む. 
+  --restore  ずれが閾値を超えていれば, RTCの時刻をシステム時刻に設定する. 起動時の時刻合わせに使う. root権限が必要. 
+  --threshold <sec>  --sync, --restoreで書き込むずれの閾値[s]. デフォルトは0.5.
+  --drift <sec>  指定した秒数 10 - 86400 の間隔でずれを2回測り, システム時刻に対するRTCの進み, 遅れを表示する.
+
+  fw         ファームウェアを-fで指定したものに書き換える. 
+             -fにディレクトリを指定すると, その中から書き換えるバージョンのファームウェアを探す. 
+             RPZ-PowerMGRが既に同じバージョンの場合は書き換えない. 
+  --version <ver>  書き換えるファームウェアのバージョンを指定. 例)2.7
+                   省略すると, ディレクトリ内の現在と同じメジャーバージョンで対応している最新のものを使う. 
+  --force    同じバージョンでも書き換える. 
 
   共通オプション
   -a         I2Cセカンダリアドレス0x22を使用. 
              DSW1-6がONの状態でRunモードに入るとセカンダリI2Cアドレスになる. 
+  --target <list>  対象のボードをI2Cバス番号:アドレスのカンマ区切りで指定. 例)1:0x20,3:0x22
+                   アドレスを省略するとI2Cアドレス0x20(-a指定時は0x22)になる. 
+  --discover       /dev/i2c-*の全てのバスからボードを探して対象にする. 
+                   複数のボードはI2Cバス毎に並列に処理し, 結果をボード毎に表示する. 
+                   -fで保存するファイル名には -i2c<バス番号>-0x<アドレス> が付く. 
+  --stats <fmt>    終了時にI2C転送の統計を標準エラー出力に表示. 形式を text, json から指定.
   -f <file>  scサブコマンドでは保存, 読み出しをするcsvファイルを指定. 
              meサブコマンドでは電流値を保存するファイルを指定.
+             -Lで拡張子を.cgplにするとバイナリのアーカイブ形式で保存する. cgpmgr-archiveでcsvと変換可能.
   -h --help  ヘルプを表示
 """
 
 import os
+import sys
 import time
-import datetime
-import re
-import struct
-import subprocess
-import hashlib
-import smbus2
-
-i2c_adr = 0x20
-compatible_fw = {1: 10, 2: 7}
+from .pmgr import *
+from .archive import is_archive, write_block
+
 sig2gpio = [0, 16, 17, 26, 27]  # SIG番号とGPIO番号の対応
 dow2str = ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat']  # スケジュールデータは日曜が1, 土曜が7
 gpio_rst = 7
 gpio_boot = 25
-fw_ver = []
-
-# ファームウェアハッシュ値
-known_hash = [
-    'cf0d1818ade696bc5b7af150ff4a085266fdc829f196f26ed2ed127b7ba12eb3',  # Ver1.0
-    '1a6fdf815b5b23a6e39c79d6b734bfd3bd51ddf59b803912425bfc07504f0d1b',  # Ver1.1
-    '5764c3cc8442930997fefcc048e35a8242df9bdcdf5f302ed4fb43f1a4fd8c24',  # Ver1.2
-    'a37fe6f36a4e99bab07e3106cb99306d13f88d4c72c68b309a4fd9eb8e4c44e8',  # Ver1.3
-    '36313403baab9d50183f17d0f9cea991455baf7b1b0478e1ef8773cee0ea91cc',  # Ver1.4
-    'c3f465e5c8e2e004b23d85a6f5846931e106fd8a06715d48e54750c875cfe882',  # Ver1.5
-    '6aff47c6ceb831cf48662a71dcc0090b437a6129aa8b29d5bcebb5e0cd46e98b',  # Ver1.6
-    '14fcce2876dc004f5598d50d36eef4898e048197566a5de319ede510019df031',  # Ver1.7
-    'eb4e7bf2b2aa4a7d70fc2208e6f44122859f1efba5ea44846ee0b4db82e40bb4',  # Ver1.8
-    '5382b9347f357af3429d8c204065e62d524f6957e8249040bba6e0effd6967d5',  # Ver1.9
-    '44a14a0cb0e682ee69def44753381013164e21b10c64faa6228fe526f4d1f9c7',  # Ver1.10
-    '0bdb41e819fcd8380a9bf1f551a6a7692bd22bcdb3734580413e4401fa613490',  # Ver2.0
-    'f5aa9ab42affd8004238bf1f747d93095b5138602473660eb7965a24d03b167b',  # Ver2.1
-    'a49c1fa3c1f540fcbb77d69be4d599791d3a5a88508e7519aaab2c5426f0fb0c',  # Ver2.2
-    'c39cc7100644abafd3f69bc0b61304093b4a535097fd637282837ed8fe007821',  # Ver2.3
-    '39498cf80856838cf9676c0e40316d1e7ae283d03179d1d538d1cca992a0e9cc',  # Ver2.4
-    'ae89f56fd2886076d41d583fe2f4e82520f9d1c2dbf7e020c787b04f5e3e46c1',  # Ver2.5
-    '17cf25d7e5115643498e41cb5b66a494e204f95887fb0836b3adb6a6f5fd7cef',  # Ver2.6
-    'a351b9554a3999f13020e7a063cd61445d7368f8a5d031bfa2f6ceef2d3ef528',  # Ver2.7
+boot_delay = 0.01  # ブートローダー起動時のGPIO操作の間隔[s]
+bootloader_device = '/dev/i2c-1'  # ブートローダーと通信するI2Cバス
+bootloader_address = '0x42'  # ブートローダーのI2Cアドレス
+hash_chunk = 65536  # ハッシュ値を計算する時に1回に読み出すバイト数
+# ファイルのハッシュ値のキャッシュ. ファイルのサイズと更新時刻が同じなら計算し直さない.
+hash_cache_file = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cgpmgr',
+                               'firmware-hash.json')
+rtc_threshold = 0.5  # rtc --sync, --restoreでRTC, システム時刻に書き込むずれの閾値[s]
+rtc_valid_year = 2021  # RTCの年がこれより前なら電源が途切れてリセットされたと判断する
+daemon_socket = os.environ.get('CGPMGR_SOCKET', '/run/cgpmgr.sock')  # cgpmgrdのUnixソケット
+daemon_check_interval = 60  # cgpmgrdがデバイスIDとファームウェアバージョンを再確認する間隔[s]
+daemon_timeout = 60  # cgpmgrdの応答を待つ最大の時間[s]
+daemon_end = b'\0'  # cgpmgrdの応答の終わり. 途中で切断された場合と区別する.
+
+# Usageの構文. 実行毎に__doc__を解析しないように, 各行の必須要素と省略可能な要素を定義.
+# on|offはどちらか一方. Usageを変更した場合は合わせて変更する. tests/test_cli.pyで__doc__と一致することを確認する.
+commands = ['cf', 'sc', 'me', 'rtc', 'fw']
+value_options = [
+    '-u', '-d', '-r', '-c', '-z', '-p', '-w', '-b', '-D', '-l', '-R', '-f', '--from', '--chunk', '--watch',
+    '--format', '--target', '--stats', '--voltage', '--spike', '--resample', '--next', '--simulate', '--import',
+    '--version', '--threshold', '--drift'
+]
+flag_options = [
+    '-a', '-o', '-i', '-L', '-s', '--sync', '--optimize', '--discover', '--analyze', '--force', '--restore', '--help'
 ]
+common_options = ['-a', '--target', '--discover', '--stats']  # cf, sc, meに共通のオプション
+exclusive_options = [('--target', '--discover'), ('--sync', '--restore')]  # Usageで | で区切った同時に指定できないオプション
+usage_patterns = [
+    ('cf', [], common_options + ['-u', '-d', '-r', '-c', '-z', '-p', '-w', '-b']),
+    ('sc', ['<time>', 'on|off'], common_options + ['-o', '-D']),
+    ('sc', ['-l', 'on|off'], common_options),
+    ('sc', ['-R'], common_options),
+    ('sc', ['-f'], common_options + ['-i']),
+    ('sc', ['--sync', '-f'], common_options),
+    ('sc', ['--next'], common_options + ['-f']),
+    ('sc', ['--simulate'], common_options + ['-f']),
+    ('sc', ['--optimize'], common_options + ['-f']),
+    ('sc', ['--import'], common_options),
+    ('sc', [], common_options),
+    ('me', ['-L'], common_options + ['-f', '--from', '--chunk']),
+    ('me', ['-s'], common_options),
+    ('me', ['--watch'], common_options + ['-f', '--format']),
+    ('me', ['--analyze'], common_options + ['-f', '--voltage', '--spike', '--resample']),
+    ('me', [], common_options),
+    ('rtc', [], ['-a', '--stats', '--threshold']),
+    ('rtc', ['--sync'], ['-a', '--stats', '--threshold']),
+    ('rtc', ['--restore'], ['-a', '--stats', '--threshold']),
+    ('rtc', ['--drift'], ['-a', '--stats']),
+    ('fw', ['-f'], ['-a', '--force', '--version']),
+]
+
+# ファームウェアのハッシュ値 -> バージョン(メジャー, マイナー)
+firmware_index = {
+    'cf0d1818ade696bc5b7af150ff4a085266fdc829f196f26ed2ed127b7ba12eb3': (1, 0),
+    '1a6fdf815b5b23a6e39c79d6b734bfd3bd51ddf59b803912425bfc07504f0d1b': (1, 1),
+    '5764c3cc8442930997fefcc048e35a8242df9bdcdf5f302ed4fb43f1a4fd8c24': (1, 2),
+    'a37fe6f36a4e99bab07e3106cb99306d13f88d4c72c68b309a4fd9eb8e4c44e8': (1, 3),
+    '36313403baab9d50183f17d0f9cea991455baf7b1b0478e1ef8773cee0ea91cc': (1, 4),
+    'c3f465e5c8e2e004b23d85a6f5846931e106fd8a06715d48e54750c875cfe882': (1, 5),
+    '6aff47c6ceb831cf48662a71dcc0090b437a6129aa8b29d5bcebb5e0cd46e98b': (1, 6),
+    '14fcce2876dc004f5598d50d36eef4898e048197566a5de319ede510019df031': (1, 7),
+    'eb4e7bf2b2aa4a7d70fc2208e6f44122859f1efba5ea44846ee0b4db82e40bb4': (1, 8),
+    '5382b9347f357af3429d8c204065e62d524f6957e8249040bba6e0effd6967d5': (1, 9),
+    '44a14a0cb0e682ee69def44753381013164e21b10c64faa6228fe526f4d1f9c7': (1, 10),
+    '0bdb41e819fcd8380a9bf1f551a6a7692bd22bcdb3734580413e4401fa613490': (2, 0),
+    'f5aa9ab42affd8004238bf1f747d93095b5138602473660eb7965a24d03b167b': (2, 1),
+    'a49c1fa3c1f540fcbb77d69be4d599791d3a5a88508e7519aaab2c5426f0fb0c': (2, 2),
+    'c39cc7100644abafd3f69bc0b61304093b4a535097fd637282837ed8fe007821': (2, 3),
+    '39498cf80856838cf9676c0e40316d1e7ae283d03179d1d538d1cca992a0e9cc': (2, 4),
+    'ae89f56fd2886076d41d583fe2f4e82520f9d1c2dbf7e020c787b04f5e3e46c1': (2, 5),
+    '17cf25d7e5115643498e41cb5b66a494e204f95887fb0836b3adb6a6f5fd7cef': (2, 6),
+    'a351b9554a3999f13020e7a063cd61445d7368f8a5d031bfa2f6ceef2d3ef528': (2, 7),
+}
+known_hash = list(firmware_index)
 
 
 def cli():
   """
   コマンドラインツールを実行
   """
-  global i2c
-  global i2c_adr
-  global fw_ver
+  start = time.perf_counter()
 
-  try:
-    from docopt import docopt
-  except ImportError:
-    print(
-        'docoptのインポートに失敗しました. sudo python3 -m pip install docopt --break-system-packages コマンドでインストールして下さい. '
-    )
+  # cgpmgrdが起動していれば処理を依頼
+  if request_daemon(sys.argv[1:]):
     return
 
-  args = docopt(__doc__)
+  args = parse_args(sys.argv[1:])
 
-  try:
-    i2c = smbus2.SMBus(1)
-  except FileNotFoundError:
-    print('I2Cバスが開けませんでした. I2Cが有効になっているか確認して下さい. ')
+  # ファームウェア書き換えと保存したファイルの解析はRPZ-PowerMGRと通信しない
+  if args['fw'] or (args['--analyze'] and args['-f'] != None):
+    run(None, args)
     return
 
-  # セカンダリI2Cアドレスを使用
-  if args['-a']:
-    i2c_adr = 0x22
-
-  # ファームウェア書き換えの場合はスキップ
-  if not args['fw']:
-    # IDチェック
-    devid = i2c_read(0x10, 4)
-    if 0x52474D50 != devid[0] + (devid[1] << 8) + (devid[2] << 16) + (devid[3] << 24):
-      print('RPZ-PowerMGRとの通信に失敗しました. 拡張基板が正しくセットアップされているか確認して下さい. ')
-      print('DSW1-6でセカンダリI2Cアドレスを指定している場合は-aオプションを指定して下さい. ')
+  stats = None
+  if args['--stats'] != None:
+    if args['--stats'] not in ['text', 'json']:
+      print('--stats で指定した値 {} が正しくありません. text, json のいずれかを指定してください. '.format(
+          args['--stats']))
+      return
+    stats = I2CStats()
+
+  targets = select_boards(args)
+  if targets == None:
+    return
+  try:
+    if len(targets) > 1 or args['--discover']:
+      run_boards(targets, args, stats)
       return
 
-    # ファームウェアバージョンチェック
-    fw_ver = i2c_read(0x14, 2)
-    r = False
-    if fw_ver[1] in compatible_fw:
-      if fw_ver[0] <= compatible_fw[fw_ver[1]]:
-        r = True
-    if not r:
-      print('RPZ-PowerMGRに新しいファームウェアを確認しました. 以下のコマンドで最新版のcgpmgrをインストールしてください. ')
-      print('sudo python3 -m pip install -U cgpmgr --break-system-packages')
+    pm = PowerMGR(*targets[0])
+    pm.stats = stats
+    if not open_device(pm):
       return
+    try:
+      run(pm, args)
+    except PowerMGRError as e:
+      print(e)
+    finally:
+      pm.close()
+  finally:
+    if stats != None:
+      print_stats(stats, time.perf_counter() - start, args['--stats'])
+
+
+def parse_args(argv, show_help=True):
+  """
+  コマンドライン引数をusage_patternsに従って解析する. 結果はdocoptと同じ形式.
+
+  Args:
+    argv: コマンドライン引数のリスト
+    show_help: Falseの場合, ヘルプの指定があっても表示せずに'--help'をTrueにして返す
+
+  Returns:
+    dict: コマンド, オプション, <time>をキーとした辞書. 指定されていないものはFalseかNone.
+
+  Raises:
+    SystemExit: 構文エラーの場合はUsageをメッセージにする. ヘルプを表示した場合も終了する.
+  """
+  usage = SystemExit(__doc__[__doc__.index('Usage:'):__doc__.index('\n\n', __doc__.index('Usage:'))])
+  args = {key: False for key in commands + ['on', 'off'] + flag_options}
+  args.update({key: None for key in value_options + ['<time>']})
+  present = []  # 指定された要素
+
+  i = 0
+  while i < len(argv):
+    arg = argv[i]
+    i += 1
+    names = []
+    if arg.startswith('--'):
+      name, eq, value = arg.partition('=')
+      if name in value_options and not eq:
+        if i >= len(argv):
+          raise usage
+        value = argv[i]
+        i += 1
+      elif not (name in value_options or (name in flag_options and not eq)):
+        raise usage
+      names.append((name, value if name in value_options else True))
+    elif arg.startswith('-') and len(arg) > 1:
+      # -ai のようにまとめて指定した場合, 引数を取るオプションより後ろは引数
+      for j in range(1, len(arg)):
+        name = '--help' if arg[j] == 'h' else '-' + arg[j]
+        if name in value_options:
+          value = arg[j + 1:]
+          if value == '':
+            if i >= len(argv):
+              raise usage
+            value = argv[i]
+            i += 1
+          names.append((name, value))
+          break
+        elif name in flag_options:
+          names.append((name, True))
+        else:
+          raise usage
+    elif arg in commands and not any(args[key] for key in commands):
+      names.append((arg, True))
+    elif arg in ['on', 'off']:
+      names.append(('on|off', None))
+      args[arg] = True
+    else:
+      names.append(('<time>', arg))
+
+    for name, value in names:
+      if name in present:
+        raise usage
+      present.append(name)
+      if value != None:
+        args[name] = value
+
+  if args['--help']:
+    if not show_help:
+      return args
+    print(__doc__.strip('\n'))
+    sys.exit()
+
+  # 位置引数は <time> (on | off) の順
+  if '<time>' in present and 'on|off' in present and present.index('<time>') > present.index('on|off'):
+    raise usage
+  if any(all(name in present for name in group) for group in exclusive_options):
+    raise usage
+
+  for command, required, optional in usage_patterns:
+    if args[command] and set(required) <= set(present) - set(commands) <= set(required + optional):
+      return args
+  raise usage
+
+
+def select_boards(args):
+  """
+  コマンドライン引数から対象のボードを決める. 失敗した場合はエラーメッセージを表示する.
+
+  Args:
+    args: parse_args()で解析したコマンドライン引数の辞書
+
+  Returns:
+    list: (I2Cバス番号, I2Cアドレス)のリスト. 失敗した場合はNone.
+  """
+  # セカンダリI2Cアドレスを使用
+  adr = 0x22 if args['-a'] else 0x20
+
+  if args['--discover']:
+    targets = discover()
+    if len(targets) == 0:
+      print('RPZ-PowerMGRが見つかりませんでした. I2Cが有効になっているか確認して下さい. ')
+      return None
+    return targets
+
+  if args['--target'] == None:
+    return [(1, adr)]
+
+  targets = []
+  for item in args['--target'].split(','):
+    bus, sep, address = item.strip().partition(':')
+    try:
+      target = (int(bus), int(address, 0) if sep else adr)
+    except ValueError:
+      print('--target で指定した値 {} が正しくありません. バス番号:アドレス をカンマ区切りで指定してください. '.format(item))
+      return None
+    if target not in targets:
+      targets.append(target)
+  return targets
+
+
+def run_boards(targets, args, stats=None):
+  """
+  複数のRPZ-PowerMGRでサブコマンドを実行. I2Cバス毎にスレッドで並列に実行し, 同じバスのボードは順番に処理する.
+  出力はボード毎にまとめて表示する. -fで保存するファイル名はボード毎に変え, 読み込むファイルは全てのボードで共有する.
+
+  Args:
+    targets: (I2Cバス番号, I2Cアドレス)のリスト
+    args: parse_args()で解析したコマンドライン引数の辞書
+    stats: I2C転送の統計を記録するI2CStats. 全てのボードで共有する.
+  """
+  import concurrent.futures
+  import io
+
+  if args['--watch'] != None:
+    print('--watch は複数のボードに同時に使用できません. --target でボードを1つ指定して下さい. ')
+    return
+
+  buses = {}  # I2Cバス番号 -> I2Cアドレスのリスト
+  for bus, adr in targets:
+    buses.setdefault(bus, []).append(adr)
+  out = ThreadOutput(sys.stdout)
+  results = {}  # (I2Cバス番号, I2Cアドレス) -> 出力
+
+  def run_bus(bus, addresses):
+    for adr in addresses:
+      buf = io.StringIO()
+      out.buffers[out.get_ident()] = buf
+      board_args = dict(args)
+      if args['-f'] != None and not reads_file(args):
+        board_args['-f'] = board_file(args['-f'], bus, adr)
+      pm = PowerMGR(bus, adr)
+      pm.stats = stats
+      try:
+        if open_device(pm):
+          run(pm, board_args)
+      except PowerMGRError as e:
+        print(e)
+      finally:
+        pm.close()
+        del out.buffers[out.get_ident()]
+        results[(bus, adr)] = buf.getvalue()
+
+  sys.stdout = out
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(buses)) as executor:
+      futures = [executor.submit(run_bus, bus, addresses) for bus, addresses in buses.items()]
+      for future in futures:
+        future.result()
+  finally:
+    sys.stdout = out.stream
+    for bus, adr in targets:
+      if (bus, adr) in results:
+        print('[i2c-{} 0x{:02X}]'.format(bus, adr))
+        print(results[(bus, adr)], end='')
+
+
+def print_stats(stats, wall, fmt='text'):
+  """
+  I2C転送の統計を標準エラー出力に表示する
+
+  Args:
+    stats: I2CStats
+    wall: 実行時間[s]
+    fmt: textかjson
+  """
+  summary = stats.summary(wall)
+  if fmt == 'json':
+    import json
+
+    print(json.dumps(summary), file=sys.stderr)
+    return
+
+  lines = ['I2C転送の統計']
+  lines.append('  実行時間: {:.2f}ms  I2C転送: {:.2f}ms ({}回)  I2C以外: {:.2f}ms'.format(
+      summary['wall_ms'], summary['bus_ms'], summary['transactions'], summary['outside_ms']))
+  lines.append('  アドレス  読出  書込  一括  バイト数  エラー  平均[ms]  最大[ms]')
+  for reg in summary['registers']:
+    lines.append('  {:<8}  {:>4}  {:>4}  {:>4}  {:>8}  {:>6}  {:>8.3f}  {:>8.3f}'.format(
+        reg['register'], reg['read'], reg['write'], reg['rdwr'], reg['bytes'], reg['errors'], reg['mean_ms'],
+        reg['max_ms']))
+  lock = summary['bus_lock']
+  if lock['acquired'] + lock['timeouts'] > 0:
+    lines.append('  ロック: 取得 {}回  競合 {}回  タイムアウト {}回  待ち時間 合計{:.3f}ms 最大{:.3f}ms  保持時間 最大{:.3f}ms'.format(
+        lock['acquired'], lock['contended'], lock['timeouts'], lock['wait_ms'], lock['max_wait_ms'],
+        lock['max_hold_ms']))
+  lines.append('  転送時間の分布[ms]')
+  for bucket, count in summary['histogram']:
+    lines.append('  {:>8}: {}'.format(bucket, count))
+  print('\n'.join(lines), file=sys.stderr)
+
+
+def board_file(file, bus, address):
+  """
+  複数のボードを処理する時に, ボード毎のファイル名を作る. 例) log.csv -> log-i2c1-0x20.csv
+
+  Args:
+    file: 指定されたファイル名
+    bus: I2Cバス番号
+    address: I2Cアドレス
+
+  Returns:
+    str: ボード毎のファイル名
+  """
+  root, ext = os.path.splitext(file)
+  return '{}-i2c{}-0x{:02X}{}'.format(root, bus, address, ext)
+
+
+class ThreadOutput:
+  """
+  sys.stdoutの代わりに使い, スレッド毎に出力をバッファする. バッファを登録していないスレッドは元の出力先へ書き込む.
+
+  Attributes:
+    stream: 元の出力先
+    buffers: スレッドID -> バッファ
+    lock: ask()で確認を1つずつ表示するためのロック
+  """
+
+  def __init__(self, stream):
+    import threading
+
+    self.stream = stream
+    self.buffers = {}
+    self.get_ident = threading.get_ident
+    self.lock = threading.Lock()
+
+  def write(self, s):
+    return self.buffers.get(self.get_ident(), self.stream).write(s)
+
+  def flush(self):
+    self.buffers.get(self.get_ident(), self.stream).flush()
+
+
+def reads_file(args):
+  """
+  -fのファイルを読み込むか. sc -i, --sync, --next, --simulate, --optimize, me --analyzeは読み込み, それ以外は保存する.
+
+  Args:
+    args: parse_args()で解析したコマンドライン引数の辞書
+
+  Returns:
+    bool: 読み込む場合はTrue
+  """
+  return any(args[key] not in [None, False]
+             for key in ['-i', '--sync', '--next', '--simulate', '--optimize', '--analyze'])
+
+
+def open_device(pm):
+  """
+  I2Cバスを開き, デバイスIDとファームウェアバージョンをチェックする. 既に開いている場合はチェックのみ行う.
+  失敗した場合はエラーメッセージを表示する.
+
+  Args:
+    pm: PowerMGR
+
+  Returns:
+    bool: Trueなら問題なし. FalseならRPZ-PowerMGRが見つからないか未対応のファームウェア.
+  """
+  try:
+    if pm.i2c == None:
+      pm.open()
+    else:
+      # 開いたままのバスはデバイスの確認だけ行う
+      pm.check_device()
+  except FileNotFoundError:
+    print('I2Cバスが開けませんでした. I2Cが有効になっているか確認して下さい. ')
+    return False
+  except DeviceNotFoundError:
+    print('RPZ-PowerMGRとの通信に失敗しました. 拡張基板が正しくセットアップされているか確認して下さい. ')
+    print('DSW1-6でセカンダリI2Cアドレスを指定している場合は-aオプションを指定して下さい. ')
+    return False
+  except UnsupportedFirmwareError:
+    print('RPZ-PowerMGRに新しいファームウェアを確認しました. 以下のコマンドで最新版のcgpmgrをインストールしてください. ')
+    print('sudo python3 -m pip install -U cgpmgr --break-system-packages')
+    return False
+  return True
+
+
+def run(pm, args):
+  """
+  解析済みのコマンドライン引数に従ってサブコマンドを実行.
 
+  Args:
+    pm: デバイスを確認済みのPowerMGR. fwサブコマンドと, me --analyzeでファイルを指定した場合はNone.
+    args: parse_args()で解析したコマンドライン引数の辞書
+  """
   #----------------------------
   # コンフィグ情報の設定, 表示
   if args['cf']:
+    cfg = pm.config()
+
     if args['-u'] != None:
       if not check_digit('-u', args['-u'], 1, 250):
         return
-      i2c_write(0x16, [int(args['-u'])])
+      pm.write_config(startup_timer=int(args['-u']))
       print('スタートアップタイマーを{}秒に設定しました. '.format(args['-u']))
 
     if args['-d'] != None:
       if not check_digit('-d', args['-d'], 0, 250):
         return
-      i2c_write(0x17, [int(args['-d'])])
+      pm.write_config(sd_timer=int(args['-d']))
       print('シャットダウンタイマーを' +
             ('無効にしました.' if 0 == int(args['-d']) else '{}秒に設定しました. '.format(args['-d'])))
 
-    r = i2c_read(0x18, 1)[0]
-    c = i2c_read(0x19, 1)[0]
+    r = cfg.sig_sd_request
+    c = cfg.sig_sd_complete
     if args['-r'] != None:
       if not check_digit_list('-r', args['-r'], sig2gpio):
         return
@@ -192,79 +592,77 @@ def cli():
       print('シャットダウン要求と完了信号を同じ番号に割り付けることはできません. ')
       return
 
+    if args['-r'] != None and args['-c'] != None:
+      pm.write_config(sig_sd_request=r, sig_sd_complete=c)
+    elif args['-r'] != None:
+      pm.write_config(sig_sd_request=r)
+    elif args['-c'] != None:
+      pm.write_config(sig_sd_complete=c)
+
     if args['-r'] != None:
-      if args['-c'] != None:
-        i2c_write(0x19, [0])  # 番号が重なる可能性があるので一度無効化
-      i2c_write(0x18, [r])
       print('シャットダウン要求信号を' +
             ('無効にしました.' if 0 == int(args['-r']) else 'GPIO{} に設定しました. '.format(args['-r'])))
 
     if args['-c'] != None:
-      i2c_write(0x19, [c])
       print('シャットダウン完了信号を' +
             ('無効にしました.' if 0 == int(args['-c']) else 'GPIO{} に設定しました. '.format(args['-c'])))
 
     if args['-z'] != None:
       if not check_digit('-z', args['-z'], -720, 840):
         return
-      i2c_write(0x1A, list(struct.pack("h", int(args['-z']))))
+      pm.write_config(time_zone=int(args['-z']))
 
     if args['-p'] != None:
-      if not ((1 == fw_ver[1] and 4 <= fw_ver[0]) or (2 == fw_ver[1] and 1 <= fw_ver[0])):
+      if not pm.supports(fw_power_options):
         print('-p は現在のファームウェアで利用できません. Webサイトの説明に沿って最新のファームウェアへアップデートして下さい. ')
         return
       if not check_digit('-p', args['-p'], 0, 1):
         return
-      i2c_write(0x1C, [int(args['-p'])])
+      pm.write_config(auto_run=int(args['-p']))
       print('電源自動リカバリーを' + ('無効にしました.' if 0 == int(args['-p']) else '有効にしました. '))
 
     if args['-w'] != None:
-      if not ((1 == fw_ver[1] and 4 <= fw_ver[0]) or (2 == fw_ver[1] and 1 <= fw_ver[0])):
+      if not pm.supports(fw_power_options):
         print('-w は現在のファームウェアで利用できません. Webサイトの説明に沿って最新のファームウェアへアップデートして下さい. ')
         return
       if not check_digit('-w', args['-w'], 0, 1):
         return
-      i2c_write(0x1D, [int(args['-w'])])
+      pm.write_config(usba_wake_up=int(args['-w']))
       print('USB Type-AモバイルバッテリーWake upを' + ('無効にしました.' if 0 == int(args['-w']) else '有効にしました. '))
 
     if args['-b'] != None:
-      if not ((1 == fw_ver[1] and 10 <= fw_ver[0]) or (2 == fw_ver[1] and 7 <= fw_ver[0])):
+      if not pm.supports(fw_reboot_option):
         print('-b は現在のファームウェアで利用できません. Webサイトの説明に沿って最新のファームウェアへアップデートして下さい. ')
         return
       if not check_digit('-b', args['-b'], 0, 255):
         return
-      i2c_write(0x1E, [int(args['-b'])])
+      pm.write_config(reboot_sequence=int(args['-b']))
       print('再起動処理を' + ('Raspberry Piに設定しました.' if 0 ==
                         int(args['-b']) else '{}秒待機して確認に設定しました.'.format(int(args['-b']))))
 
-    # コンフィグ読み出し
-    rpi_startup_timer = i2c_read(0x16, 1)[0]
-    rpi_sd_timer = i2c_read(0x17, 1)[0]
-    sig_sd_request = i2c_read(0x18, 1)[0]
-    sig_sd_complete = i2c_read(0x19, 1)[0]
-    time_zone_min = i2c_read(0x1A, 2)
+    # 設定を変更した場合はコンフィグを読み直す
+    if any(args[opt] != None for opt in ['-u', '-d', '-r', '-c', '-z', '-p', '-w', '-b']):
+      cfg = pm.config()
+
     print('コンフィグ情報')
-    print('  ファームウェアバージョン: {}.{}'.format(fw_ver[1], fw_ver[0]))
-    print('  スタートアップタイマー: {}秒'.format(rpi_startup_timer))
-    print('  シャットダウンタイマー: ' + ('無効' if rpi_sd_timer == 0 else '{}秒'.format(rpi_sd_timer)))
+    print('  ファームウェアバージョン: {}.{}'.format(cfg.fw_ver[1], cfg.fw_ver[0]))
+    print('  スタートアップタイマー: {}秒'.format(cfg.startup_timer))
+    print('  シャットダウンタイマー: ' + ('無効' if cfg.sd_timer == 0 else '{}秒'.format(cfg.sd_timer)))
     print('  シャットダウン要求信号: ' +
-          ('無効' if sig_sd_request == 0 else 'GPIO{}'.format(sig2gpio[sig_sd_request])))
+          ('無効' if cfg.sig_sd_request == 0 else 'GPIO{}'.format(sig2gpio[cfg.sig_sd_request])))
     print('  シャットダウン完了信号: ' +
-          ('無効' if sig_sd_complete == 0 else 'GPIO{}'.format(sig2gpio[sig_sd_complete])))
-    print('  タイムゾーン設定: ' + ('{}'.format(struct.unpack("h", bytes(time_zone_min))[0])))
+          ('無効' if cfg.sig_sd_complete == 0 else 'GPIO{}'.format(sig2gpio[cfg.sig_sd_complete])))
+    print('  タイムゾーン設定: {}'.format(cfg.time_zone))
 
     # ファームウェアVersion1.4 / 2.1以降で追加されたオプション
-    if (1 == fw_ver[1] and 4 <= fw_ver[0]) or (2 == fw_ver[1] and 1 <= fw_ver[0]):
-      auto_run = i2c_read(0x1C, 1)[0]
-      usba_wake_up = i2c_read(0x1D, 1)[0]
-      print('  電源自動リカバリー: ' + ('無効' if auto_run == 0 else '有効'))
-      print('  USB Type-Aウェイクアップ: ' + ('無効' if usba_wake_up == 0 else '有効'))
+    if cfg.auto_run != None:
+      print('  電源自動リカバリー: ' + ('無効' if cfg.auto_run == 0 else '有効'))
+      print('  USB Type-Aウェイクアップ: ' + ('無効' if cfg.usba_wake_up == 0 else '有効'))
 
     # ファームウェアVersion1.10 / 2.7以降で追加されたオプション
-    if (1 == fw_ver[1] and 10 <= fw_ver[0]) or (2 == fw_ver[1] and 7 <= fw_ver[0]):
-      reboot_sequence = i2c_read(0x1E, 1)[0]
-      print('  再起動処理: ' +
-            ('Raspberry Pi' if reboot_sequence == 0 else '{}秒待機して確認'.format(reboot_sequence)))
+    if cfg.reboot_sequence != None:
+      print('  再起動処理: ' + ('Raspberry Pi' if cfg.reboot_sequence ==
+                           0 else '{}秒待機して確認'.format(cfg.reboot_sequence)))
 
   #----------------------------
   # スケジュールの追加, 削除, 表示
@@ -299,7 +697,7 @@ def cli():
         print('-Dで指定した値{}が正しくありません. '.format(args['-D']))
         return
 
-      if wc and fw_ver[1] == 1 and fw_ver[0] <= 2:
+      if wc and not pm.supports(fw_date_wildcard):
         print('<time>に*を指定した場合は-Dオプションは指定できません. ')
         print('ファームウェアを更新することで指定可能になります.')
         return
@@ -318,7 +716,7 @@ def cli():
       # 月
       if data[0] in ['*', '**']:
         pass
-      elif check_digit('-D', data[0], 1, 12) and not (wc and fw_ver[1] == 1 and fw_ver[0] <= 2):
+      elif check_digit('-D', data[0], 1, 12) and not (wc and not pm.supports(fw_date_wildcard)):
         sch[3] = int(data[0])
       else:
         print('-Dで指定した値{}が正しくありません. '.format(args['-D']))
@@ -337,14 +735,16 @@ def cli():
       if not check_digit('-l', args['-l'], 0, 999):
         return
 
+      import datetime
+
       # -l 0 offかつファームウェアが対応している場合, すぐにシャットダウンリクエスト
       if 0 == int(args['-l']):
-        if (fw_ver[1] == 1 and fw_ver[0] >= 6) or (fw_ver[1] == 2 and fw_ver[0] >= 3):
+        if pm.supports(fw_shutdown_request):
           print('シャットダウン要求を開始します')
-          i2c_write(0x40, [0xFF])
+          pm.request_shutdown()
           return
 
-      dtrtc = read_rtc()
+      dtrtc = pm.read_rtc()
       delay = int(args['-l'])
       if delay == 0:
         dt = dtrtc + datetime.timedelta(seconds=75)  # 通信, 計算マージン15秒 + 桁繰り上げ用60秒
@@ -356,79 +756,85 @@ def cli():
       sch[3] = dt.month
 
     if args['on'] or args['off']:
-      sch_count = i2c_read(0x30, 1)[0]  # 登録済みスケジュールの数
-      if sch_count >= 250:
+      sch_count = pm.schedule_count()
+      if sch_count >= max_schedules:
         print('スケジュール登録数の上限に達しています. これ以上登録できません')
         return
-      i2c_write(0x32, sch)
+      pm.add_schedules([sch], sch_count)
       print('スケジュールを登録しました')
 
     # 削除オプション
-    sch_count = i2c_read(0x30, 1)[0]  # 登録済みスケジュールの数
-    numbers = list(range(1, sch_count + 1))  # 登録済みスケジュール番号のリスト
-    numbers.append(0xFF)  # 全スケジュール削除用の特殊番号
     if args['-R'] != None:
+      numbers = list(range(1, pm.schedule_count() + 1))  # 登録済みスケジュール番号のリスト
+      numbers.append(0xFF)  # 全スケジュール削除用の特殊番号
       if not check_digit_list('-R', args['-R'], numbers):
         return
 
-      i2c_write(0x36, [int(args['-R'])])
+      pm.delete_schedule(int(args['-R']))
       if int(args['-R']) == 0xFF:
         print('全てのスケジュールを削除しました. ')
       else:
         print('スケジュール#{:03}を削除しました. '.format(int(args['-R'])))
 
     # csvファイルから登録
-    sch_list = []
     if (args['-f'] != None) and args['-i']:
-      try:
-        with open(args['-f'], 'r') as f:
-          line_num = 0
-          for line in f:
-            line_num += 1
+      sch_list = load_schedule_csv(args['-f'], pm.fw_ver)
+      if sch_list == None:
+        return
 
-            # 1行目, 空白行は無視
-            if line_num == 1 or line == '\n':
-              continue
+      try:
+        pm.add_schedules(sch_list)
+      except PowerMGRError as e:
+        print(e)
+        return
 
-            sch = csv2sch(line.rstrip('\n'))
+      print('ファイル {} からスケジュールを{}個登録しました.'.format(args['-f'], len(sch_list)))
 
-            # 失敗
-            if len(sch) == 0:
-              print('csvファイル{}行目の構文にエラーがあります. 登録できませんでした. '.format(line_num))
-              print(line.rstrip('\n'))
-              return
-            else:
-              sch_list.append(sch)
-      except:
-        print('ファイル {} の読み込みに失敗しました.'.format(args['-f']))
+    # csvファイルと一致するように差分だけ削除, 登録
+    if args['--sync']:
+      sch_list = load_schedule_csv(args['-f'], pm.fw_ver)
+      if sch_list == None:
         return
 
-      sch_count = i2c_read(0x30, 1)[0]  # 登録済みスケジュールの数
-      if sch_count + len(sch_list) > 250:
-        print('スケジュールは合計250個を超えて登録できません. ')
+      try:
+        delete, add = pm.sync_schedules(sch_list)
+      except PowerMGRError as e:
+        print(e)
         return
 
-      for sch in sch_list:
-        i2c_write(0x32, sch)
+      print('ファイル {} と一致するようにスケジュールを{}個削除, {}個登録しました.'.format(
+          args['-f'], len(delete), len(add)))
+      return
 
-      print('ファイル {} からスケジュールを{}個登録しました.'.format(args['-f'], len(sch_list)))
+    # cron/OnCalendar形式のファイルから登録
+    if args['--import'] != None:
+      import_schedule_file(pm, args['--import'])
+      return
 
-    # 登録済みスケジュールの読み出し
-    sch_count = i2c_read(0x30, 1)[0]  # 登録済みスケジュールの数
-    if sch_count == 0:
+    # 電源ON/OFFが同じになる少ないスケジュールに置き換え
+    if args['--optimize']:
+      replace_optimized_schedules(pm, args)
+      return
+
+    # 次の電源ON/OFF, 期間内の電源ON/OFFを表示
+    if args['--next'] != None or args['--simulate'] != None:
+      show_schedule_events(pm, args)
+      return
+
+    # 登録済みスケジュールの読み出し. 表示とcsvファイルへの保存で共用
+    schedules = pm.schedules()
+    if len(schedules) == 0:
       print('登録さているスケジュールはありません. ')
       return
 
-    print('登録されているスケジュールが{}個あります. '.format(sch_count))
+    print('登録されているスケジュールが{}個あります. '.format(len(schedules)))
 
-    for i in range(sch_count):
-      i2c_write(0x31, [i + 1])
-      sch = i2c_read(0x32, 4)
+    for i, sch in enumerate(schedules):
       print('  #{:03} '.format(i + 1), end='')
       print(sch2str(sch))
 
     # csvファイルに保存
-    if (args['-f'] != None) and not args['-i']:
+    if (args['-f'] != None) and not args['-i'] and not args['--sync']:
       if os.path.exists(args['-f']):
         if not ask('ファイル {} は存在します. 上書きしてよいですか？'.format(args['-f'])):
           return
@@ -438,9 +844,7 @@ def cli():
           os.makedirs(os.path.dirname(args['-f']), exist_ok=True)
         with open(args['-f'], 'w') as f:
           f.write('ON/OFF, Repeat/OneTime, Month, Day, Hour, Minute\n')
-          for i in range(sch_count):
-            i2c_write(0x31, [i + 1])
-            sch = i2c_read(0x32, 4)
+          for sch in schedules:
             f.write(sch2csv(sch) + '\n')
 
           print('ファイル {} へ保存しました.'.format(args['-f']))
@@ -451,28 +855,42 @@ def cli():
   # 電流測定
   if args['me']:
     if args['-L']:
-      count = i2c_read(0x22, 2)
-      count = count[0] + (count[1] << 8)
-      if count > 3600:
+      count = pm.log_count()
+      if count > max_log:
         print('データの読み出しに失敗しました.')
         return
       print('{}秒分の電流値の記録データがあります.'.format(count))
 
+      start = 0
+      if args['--from'] != None:
+        if not check_digit('--from', args['--from'], 0, count):
+          return
+        start = int(args['--from'])
+
+      chunk = rdwr_chunk
+      if args['--chunk'] != None:
+        if not check_digit('--chunk', args['--chunk'], 0, rdwr_chunk):
+          return
+        chunk = int(args['--chunk'])
+
       # ファイルに保存
       if (args['-f'] != None):
-        if os.path.exists(args['-f']):
+        # 再開時は既存のファイルに追記
+        append = start > 0 and os.path.exists(args['-f'])
+        if os.path.exists(args['-f']) and not append:
           if not ask('ファイル {} は存在します. 上書きしてよいですか？'.format(args['-f'])):
             return
         try:
           # サブディレクトリが指定されている場合は作成
           if len(os.path.dirname(args['-f'])) > 0:
             os.makedirs(os.path.dirname(args['-f']), exist_ok=True)
-          with open(args['-f'], 'w') as f:
-            f.write('時間[s], 電流[mA]\n')
-            for i in range(count):
-              i2c_write(0x24, [i & 0xFF, i >> 8])
-              curr = i2c_read(0x26, 2)
-              f.write('{}, {}\n'.format(i, (curr[1] << 8) + curr[0]))
+          # 拡張子が.cgplの場合はアーカイブ形式
+          archive = is_archive(args['-f'])
+          with open(args['-f'], ('a' if append else 'w') + ('b' if archive else '')) as f:
+            if not append and not archive:
+              f.write('時間[s], 電流[mA]\n')
+            if not download_log(pm, f, start, count, chunk, archive):
+              return
 
             print('ファイル {} へ保存しました.'.format(args['-f']))
         except:
@@ -480,99 +898,704 @@ def cli():
       else:
         # 画面に表示
         print('時間[s], 電流[mA]')
-        for i in range(count):
-          i2c_write(0x24, [i & 0xFF, i >> 8])
-          curr = i2c_read(0x26, 2)
-          print('{}, {}'.format(i, (curr[1] << 8) + curr[0]))
+        download_log(pm, sys.stdout, start, count, chunk)
 
     elif args['-s']:
-      i2c_write(0x24, [0xFF, 0xFF])
+      pm.reset_log()
       print('電流値のログをリセットしました. 現在から毎秒, 最大1時間まで記録します. ')
 
+    elif args['--watch'] != None:
+      try:
+        hz = float(args['--watch'])
+      except ValueError:
+        hz = 0
+      if not 0.1 <= hz <= 100:
+        print('--watch で指定した値 {} が正しくありません. 0.1 - 100 の範囲の数値を指定してください. '.format(
+            args['--watch']))
+        return
+
+      fmt = 'csv' if args['--format'] == None else args['--format']
+      if fmt not in ['csv', 'ndjson']:
+        print('--format で指定した値 {} が正しくありません. csv, ndjson のいずれかを指定してください. '.format(fmt))
+        return
+
+      if (args['-f'] != None):
+        try:
+          # サブディレクトリが指定されている場合は作成
+          if len(os.path.dirname(args['-f'])) > 0:
+            os.makedirs(os.path.dirname(args['-f']), exist_ok=True)
+          with open(args['-f'], 'a') as f:
+            watch_current(pm, f, hz, fmt)
+        except OSError:
+          print('ファイル {} へ保存に失敗しました.'.format(args['-f']))
+      else:
+        watch_current(pm, sys.stdout, hz, fmt)
+
+    elif args['--analyze']:
+      analyze(pm, args)
+
     else:
-      curr = i2c_read(0x20, 2)
-      print('電流値 {}[mA]'.format((curr[1] << 8) + curr[0]))
+      print('電流値 {}[mA]'.format(pm.current()))
+
+  #----------------------------
+  # RTCの表示, 書き込み
+  if args['rtc']:
+    sync_rtc(pm, args)
 
   #----------------------------
   # ファームウェア書き換え
   if args['fw']:
-    try:
-      res = subprocess.run(['stm32flash'],
-                           encoding='utf-8',
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT)
-    except:
+    import shutil
+    from . import emulator
+
+    if emulator.enabled():
+      print('エミュレーター使用時はファームウェアを書き換えできません. ')
+      return
+
+    if shutil.which('stm32flash') == None:
       print('stm32flashが見つかりませんでした. sudo apt install stm32flash コマンドでインストールして下さい. ')
       return
 
-    try:
-      with open(args['-f'], 'rb') as f:
-        hash = hashlib.sha256(f.read()).hexdigest()
-      if not hash in known_hash:
-        if not ask('ファイル {} は既知のファームウェアではありません. 続行しますか？'.format(args['-f'])):
+    version = None
+    if args['--version'] != None:
+      major, dot, minor = args['--version'].partition('.')
+      if not (dot and major.isdigit() and minor.isdigit()):
+        print('--version で指定した値 {} が正しくありません. 例)2.7 のように指定してください. '.format(args['--version']))
+        return
+      version = (int(major), int(minor))
+
+    # 書き換え前のバージョン. 通信できない場合はNone.
+    current = running_firmware(0x22 if args['-a'] else 0x20)
+
+    if os.path.isdir(args['-f']):
+      if current == None and version == None:
+        # メジャーバージョンが異なるファームウェアを選ばないように, 現在のバージョンが不明な場合は指定を必須にする
+        print('RPZ-PowerMGRのファームウェアバージョンを確認できませんでした. --version で書き換えるバージョンを指定してください. ')
+        return
+      found = resolve_firmware(args['-f'], version, None if current == None else current[0])
+      if found == None:
+        print('ディレクトリ {} に書き換えできる{}ファームウェアが見つかりませんでした.'.format(
+            args['-f'], '' if version == None else 'Ver{}.{}の'.format(*version)))
+        return
+      file, image = found
+    else:
+      file = args['-f']
+      try:
+        image = firmware_index.get(cached_file_hashes([file])[file])
+      except OSError:
+        print('ファイル {} の読み込みに失敗しました.'.format(file))
+        return
+      if image == None:
+        if not ask('ファイル {} は既知のファームウェアではありません. 続行しますか？'.format(file)):
           return
-    except:
-      print('ファイル {} の読み込みに失敗しました.'.format(args['-f']))
-      return
+      elif version != None and image != version:
+        print('ファイル {} はVer{}.{}です. --version の指定と一致しません. '.format(file, *image))
+        return
+
+    if image != None:
+      print('ファイル {} はVer{}.{}のファームウェアです. '.format(file, *image))
+    if current != None:
+      print('RPZ-PowerMGRのファームウェアはVer{}.{}です. '.format(*current))
+      if image == current and not args['--force']:
+        print('既に同じバージョンのため書き換えません. 書き換える場合は --force を指定してください. ')
+        return
+      if image != None and image[0] != current[0]:
+        if not ask('メジャーバージョンが異なります. 続行しますか？'):
+          return
+      elif image != None and image < current:
+        if not ask('古いバージョンに書き換えます. 続行しますか？'):
+          return
+    elif image != None:
+      if not ask('RPZ-PowerMGRのバージョンを確認できませんでした. メジャーバージョン{}のVer{}.{}に書き換えますか？'.format(
+          image[0], *image)):
+        return
+    if image != None and image[1] > compatible_fw.get(image[0], -1):
+      print('Ver{}.{}はこのcgpmgrでは使用できません. 書き換え後に最新版のcgpmgrをインストールしてください. '.format(*image))
 
     print('RPZ-PowerMGRのスイッチDSW1-1, 3, 4がONになっていることを確認してください. ')
     print('SPIが有効な場合は無効化してください. ')
     if not ask('ファームウェア書き換えを開始してよろしいですか？'):
       return
 
-    boot_loader()
-    # return
-    res = subprocess.run(['stm32flash', '/dev/i2c-1', '-a', '0x42', '-j'],
-                         encoding='utf-8',
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-
-    boot_loader()
-    res = subprocess.run(['stm32flash', '/dev/i2c-1', '-a', '0x42', '-k'],
-                         encoding='utf-8',
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-
-    boot_loader()
-    res = subprocess.run(
-        ['stm32flash', '/dev/i2c-1', '-a', '0x42', '-e 0', '-w', args['-f'], '-v', '-R'])
-    if res.returncode != 0:
+    if not flash_firmware(file):
       print('ファームウェアの書き換え中にエラーが発生しました')
       return
 
     print('ファームウェアの書き換えが完了しました. ')
 
 
-def i2c_read(addr, length):
+def daemon():
+  """
+  cgpmgrdを実行. I2Cバスを開いたままUnixソケットで待ち受け, 
+  cgpmgrから依頼されたcf, sc, meサブコマンドを処理して出力を返す. 
+  """
+  import argparse
+  import socket
+
+  parser = argparse.ArgumentParser(description='RPZ-PowerMGR control daemon')
+  parser.add_argument('--socket', default=daemon_socket, help='Unix socket path')
+  parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+  parser.add_argument('--emulator', action='store_true', help='use the register-level emulator instead of I2C')
+  opts = parser.parse_args()
+  if opts.emulator:
+    os.environ['CGPMGR_EMULATOR'] = '1'
+
+  if os.path.exists(opts.socket):
+    os.remove(opts.socket)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(opts.socket)
+  os.chmod(opts.socket, 0o660)
+  server.listen(8)
+
+  devices = {}  # I2Cアドレス -> PowerMGR
+  checked = {}  # I2Cアドレス -> 確認した時刻
+  try:
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        handle_request(conn, opts.bus, devices, checked)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    os.remove(opts.socket)
+    for pm in devices.values():
+      pm.close()
+
+
+def handle_request(conn, bus, devices, checked):
   """
-  I2Cで指定アドレスから読み出す
+  cgpmgrdで1つの依頼を処理し, 標準出力と標準エラー出力への出力を返す.
+  処理中のエラーは全てクライアントに返し, cgpmgrdは次の依頼を待つ.
 
   Args:
-    addr: 読み出しアドレス. 8bit. 
-    length: 読み出しデータの長さ. バイト数.
-  
+    conn: 依頼を受け付けたソケット
+    bus: I2Cバス番号
+    devices: I2Cアドレス -> 開いたままのPowerMGRの辞書. 依頼をまたいで使う.
+    checked: I2Cアドレス -> デバイスを確認した時刻の辞書. 依頼をまたいで使う.
+  """
+  import contextlib
+  import io
+
+  conn.settimeout(5)
+  out = io.StringIO()
+  adr = None
+  try:
+    argv = conn.makefile('rb').read().decode('utf-8').split('\0')
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+      args = parse_args(argv, show_help=False)
+      if not daemon_allowed(args):
+        # ファイルはcgpmgrdの権限と作業ディレクトリで書き込まれるので受け付けない
+        raise SystemExit('cgpmgrdでは処理できない指定です. ')
+      adr = 0x22 if args['-a'] else 0x20
+
+      # バスはアドレス毎に開いたままにし, デバイスの確認は一定間隔でのみ行う
+      now = time.monotonic()
+      if adr in checked and now - checked[adr] < daemon_check_interval:
+        run(devices[adr], args)
+      else:
+        checked.pop(adr, None)
+        if adr not in devices:
+          devices[adr] = PowerMGR(bus, adr)
+        if open_device(devices[adr]):
+          checked[adr] = now
+          run(devices[adr], args)
+        else:
+          devices.pop(adr).close()
+  except SystemExit as e:
+    # 構文エラー
+    out.write('{}\n'.format(e))
+  except PowerMGRError as e:
+    # 通信エラー. 次の依頼ではデバイスを確認し直す.
+    out.write('{}\n'.format(e))
+    if adr != None:
+      checked.pop(adr, None)
+  except Exception as e:
+    # 依頼の受信, ファイル入出力の失敗や想定外のエラー. 黙って切断せずにエラーを返し, 次の依頼ではデバイスを確認し直す.
+    out.write('cgpmgrdでエラーが発生しました. {}: {}\n'.format(type(e).__name__, e))
+    if adr != None:
+      checked.pop(adr, None)
+  try:
+    conn.sendall(out.getvalue().encode('utf-8') + daemon_end)
+  except OSError:
+    pass
+
+
+def request_daemon(argv):
+  """
+  cgpmgrdが起動していれば, サブコマンドの処理を依頼して結果を表示する. 
+  ファイル入出力や確認が必要なもの(-f, fw, --optimize, --import), 終了しないもの(--watch), 
+  cgpmgrdが開いていないバスを使うもの(--target, --discover), 転送を計測するもの(--stats), ヘルプは依頼しない. 
+
+  Args:
+    argv: コマンドライン引数のリスト
+
   Returns:
-    list: 読み出しデータのリスト. 通信失敗で全て0を返す. 
+    bool: cgpmgrdに依頼したらTrue. Falseの場合は自身で処理する. 
+
+  Raises:
+    SystemExit: 依頼した後に応答を受信できなかった. 処理済みの可能性があるので自身では処理しない.
   """
+  if len(argv) == 0 or argv[0] not in ['cf', 'sc', 'me']:
+    return False
+  if not os.path.exists(daemon_socket):
+    return False
+  # -afのようにまとめて指定した場合も判定できるように解析した結果で判断する
   try:
-    return i2c.read_i2c_block_data(i2c_adr, addr, length)
-  except IOError:
-    return [0 for i in range(length)]
+    args = parse_args(argv, show_help=False)
+  except SystemExit:
+    return False
+  if not daemon_allowed(args):
+    return False
+
+  import socket
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+    conn.settimeout(daemon_timeout)
+    # 接続できない場合だけ自身で処理する
+    try:
+      conn.connect(daemon_socket)
+    except OSError:
+      return False
+
+    # 依頼した後はcgpmgrdが処理した可能性があるので, 失敗しても自身で処理し直さない
+    res = b''
+    try:
+      conn.sendall('\0'.join(argv).encode('utf-8'))
+      conn.shutdown(socket.SHUT_WR)
+      while True:
+        data = conn.recv(4096)
+        if not data:
+          break
+        res += data
+    except OSError as e:
+      raise SystemExit('cgpmgrdの応答を受信できませんでした. 処理されたか確認して下さい. {}'.format(e))
+  if not res.endswith(daemon_end):
+    raise SystemExit('cgpmgrdの応答が途中で終わりました. 処理されたか確認して下さい. ')
+  print(res[:-len(daemon_end)].decode('utf-8'), end='')
+  return True
+
+
+def daemon_allowed(args):
+  """
+  cgpmgrdで処理できるサブコマンドか判定する. request_daemon()を参照.
+
+  Args:
+    args: parse_args()で解析したコマンドライン引数の辞書
+
+  Returns:
+    bool: cgpmgrdで処理できればTrue
+  """
+  if not (args['cf'] or args['sc'] or args['me']):
+    return False
+  if args['--help'] or args['--optimize'] or args['--discover']:
+    return False
+  return all(args[key] == None for key in ['-f', '--watch', '--target', '--stats', '--import'])
 
 
-def i2c_write(addr, data):
+def show_schedule_events(pm, args):
   """
-  I2Cで指定アドレスに書き込む
+  sc --next, --simulateを実行. 登録済みスケジュールか-fのcsvファイルを評価し, 電源ON/OFFする日時を表示する.
 
   Args:
-    addr: 書き込みアドレス. 8bit. 
-    data(list): 書き込みデータのリスト. [1バイト目, 2バイト目, ...]
+    pm: デバイスを確認済みのPowerMGR
+    args: parse_args()で解析したコマンドライン引数の辞書
   """
+  import datetime
+  from .schedule import ScheduleIndex
+
+  if args['--next'] != None:
+    if not check_digit('--next', args['--next'], 1, 1000):
+      return
+  else:
+    period = []
+    for item in args['--simulate'].split(','):
+      try:
+        period.append(datetime.datetime.strptime(item.strip(), '%Y/%m/%d'))
+      except ValueError:
+        break
+    if len(period) != 2 or period[0] > period[1]:
+      print('--simulate で指定した値 {} が正しくありません. 開始日,終了日 を年/月/日で指定してください. '.format(
+          args['--simulate']))
+      return
+
+  if args['-f'] != None:
+    schedules = load_schedule_csv(args['-f'], pm.fw_ver)
+    if schedules == None:
+      return
+  else:
+    schedules = pm.schedules()
+  if len(schedules) == 0:
+    print('評価するスケジュールがありません. ')
+    return
+
+  index = ScheduleIndex(schedules)
+  if args['--next'] != None:
+    now = pm.read_rtc()
+    print('RTC時刻 {:%Y/%m/%d %H:%M:%S} から{}個の電源ON/OFFを表示します. '.format(now, args['--next']))
+    events = index.next_events(now, int(args['--next']))
+  else:
+    # 開始日の0:00から終了日の24:00まで
+    start = period[0] - datetime.timedelta(seconds=1)
+    events = list(index.events(start, period[1] + datetime.timedelta(days=1)))
+    print('{:%Y/%m/%d} から {:%Y/%m/%d} までに電源ONが{}回, OFFが{}回あります. '.format(
+        period[0], period[1], sum(1 for event in events if not event[2].off),
+        sum(1 for event in events if event[2].off)))
+
+  for dt, num, sch in events:
+    print('  {:%Y/%m/%d} {} {:%H:%M}  #{:03} {}'.format(dt, dow2str[dt.isoweekday() % 7], dt, num,
+                                                       sch2str(schedules[num - 1])))
+  if args['--next'] != None and len(events) < int(args['--next']):
+    print('これ以降に電源ON/OFFするスケジュールはありません. ')
+
+
+def import_schedule_file(pm, file):
+  """
+  sc --importを実行. cron/OnCalendar形式のファイルをスケジュールに変換して追加する.
+  変換できない行がある場合と, 登録数が上限を超える場合は1つも追加しない.
+
+  Args:
+    pm: デバイスを確認済みのPowerMGR
+    file: ファイルのパス
+  """
+  from .schedule import import_schedules, ScheduleError
+
+  try:
+    with open(file, 'r') as f:
+      sch_list = import_schedules(f.readlines(), pm.fw_ver)
+  except OSError:
+    print('ファイル {} の読み込みに失敗しました.'.format(file))
+    return
+  except ScheduleError as e:
+    print(e)
+    print('スケジュールを登録できませんでした. ')
+    return
+
+  print('ファイル {} をスケジュール{}個に変換しました. '.format(file, len(sch_list)))
+  for sch in sch_list:
+    print('  ' + sch2str(sch))
+
+  try:
+    # 登録数の確認から追加までの間に他のプロセスが追加しないようにロックする
+    with pm.bus_lock:
+      count = pm.schedule_count()
+      if count + len(sch_list) > max_schedules:
+        print('登録済みの{}個と合わせて{}個を超えるため登録できません. '.format(count, max_schedules))
+        return
+      pm.add_schedules(sch_list, count, atomic=True)
+  except PowerMGRError as e:
+    print(e)
+    print('スケジュールを登録できませんでした. ')
+    return
+  print('ファイル {} からスケジュールを{}個登録しました.'.format(file, len(sch_list)))
+
+
+def replace_optimized_schedules(pm, args):
+  """
+  sc --optimizeを実行. 登録済みスケジュールか-fのcsvファイルを最適化し, 
+  全ての日付で電源ON/OFFが一致することを確認してから登録済みスケジュールと置き換える.
+
+  Args:
+    pm: デバイスを確認済みのPowerMGR
+    args: parse_args()で解析したコマンドライン引数の辞書
+  """
+  from .schedule import optimize_schedules, equivalent_schedules
+
+  if args['-f'] != None:
+    source = load_schedule_csv(args['-f'], pm.fw_ver)
+    if source == None:
+      return
+  else:
+    source = pm.schedules()
+  if len(source) == 0:
+    print('最適化するスケジュールがありません. ')
+    return
+
+  optimized = optimize_schedules(source, pm.fw_ver)
+  print('スケジュール{}個を{}個に最適化しました. '.format(len(source), len(optimized)))
+  for i, sch in enumerate(optimized):
+    print('  #{:03} '.format(i + 1), end='')
+    print(sch2str(sch))
+
+  if not equivalent_schedules(source, optimized):
+    print('最適化前後で電源ON/OFFする日時が一致しませんでした. 登録を中止します. ')
+    return
+  print('全ての日付で最適化前と同じ日時に電源ON/OFFすることを確認しました. ')
+
+  if len(optimized) > max_schedules:
+    print('最適化後もスケジュールが{}個を超えるため登録できません. '.format(max_schedules))
+    return
+  if args['-f'] == None and optimized == source:
+    print('登録済みスケジュールはこれ以上最適化できません. ')
+    return
+  if not ask('登録済みスケジュールを最適化したスケジュールに置き換えてよいですか？'):
+    return
+
+  try:
+    delete, add = pm.sync_schedules(optimized)
+  except PowerMGRError as e:
+    print(e)
+    return
+  print('スケジュールを{}個削除, {}個登録しました.'.format(len(delete), len(add)))
+
+
+def load_schedule_csv(file, fw_ver=None):
+  """
+  csvファイルからスケジュールを読み込む. 1行目と空白行は無視する.
+  失敗した場合はエラーメッセージを表示する.
+
+  Args:
+    file: csvファイルのパス
+    fw_ver: ファームウェアバージョン. csv2sch()を参照.
+
+  Returns:
+    list: RPZ-PowerMGRの4バイトのスケジュールデータのリスト. 失敗したらNone.
+  """
+  sch_list = []
+  try:
+    with open(file, 'r') as f:
+      line_num = 0
+      for line in f:
+        line_num += 1
+
+        # 1行目, 空白行は無視
+        if line_num == 1 or line == '\n':
+          continue
+
+        sch = csv2sch(line.rstrip('\n'), fw_ver)
+
+        # 失敗
+        if len(sch) == 0:
+          print('csvファイル{}行目の構文にエラーがあります. 登録できませんでした. '.format(line_num))
+          print(line.rstrip('\n'))
+          return None
+        else:
+          sch_list.append(sch)
+  except:
+    print('ファイル {} の読み込みに失敗しました.'.format(file))
+    return None
+  return sch_list
+
+
+def download_log(pm, f, start, count, chunk=rdwr_chunk, archive=False):
+  """
+  記録されている電流値をstartからcount未満のインデックスまで読み出し, ファイルに書き出す. 
+  csvでは読み出した分だけ順に書き出すので, サンプル数によらずメモリ使用量は一定. 
+  アーカイブ形式では読み出した電流値を最後に1ブロックとして書き出す. 
+  中断した場合や通信に失敗した場合は再開用のインデックスを表示する. 
+
+  Args:
+    pm: PowerMGR
+    f: 書き出し先のファイルオブジェクト
+    start: 読み出しを開始するインデックス
+    count: 記録されているサンプル数
+    chunk: まとめて読み出すサンプル数. PowerMGR.read_log()を参照. 
+    archive: Trueの場合はアーカイブ形式. fはバイナリモードで開く. 
+
+  Returns:
+    bool: 最後まで読み出せたらTrue, 中断したらFalse
+  """
+  samples = []
+  if archive:
+    # インデックス0は記録開始時, 最後のインデックスは現在のRTC時刻
+    cfg = pm.config()
+    log_start = pm.read_rtc(utc=True).timestamp() - count + 1
+
+  i = start
+  t = time.monotonic()
+  error = None
+  try:
+    for data in pm.read_log(start, count - start, chunk):
+      if archive:
+        samples += data
+      else:
+        f.write(''.join('{}, {}\n'.format(i + j, curr) for j, curr in enumerate(data)))
+      i += len(data)
+  except (KeyboardInterrupt, PowerMGRError) as e:
+    error = e
+
+  # 中断した場合も読み出した分は保存する
+  if archive and len(samples) > 0:
+    write_block(f, samples, log_start + start, 1, 'varint', cfg.dev_id, cfg.fw_ver,
+                0 if cfg.time_zone == None else cfg.time_zone, pm.bus if isinstance(pm.bus, int) else 0,
+                pm.address)
+  if error != None:
+    f.flush()
+    if isinstance(error, PowerMGRError):
+      print(error, file=sys.stderr)
+    print('読み出しを中断しました. --from {} で再開できます. '.format(i), file=sys.stderr)
+    return False
+
+  # 画面にcsvを出力する場合に混ざらないように標準エラー出力に表示
+  t = time.monotonic() - t
+  print('{}サンプルを{:.2f}秒で読み出しました ({:.0f}サンプル/秒). '.format(
+      i - start, t, (i - start) / t if t > 0 else 0),
+        file=sys.stderr)
+  return True
+
+
+def watch_current(pm, f, hz, fmt='csv'):
+  """
+  直近の電流測定値を一定周期で読み出し, 1行ずつファイルに書き出す. Ctrl+Cで終了.
+  周期に間に合わなかった回数は各行と終了時に表示する. 終了時の表示は標準エラー出力.
+
+  Args:
+    pm: PowerMGR
+    f: 書き出し先のファイルオブジェクト
+    hz: 読み出す周波数[Hz]
+    fmt: 出力形式. csvは"時刻, 電流[mA], 欠損"の行. ndjsonは1行1つのJSON.
+  """
+  count = 0
+  missed_total = 0
+  if fmt == 'csv' and (not f.seekable() or f.tell() == 0):
+    f.write('時刻[s], 電流[mA], 欠損\n')
   try:
-    i2c.write_i2c_block_data(i2c_adr, addr, data)
-  except IOError:
+    for t, curr, missed in pm.watch_current(hz):
+      if fmt == 'csv':
+        f.write('{:.3f}, {}, {}\n'.format(t, curr, missed))
+      else:
+        f.write('{{"time": {:.3f}, "current": {}, "missed": {}}}\n'.format(t, curr, missed))
+      f.flush()
+      count += 1
+      missed_total += missed
+  except KeyboardInterrupt:
+    pass
+  print('{}サンプルを読み出しました. 周期に間に合わなかった回数 {}'.format(count, missed_total),
+        file=sys.stderr)
+
+
+def analyze(pm, args):
+  """
+  me --analyzeを実行. 電流値をRPZ-PowerMGRか-fのファイルから読み出して解析結果を表示する.
+
+  Args:
+    pm: デバイスを確認済みのPowerMGR. -fを指定した場合は使わない.
+    args: parse_args()で解析したコマンドライン引数の辞書
+  """
+  from .analysis import analyze_log, load_log
+  from .archive import ArchiveError
+
+  options = {}
+  for key, name, min in [('--voltage', 'voltage', 0.001), ('--spike', 'spike', 0), ('--resample', 'resolution', 1)]:
+    if args[key] != None:
+      if not check_float(key, args[key], min, 100000):
+        return
+      options[name] = float(args[key])
+
+  if args['-f'] != None:
+    try:
+      samples, interval = load_log(args['-f'])
+    except (OSError, ArchiveError):
+      print('ファイル {} の読み込みに失敗しました.'.format(args['-f']))
+      return
+  else:
+    samples, interval = pm.log(), 1
+
+  result = analyze_log(samples, interval, **options)
+  if result == None:
+    print('電流値の記録データがありません.')
+    return
+
+  print('{}秒分の電流値を解析しました.'.format(result.count * result.interval))
+  print('最小 {}[mA], 最大 {}[mA], 平均 {:.1f}[mA], 標準偏差 {:.1f}[mA]'.format(result.min, result.max, result.mean,
+                                                                    result.std))
+  print('パーセンタイル ' + ', '.join('{}%: {:.1f}[mA]'.format(q, v) for q, v in result.percentiles))
+  print('電荷量 {:.2f}[mAh]'.format(result.charge))
+  if result.energy != None:
+    print('電力量 {:.3f}[Wh] ({}V)'.format(result.energy, args['--voltage']))
+
+  if len(result.spikes) == 0:
+    print('{:.1f}[mA]を超えるスパイクはありません.'.format(result.threshold))
+  else:
+    print('{:.1f}[mA]を超えるスパイクが{}個あります.'.format(result.threshold, len(result.spikes)))
+    for start, length, peak in result.spikes:
+      print('  {}[s]から{}秒間 最大 {}[mA]'.format(start * result.interval, length * result.interval, peak))
+
+  if result.resampled != None:
+    print('時間[s], 平均[mA], 最小[mA], 最大[mA]')
+    for t, mean, low, high in result.resampled:
+      print('{}, {:.1f}, {}, {}'.format(t, mean, low, high))
+
+
+def sync_rtc(pm, args):
+  """
+  RTCの時刻とシステム時刻とのずれを表示する. --syncではシステム時刻をRTCに, --restoreではRTCの時刻をシステム時刻に, 
+  ずれが閾値を超えた場合だけ書き込む. --driftでは間隔を空けてずれを2回測り, RTCの進み, 遅れを求める.
+  システム時刻の設定はhwclockを起動せずにclock_settimeで行う.
+
+  Args:
+    pm: デバイスを確認済みのPowerMGR
+    args: parse_args()で解析したコマンドライン引数の辞書
+  """
+  threshold = rtc_threshold
+  if args['--threshold'] != None:
+    if not check_float('--threshold', args['--threshold'], 0, 86400):
+      return
+    threshold = float(args['--threshold'])
+  if args['--drift'] != None and not check_float('--drift', args['--drift'], 10, 86400):
     return
 
+  dt = pm.read_rtc()
+  print('RTC時刻 ', end='')
+  print_time_bcd(make_bcd(dt.year, dt.month, dt.day, dt.isoweekday() % 7 + 1, dt.hour, dt.minute, dt.second))
+  start = time.monotonic()
+  offset = pm.rtc_offset()
+  print('システム時刻とのずれ {:+.3f}[s]'.format(offset))
+
+  if args['--drift'] != None:
+    interval = float(args['--drift'])
+    print('{}秒後にもう一度測定します. '.format(args['--drift']))
+    time.sleep(max(0, interval - (time.monotonic() - start)))
+    latest = pm.rtc_offset()
+    ppm = (latest - offset) / (time.monotonic() - start) * 1e6
+    print('システム時刻とのずれ {:+.3f}[s]'.format(latest))
+    print('RTCはシステム時刻に対して {:+.1f}[ppm] (1日あたり {:+.2f}[s]) ずれています. '.format(ppm, ppm * 0.0864))
+
+  elif args['--sync']:
+    if abs(offset) <= threshold:
+      print('ずれが{}秒以下のためRTCに書き込みません. '.format(threshold))
+      return
+    written = pm.write_rtc()
+    print('RTCを{} (UTC)に設定しました. '.format(written.strftime('%Y/%m/%d %H:%M:%S')))
+    print('システム時刻とのずれ {:+.3f}[s]'.format(pm.rtc_offset()))
+
+  elif args['--restore']:
+    if dt.year < rtc_valid_year:
+      print('RTCの時刻が設定されていないため, システム時刻を設定しません. ')
+      return
+    if abs(offset) <= threshold:
+      print('ずれが{}秒以下のためシステム時刻を設定しません. '.format(threshold))
+      return
+    try:
+      time.clock_settime(time.CLOCK_REALTIME, time.time() + offset)
+    except PermissionError:
+      print('システム時刻の設定にはroot権限が必要です. ')
+      return
+    print('システム時刻をRTCに合わせました. ')
+
+
+def check_float(option, num, min, max):
+  """
+  文字列numが数値かチェックし, min-maxの範囲であればTrueを返す
+
+  Args:
+    option: エラーメッセージに表示する文字列を指定. ''の場合はエラーメッセージを表示しない. 
+    num: チェックする文字列
+    min: 数値の範囲の下限
+    max: 数値の範囲の上限
+  
+  Returns:
+    bool: Trueなら問題なし. Falseなら数値でないか範囲外. 
+  """
+  try:
+    if min <= float(num) <= max:
+      return True
+  except ValueError:
+    pass
+
+  if len(option) > 0:
+    print('{} で指定した値 {} が正しくありません. {} - {} の範囲の数値を指定してください. '.format(option, num, min, max))
+  return False
+
 
 def check_digit(option, num, min, max):
   """
@@ -661,55 +1684,6 @@ def print_time_bcd(bcd):
                                 bcd[0] & 0xF))
 
 
-def make_bcd(year, month, date, dow, hour, minute, second):
-  """
-  指定日時から, BCDフォーマットの7バイトのデータを生成
-
-  Args:
-    year: 年
-    month: 月
-    date: 日
-    dow: 曜日. 日曜日が1, 土曜日が7
-    hour: 時
-    minute: 分
-    second: 秒
-  
-  Returns:
-    list: BCDフォーマットの7バイトデータのリスト
-  """
-  bcd = [0] * 7
-  bcd[0] = second % 10 + (second // 10 << 4)
-  bcd[1] = minute % 10 + (minute // 10 << 4)
-  bcd[2] = hour % 10 + (hour // 10 << 4)
-  bcd[3] = dow
-  bcd[4] = date % 10 + (date // 10 << 4)
-  bcd[5] = month % 10 + (month // 10 << 4)
-  year %= 100
-  bcd[6] = year % 10 + (year // 10 << 4)
-  return bcd
-
-
-def read_rtc():
-  """
-  RTCの時刻を読み出してdatetimeに変換. タイムゾーンはRPZ-PowerMGRの設定値を読み出して計算. 
-
-  Returns:
-    datetime: タイムゾーン補正後のRTC時刻 
-  """
-  bcd = i2c_read(0x0, 7)
-  year = (bcd[6] & 0xF) + (bcd[6] >> 4) * 10 + 2000
-  month = (bcd[5] & 0xF) + (bcd[5] >> 4) * 10
-  day = (bcd[4] & 0xF) + (bcd[4] >> 4) * 10
-  hour = (bcd[2] & 0xF) + (bcd[2] >> 4) * 10
-  minute = (bcd[1] & 0xF) + (bcd[1] >> 4) * 10
-  second = (bcd[0] & 0xF) + (bcd[0] >> 4) * 10
-  dt = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
-
-  # RTCはUTCなのでタイムゾーン設定を読み出して補正
-  time_zone_min = i2c_read(0x1A, 2)
-  return dt + datetime.timedelta(minutes=struct.unpack("h", bytes(time_zone_min))[0])
-
-
 def sch2str(sch):
   """
   スケジュールデータを文字列に変換
@@ -796,19 +1770,19 @@ def sch2csv(sch):
   return s
 
 
-def csv2sch(csv_str):
+def csv2sch(csv_str, fw_ver=None):
   """
   csvファイルの1行をスケジュールデータ4バイトに変換
 
   Args:
     csv_str: csvフォーマットの文字列
-    sch: RPZ-PowerMGRの4バイトのスケジュールデータのリスト. ファームウェア仕様書参照. 
-  
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]. 指定するとファームウェアが対応していない組み合わせを失敗にする.
+
   Returns:
-    list: RPZ-PowerMGRの4バイトのスケジュールデータのリスト. 失敗したら空のリストを返す. 
+    list: RPZ-PowerMGRの4バイトのスケジュールデータのリスト. 失敗したら空のリストを返す.
   """
-  global fw_ver
-  data = re.split(r'\s*,\s*', csv_str)
+  date_wc = fw_ver == None or fw_supports(fw_ver, fw_date_wildcard)  # ワイルドカードと日付の組み合わせ
+  data = [item.strip() for item in csv_str.split(',')]
 
   # 数が不足
   if len(data) < 6:
@@ -852,7 +1826,7 @@ def csv2sch(csv_str):
   if data[3] in ['*', '**']:
     sch[2] = 0x80
     wc = True
-  elif check_digit('', data[3], 1, 31) and not (wc and fw_ver[1] == 1 and fw_ver[0] <= 2):
+  elif check_digit('', data[3], 1, 31) and not (wc and not date_wc):
     sch[2] = int(data[3])
   elif data[3].capitalize() in dow2str:
     sch[2] = 0x40 | (dow2str.index(data[3].capitalize()) + 1)
@@ -863,7 +1837,7 @@ def csv2sch(csv_str):
   if data[2] in ['*', '**']:
     sch[3] = 0x80
     wc = True
-  elif check_digit('', data[2], 1, 12) and not (wc and fw_ver[1] == 1 and fw_ver[0] <= 2):
+  elif check_digit('', data[2], 1, 12) and not (wc and not date_wc):
     sch[3] = int(data[2])
   else:
     return []
@@ -882,6 +1856,16 @@ def ask(message, default=False):
   Returns:
     bool: Yes選択でTrue, No選択でFalse
   """
+  # 複数のボードを並列に処理している場合は, バッファせず1つずつ表示する
+  out = sys.stdout
+  if isinstance(out, ThreadOutput) and out.get_ident() in out.buffers:
+    with out.lock:
+      buf = out.buffers.pop(out.get_ident())
+      try:
+        return ask(message, default)
+      finally:
+        out.buffers[out.get_ident()] = buf
+
   if (default):
     add_str = ' [Y/n]: '
   else:
@@ -897,6 +1881,179 @@ def ask(message, default=False):
       return default
 
 
+def file_hash(path):
+  """
+  ファイルのSHA-256ハッシュ値を, 全体をメモリに読み込まずにhash_chunkバイトずつ計算する
+
+  Args:
+    path: ファイルのパス
+
+  Returns:
+    str: 16進数のハッシュ値
+  """
+  import hashlib
+
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(hash_chunk), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def cached_file_hashes(paths):
+  """
+  ファイルのSHA-256ハッシュ値を求める. サイズと更新時刻がキャッシュと同じファイルは計算し直さない.
+
+  Args:
+    paths: ファイルのパスのリスト
+
+  Returns:
+    dict: パス -> 16進数のハッシュ値
+
+  Raises:
+    OSError: ファイルを読み出せない
+  """
+  import json
+
+  try:
+    with open(hash_cache_file) as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    cache = {}
+
+  hashes = {}
+  changed = False
+  for path in paths:
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    entry = cache.get(key)
+    if entry != None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+      hashes[path] = entry[2]
+      continue
+    hashes[path] = file_hash(path)
+    cache[key] = [st.st_size, st.st_mtime_ns, hashes[path]]
+    changed = True
+
+  if changed:
+    try:
+      os.makedirs(os.path.dirname(hash_cache_file), exist_ok=True)
+      with open(hash_cache_file, 'w') as f:
+        json.dump(cache, f)
+    except OSError:
+      pass
+  return hashes
+
+
+def resolve_firmware(directory, version=None, major=None):
+  """
+  ディレクトリ内の既知のファームウェアから書き換えるものを探す
+
+  Args:
+    directory: ファームウェアを置いたディレクトリ
+    version: (メジャー, マイナー). 指定した場合はこのバージョンを探す.
+    major: versionを指定しない場合, このメジャーバージョンで対応している最新のものを探す. Noneの場合は全てから探す.
+
+  Returns:
+    tuple: (ファイルのパス, (メジャー, マイナー)). 見つからなければNone.
+  """
+  paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+  paths = [path for path in paths if os.path.isfile(path)]
+  found = None
+  for path, hash in cached_file_hashes(paths).items():
+    image = firmware_index.get(hash)
+    if image == None:
+      continue
+    if version != None:
+      if image == version:
+        return path, image
+    elif (major == None or image[0] == major) and image[1] <= compatible_fw.get(image[0], -1):
+      if found == None or image > found[1]:
+        found = (path, image)
+  return found
+
+
+def running_firmware(address):
+  """
+  RPZ-PowerMGRで動作中のファームウェアのバージョンを読み出す
+
+  Args:
+    address: I2Cアドレス
+
+  Returns:
+    tuple: (メジャー, マイナー). 通信できない場合はNone.
+  """
+  pm = PowerMGR(1, address, retries=0)
+  try:
+    pm.open(check=False)
+    cfg = pm.config()
+    return cfg.fw_ver[1], cfg.fw_ver[0]
+  except (OSError, PowerMGRError):
+    return None
+  finally:
+    pm.close()
+
+
+def stm32flash(*options, quiet=True):
+  """
+  ブートローダーと通信するstm32flashを実行する
+
+  Args:
+    options: stm32flashのオプション
+    quiet: Trueの場合は出力を表示しない
+
+  Returns:
+    bool: 成功したらTrue
+  """
+  import subprocess
+
+  res = subprocess.run(['stm32flash', bootloader_device, '-a', bootloader_address] + list(options),
+                       stdout=subprocess.DEVNULL if quiet else None,
+                       stderr=subprocess.STDOUT if quiet else None)
+  return res.returncode == 0
+
+
+def flash_firmware(file):
+  """
+  ファームウェアを書き換え, 工程毎の時間を表示する.
+  ブートローダーを起動して読み出せるか確認し, 読み出し保護が無効なら保護の設定をせずにそのまま書き込む.
+  保護が有効な場合だけ解除(全消去とリセットを伴う)してからブートローダーを再起動して書き込む.
+
+  Args:
+    file: ファームウェアのファイル
+
+  Returns:
+    bool: 成功したらTrue
+  """
+  import tempfile
+
+  phases = []  # (工程, 時間[s])
+
+  def phase(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    phases.append((name, time.perf_counter() - start))
+    return result
+
+  try:
+    phase('ブートローダー起動', boot_loader)
+    with tempfile.TemporaryDirectory() as tmp:
+      protected = not phase('状態確認', stm32flash, '-r', os.path.join(tmp, 'probe.bin'), '-S', '0x08000000:4')
+
+    if protected:
+      # 読み出し保護の解除でフラッシュが全消去され, コントローラーがリセットされる
+      if not phase('保護解除', stm32flash, '-k'):
+        return False
+      phase('ブートローダー起動', boot_loader)
+      options = ['-e', '0', '-w', file, '-v', '-R']
+    else:
+      # 書き込む範囲だけ消去する
+      options = ['-w', file, '-v', '-R']
+    return phase('書き込みとベリファイ', stm32flash, *options, quiet=False)
+  finally:
+    total = sum(t for _, t in phases)
+    print('  ' + ', '.join('{} {:.2f}s'.format(name, t) for name, t in phases) + '  合計 {:.2f}s'.format(total))
+
+
 def boot_loader():
   """
   RPZ-PowerMGRのコントローラーをブートローダーから起動する. 
@@ -905,13 +2062,13 @@ def boot_loader():
   try:
     from gpiozero import DigitalOutputDevice
     boot = DigitalOutputDevice(gpio_boot)
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     boot.value = 1
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     rst = DigitalOutputDevice(gpio_rst)
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     rst.value = 1
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     boot.value = 0
     rst.close()
     boot.close()
@@ -922,12 +2079,12 @@ def boot_loader():
     GPIO.setup(gpio_rst, GPIO.OUT)
     GPIO.setup(gpio_boot, GPIO.OUT)
     GPIO.output(gpio_boot, 1)
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     GPIO.output(gpio_rst, 0)
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     GPIO.output(gpio_rst, 1)
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     GPIO.output(gpio_boot, 0)
-    time.sleep(0.01)
+    time.sleep(boot_delay)
     GPIO.cleanup(gpio_rst)
     GPIO.cleanup(gpio_boot)
@@ -0,0 +1,295 @@
+"""
+RPZ-PowerMGRのレジスタを再現するエミュレーター. smbus2.SMBusの代わりにPowerMGRから使う.
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+
+環境変数CGPMGR_EMULATORを設定すると, 番号で指定したI2Cバスの代わりにエミュレーターを使う.
+  CGPMGR_EMULATOR=1                 エミュレーターを使う
+  CGPMGR_EMULATOR_STATE=<file>      レジスタの状態をjsonファイルに保存し, 次回の実行に引き継ぐ
+  CGPMGR_EMULATOR_LATENCY=<ms>      1回の転送毎に待つ時間[ms]
+"""
+
+import os
+import struct
+import time
+
+# I2C_RDWRの読み出しメッセージのフラグ
+i2c_m_rd = 0x0001
+
+emulated_buses = {}  # I2Cバス番号 -> Emulator. 同じプロセス内では状態を共有する.
+
+
+def enabled():
+  """
+  環境変数でエミュレーターが有効になっているか
+
+  Returns:
+    bool: 有効ならTrue
+  """
+  return os.environ.get('CGPMGR_EMULATOR', '') not in ['', '0']
+
+
+def open_emulator(bus):
+  """
+  環境変数の設定でI2Cバス番号に対応するエミュレーターを返す. 同じバス番号には同じエミュレーターを返す.
+
+  Args:
+    bus: I2Cバス番号
+
+  Returns:
+    Emulator: エミュレーター
+  """
+  if bus not in emulated_buses:
+    latency = float(os.environ.get('CGPMGR_EMULATOR_LATENCY', '0')) / 1000
+    emulated_buses[bus] = Emulator(state_file=os.environ.get('CGPMGR_EMULATOR_STATE'), latency=latency)
+  return emulated_buses[bus]
+
+
+def utcnow():
+  """
+  システム時刻をUTCのnaive datetimeで返す. RTCはUTCで動作する.
+  """
+  import datetime
+
+  return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class Board:
+  """
+  1台のRPZ-PowerMGRのレジスタと内部状態
+
+  Attributes:
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]
+    config: 0x16-0x1Eのコンフィグレジスタ
+    schedules: 登録済みスケジュールのリスト
+    rtc_offset: RTCのシステム時刻(UTC)からのずれ[s]
+    log_start: 電流値の記録を開始したシステム時刻[s]
+    current: 電流値[mA]. 記録される電流値はこれに周期的な変動を加えたもの.
+    shutdown_requested: シャットダウン要求を受けたシステム時刻[s]. 要求がなければNone.
+  """
+
+  def __init__(self, fw_ver=None):
+    self.fw_ver = [7, 2] if fw_ver == None else fw_ver
+    self.config = [30, 0, 0, 0] + list(struct.pack('<h', 540)) + [0, 0, 0]
+    self.schedules = []
+    self.rtc_offset = 0
+    self.log_start = time.time() - 3600
+    self.current = 300
+    self.shutdown_requested = None
+    self.schedule_index = 1
+    self.log_index = 0
+
+  def to_dict(self):
+    """
+    状態を保存用の辞書にする
+    """
+    return {
+        'fw_ver': self.fw_ver,
+        'config': self.config,
+        'schedules': self.schedules,
+        'rtc_offset': self.rtc_offset,
+        'log_start': self.log_start,
+        'current': self.current,
+        'shutdown_requested': self.shutdown_requested,
+    }
+
+  @classmethod
+  def from_dict(cls, state):
+    """
+    to_dict()で保存した状態から作成
+    """
+    board = cls(state['fw_ver'])
+    for key in ['config', 'schedules', 'rtc_offset', 'log_start', 'current', 'shutdown_requested']:
+      setattr(board, key, state[key])
+    return board
+
+  def log_count(self):
+    return max(0, min(3600, int(time.time() - self.log_start)))
+
+  def log_value(self, index):
+    return self.current + index % 60
+
+  def read(self, addr):
+    """
+    1バイト読み出す. 複数バイトのレジスタは下位アドレスから順に読み出す.
+
+    Args:
+      addr: アドレス
+
+    Returns:
+      int: 読み出した値
+    """
+    if addr < 0x07:
+      import datetime
+
+      dt = utcnow() + datetime.timedelta(seconds=self.rtc_offset)
+      dow = (dt.weekday() + 1) % 7 + 1  # 日曜日が1
+      value = [dt.second, dt.minute, dt.hour, dow, dt.day, dt.month, dt.year % 100][addr]
+      return value if addr == 3 else value % 10 + (value // 10 << 4)
+    if 0x10 <= addr < 0x14:
+      return struct.pack('<I', 0x52474D50)[addr - 0x10]
+    if 0x14 <= addr < 0x16:
+      return self.fw_ver[addr - 0x14]
+    if 0x16 <= addr < 0x1F:
+      return self.config[addr - 0x16]
+    if 0x20 <= addr < 0x22:
+      return struct.pack('<H', self.current)[addr - 0x20]
+    if 0x22 <= addr < 0x24:
+      return struct.pack('<H', self.log_count())[addr - 0x22]
+    if 0x26 <= addr < 0x28:
+      value = self.log_value(self.log_index) if self.log_index < self.log_count() else 0
+      return struct.pack('<H', value)[addr - 0x26]
+    if addr == 0x30:
+      return len(self.schedules)
+    if 0x32 <= addr < 0x36:
+      if 1 <= self.schedule_index <= len(self.schedules):
+        return self.schedules[self.schedule_index - 1][addr - 0x32]
+      return 0
+    return 0
+
+  def write(self, addr, data):
+    """
+    書き込む. 複数バイトのレジスタはまとめて処理する.
+
+    Args:
+      addr: 先頭アドレス
+      data: 書き込むデータのリスト
+
+    Returns:
+      bool: 保存が必要な状態が変わったらTrue
+    """
+    if addr < 0x07 and len(data) == 7:
+      import datetime
+
+      bcd = [(b & 0xF) + (b >> 4) * 10 for b in data]
+      dt = datetime.datetime(2000 + bcd[6], bcd[5], bcd[4], bcd[2], bcd[1], bcd[0])
+      self.rtc_offset = (dt - utcnow()).total_seconds()
+      return True
+    if 0x16 <= addr < 0x1F:
+      for i, value in enumerate(data[:0x1F - addr]):
+        self.config[addr - 0x16 + i] = value
+      return True
+    if addr == 0x24 and len(data) == 2:
+      index = data[0] | data[1] << 8
+      if index == 0xFFFF:
+        self.log_start = time.time()
+        return True
+      self.log_index = index
+      return False
+    if addr == 0x31:
+      self.schedule_index = data[0]
+      return False
+    if addr == 0x32 and len(data) == 4:
+      if len(self.schedules) < 250:
+        self.schedules.append(list(data))
+      return True
+    if addr == 0x36:
+      if data[0] == 255:
+        self.schedules = []
+      elif 1 <= data[0] <= len(self.schedules):
+        del self.schedules[data[0] - 1]
+      return True
+    if addr == 0x40:
+      self.shutdown_requested = time.time()
+      return True
+    return False
+
+
+class Emulator:
+  """
+  RPZ-PowerMGRを接続したI2Cバスを再現する. smbus2.SMBusのread_i2c_block_data, write_i2c_block_data,
+  i2c_rdwrに対応.
+
+    with PowerMGR(Emulator()) as pm:
+      print(pm.current())
+
+  Attributes:
+    boards: I2Cアドレス -> Board
+    latency: 1回の転送毎に待つ時間[s]
+    transactions: 転送回数
+  """
+
+  def __init__(self, addresses=(0x20,), state_file=None, latency=0):
+    """
+    Args:
+      addresses: ボードを接続するI2Cアドレス
+      state_file: 状態を保存するjsonファイル. 存在すれば読み込み, 書き込みの度に保存する.
+      latency: 1回の転送毎に待つ時間[s]
+    """
+    self.boards = {adr: Board() for adr in addresses}
+    self.state_file = state_file
+    self.latency = latency
+    self.transactions = 0
+    if state_file != None and os.path.exists(state_file):
+      import json
+
+      with open(state_file) as f:
+        state = json.load(f)
+      self.boards = {int(adr, 0): Board.from_dict(board) for adr, board in state.items()}
+
+  def save(self):
+    """
+    状態をstate_fileに保存
+    """
+    if self.state_file == None:
+      return
+    import json
+
+    with open(self.state_file, 'w') as f:
+      json.dump({'0x{:02X}'.format(adr): board.to_dict() for adr, board in self.boards.items()}, f)
+
+  def transfer(self):
+    """
+    転送回数を数え, 1回分の待ち時間を入れる
+    """
+    self.transactions += 1
+    if self.latency > 0:
+      time.sleep(self.latency)
+
+  def board(self, i2c_addr):
+    """
+    I2Cアドレスのボードを返す
+
+    Raises:
+      OSError: ボードが接続されていない(NACK)
+    """
+    if i2c_addr not in self.boards:
+      raise OSError(121, 'Remote I/O error')
+    return self.boards[i2c_addr]
+
+  def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+    if length > 32:
+      raise ValueError('Desired block length over 32 bytes')
+    self.transfer()
+    board = self.board(i2c_addr)
+    return [board.read(register + i) for i in range(length)]
+
+  def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+    if len(data) > 32:
+      raise ValueError('Data length cannot exceed 32 bytes')
+    self.transfer()
+    if self.board(i2c_addr).write(register, list(data)):
+      self.save()
+
+  def i2c_rdwr(self, *i2c_msgs):
+    """
+    I2C_RDWR転送. 書き込みメッセージの1バイト目をアドレスとし, 続く読み出しメッセージはそのアドレスから読む.
+    """
+    self.transfer()
+    register = 0
+    changed = False
+    for msg in i2c_msgs:
+      board = self.board(msg.addr)
+      if msg.flags & i2c_m_rd:
+        for i in range(msg.len):
+          msg.buf[i] = bytes([board.read(register + i)])
+      else:
+        data = list(msg)
+        register = data[0]
+        if len(data) > 1:
+          changed = board.write(register, data[1:]) or changed
+    if changed:
+      self.save()
+
+  def close(self):
+    pass
@@ -0,0 +1,178 @@
+"""
+RPZ-PowerMGRの状態をPrometheus/OpenMetricsのテキスト形式で公開するエクスポーター
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+"""
+
+import collections
+import os
+import time
+from .pmgr import *
+
+exporter_port = 9849
+exporter_ttl = 5  # I2Cから読み出した値を使い回す時間[s]
+
+# メトリクス名と説明. この順に出力する.
+metric_help = collections.OrderedDict([
+    ('cgpmgr_up', 'RPZ-PowerMGR responded with a valid device ID.'),
+    ('cgpmgr_firmware_info', 'Firmware version of RPZ-PowerMGR.'),
+    ('cgpmgr_current_milliamperes', 'Latest current measurement.'),
+    ('cgpmgr_config', 'Configuration register value. Unsupported items are omitted.'),
+    ('cgpmgr_schedule_count', 'Number of registered schedules.'),
+    ('cgpmgr_rtc_offset_seconds', 'RTC time minus system time.'),
+])
+
+
+class Exporter:
+  """
+  RPZ-PowerMGRからメトリクスを読み出してテキスト形式にする.
+  読み出し結果はttl秒間キャッシュするので, 同時に何度スクレイプされてもI2Cの読み出しはttl秒に1回まで.
+  """
+
+  def __init__(self, devices, ttl=exporter_ttl):
+    """
+    Args:
+      devices: PowerMGRのリスト. open()しておく必要はない. 最初の読み出しで開き, 開いたままにする.
+      ttl: 読み出し結果をキャッシュする時間[s]
+    """
+    import threading
+
+    self.devices = devices
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.text = None
+    self.updated = None
+
+  def metrics(self):
+    """
+    メトリクスを返す. 前回の読み出しからttl秒以上経過していればI2Cから読み出して更新する.
+
+    Returns:
+      str: Prometheusのテキスト形式のメトリクス
+    """
+    with self.lock:
+      now = time.monotonic()
+      if self.text == None or now - self.updated >= self.ttl:
+        self.text = self.collect()
+        self.updated = now
+      return self.text
+
+  def collect(self):
+    """
+    全てのデバイスから読み出してメトリクスを作成する
+
+    Returns:
+      str: Prometheusのテキスト形式のメトリクス
+    """
+    families = collections.OrderedDict((name, []) for name in metric_help)
+
+    for pm in self.devices:
+      labels = 'bus="{}",address="0x{:02X}"'.format(pm.bus, pm.address)
+      for name, extra, value in read_metrics(pm):
+        families[name].append('{}{{{}{}}} {}'.format(name, labels, extra, value))
+
+    lines = []
+    for name, samples in families.items():
+      if len(samples) == 0:
+        continue
+      lines.append('# HELP {} {}'.format(name, metric_help[name]))
+      lines.append('# TYPE {} gauge'.format(name))
+      lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def read_metrics(pm):
+  """
+  1台のRPZ-PowerMGRからメトリクスを読み出す. I2Cバスは開いたままにし, 通信に失敗した場合だけ閉じて次回開き直す.
+
+  Args:
+    pm: PowerMGR
+
+  Returns:
+    list: (メトリクス名, 追加のラベル, 値)のリスト
+  """
+  import datetime
+
+  if pm.i2c == None:
+    try:
+      pm.open(check=False)
+    except OSError:
+      return [('cgpmgr_up', '', 0)]
+  try:
+    cfg = pm.config()
+    result = [
+        ('cgpmgr_up', '', 1),
+        ('cgpmgr_firmware_info', ',version="{}.{}"'.format(cfg.fw_ver[1], cfg.fw_ver[0]), 1),
+        ('cgpmgr_current_milliamperes', '', pm.current()),
+    ]
+    for key in config_addr:
+      value = getattr(cfg, key)
+      if value != None:
+        result.append(('cgpmgr_config', ',name="{}"'.format(key), value))
+    result.append(('cgpmgr_schedule_count', '', pm.schedule_count()))
+    try:
+      offset = pm.read_rtc(utc=True) - datetime.datetime.now(datetime.timezone.utc)
+      result.append(('cgpmgr_rtc_offset_seconds', '', round(offset.total_seconds(), 3)))
+    except ValueError:
+      # RTCの値が日時として不正な場合は省略
+      pass
+    return result
+  except PowerMGRError:
+    # 通信に失敗したか, RPZ-PowerMGRではない
+    pm.close()
+    return [('cgpmgr_up', '', 0)]
+
+
+def exporter():
+  """
+  cgpmgr-exporterを実行. HTTPで/metricsへのリクエストにメトリクスを返す.
+  """
+  import argparse
+  import socketserver
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+
+  parser = argparse.ArgumentParser(description='Prometheus exporter for RPZ-PowerMGR')
+  parser.add_argument('--listen', default='127.0.0.1', help='listen address')
+  parser.add_argument('--port', type=int, default=exporter_port, help='listen port')
+  parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+  parser.add_argument('--emulator', action='store_true', help='use the register-level emulator instead of I2C')
+  parser.add_argument('--address',
+                      type=lambda s: int(s, 0),
+                      action='append',
+                      help='I2C address. can be specified multiple times (default 0x20)')
+  parser.add_argument('--ttl', type=float, default=exporter_ttl, help='cache time of I2C reads in seconds')
+  opts = parser.parse_args()
+  if opts.emulator:
+    os.environ['CGPMGR_EMULATOR'] = '1'
+
+  addresses = [0x20] if opts.address == None else opts.address
+  exp = Exporter([PowerMGR(opts.bus, adr) for adr in addresses], opts.ttl)
+
+  class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path.split('?')[0] != '/metrics':
+        self.send_error(404)
+        return
+      body = exp.metrics().encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+  server = Server((opts.listen, opts.port), Handler)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    for pm in exp.devices:
+      pm.close()
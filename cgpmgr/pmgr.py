@@ -0,0 +1,1124 @@
+"""
+RPZ-PowerMGRをI2Cで制御するクラス
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+"""
+
+import collections
+import os
+import struct
+import time
+
+compatible_fw = {1: 10, 2: 7}
+fw_power_options = {1: 4, 2: 1}  # 電源自動リカバリー, USB Type-Aウェイクアップに対応したファームウェア
+fw_reboot_option = {1: 10, 2: 7}  # 再起動処理の設定に対応したファームウェア
+fw_shutdown_request = {1: 6, 2: 3}  # 0x40でのシャットダウン要求に対応したファームウェア
+fw_date_wildcard = {1: 3, 2: 0}  # 時, 日のワイルドカードと月日の指定を組み合わせられるファームウェア
+rdwr_chunk = 14  # 1回のI2C_RDWR転送にまとめるインデックス指定読み出しの数. i2c-devの1回あたり最大42メッセージ
+# インデックス指定の読み出しをI2C_RDWR転送にまとめる. 実機で未確認なので, 環境変数CGPMGR_RDWR=1を設定した場合だけ有効.
+i2c_rdwr = os.environ.get('CGPMGR_RDWR', '') not in ['', '0']
+max_schedules = 250  # 登録できるスケジュールの最大数
+max_log = 3600  # 記録できる電流値の最大数
+stats_buckets = [0.1, 0.5, 1, 2, 5, 10, 50]  # I2C転送時間のヒストグラムの区切り[ms]
+i2c_retries = 2  # I2C転送に失敗した場合にやり直す回数
+i2c_retry_delay = 0.005  # 1回目のやり直しまでの待ち時間[s]. やり直す毎に倍にする.
+bus_lock_dir = os.environ.get('CGPMGR_LOCK_DIR', '/run/lock')  # 他のプロセスと排他するロックファイルのディレクトリ
+bus_lock_timeout = 5  # 他のプロセスのロックの解放を待つ最大の時間[s]
+
+# 0x10-0x1Eのレジスタをまとめて読み出したコンフィグ情報
+# fw_verは[マイナー, メジャー]. ファームウェアが対応していない項目はNone.
+Config = collections.namedtuple('Config', [
+    'dev_id', 'fw_ver', 'startup_timer', 'sd_timer', 'sig_sd_request', 'sig_sd_complete',
+    'time_zone', 'auto_run', 'usba_wake_up', 'reboot_sequence'
+])
+
+# write_config()で書き込めるコンフィグ項目とアドレス
+config_addr = {
+    'startup_timer': 0x16,
+    'sd_timer': 0x17,
+    'sig_sd_request': 0x18,
+    'sig_sd_complete': 0x19,
+    'time_zone': 0x1A,
+    'auto_run': 0x1C,
+    'usba_wake_up': 0x1D,
+    'reboot_sequence': 0x1E,
+}
+
+
+class PowerMGRError(Exception):
+  """
+  RPZ-PowerMGRの操作に失敗
+  """
+
+
+class DeviceNotFoundError(PowerMGRError):
+  """
+  指定したアドレスにRPZ-PowerMGRが見つからない
+  """
+
+
+class UnsupportedFirmwareError(PowerMGRError):
+  """
+  ファームウェアがcgpmgrより新しいか, 機能に対応していない
+  """
+
+
+class I2CError(PowerMGRError):
+  """
+  やり直してもI2C通信に失敗
+  """
+
+
+class InvalidDataError(PowerMGRError):
+  """
+  やり直しても読み出した値が正しくない
+  """
+
+
+class BusLockTimeoutError(PowerMGRError):
+  """
+  他のプロセスがロックを解放しない
+  """
+
+
+class I2CStats:
+  """
+  I2C転送の統計. PowerMGR.statsに設定すると, 転送毎にレジスタのアドレス別の回数, バイト数, 時間, エラーを記録する.
+  複数のPowerMGRで共有できる.
+
+  Attributes:
+    registers: アドレス -> {'read', 'write', 'rdwr', 'bytes', 'errors', 'time', 'max'}.
+        rdwrはi2c_read_indexed()でまとめた転送で, 読み出しアドレスに記録する. 時間は秒.
+    histogram: 転送時間がstats_bucketsの各区切り未満だった回数. 最後は最大の区切り以上.
+    bus_lock: BusLockの{'acquired', 'contended', 'timeouts', 'wait', 'max_wait', 'max_hold'}. 時間は秒.
+  """
+
+  def __init__(self):
+    import threading
+
+    self.registers = {}
+    self.histogram = [0] * (len(stats_buckets) + 1)
+    self.bus_lock = {'acquired': 0, 'contended': 0, 'timeouts': 0, 'wait': 0, 'max_wait': 0, 'max_hold': 0}
+    self.lock = threading.Lock()
+
+  def add(self, addr, kind, length, elapsed, error=False):
+    """
+    1回の転送を記録
+
+    Args:
+      addr: レジスタのアドレス
+      kind: read, write, rdwr のいずれか
+      length: 転送したデータのバイト数
+      elapsed: 転送にかかった時間[s]
+      error: 通信に失敗した場合はTrue
+    """
+    with self.lock:
+      if addr not in self.registers:
+        self.registers[addr] = {'read': 0, 'write': 0, 'rdwr': 0, 'bytes': 0, 'errors': 0, 'time': 0, 'max': 0}
+      reg = self.registers[addr]
+      reg[kind] += 1
+      reg['time'] += elapsed
+      reg['max'] = max(reg['max'], elapsed)
+      if error:
+        reg['errors'] += 1
+      else:
+        reg['bytes'] += length
+      i = 0
+      while i < len(stats_buckets) and elapsed * 1000 >= stats_buckets[i]:
+        i += 1
+      self.histogram[i] += 1
+
+  def add_lock(self, wait, contended=False, timeout=False):
+    """
+    BusLockの取得を記録
+
+    Args:
+      wait: ロックの取得を待った時間[s]
+      contended: 他のプロセスがロックしていて待った場合はTrue
+      timeout: 取得できなかった場合はTrue
+    """
+    with self.lock:
+      if timeout:
+        self.bus_lock['timeouts'] += 1
+      else:
+        self.bus_lock['acquired'] += 1
+      if contended:
+        self.bus_lock['contended'] += 1
+      self.bus_lock['wait'] += wait
+      self.bus_lock['max_wait'] = max(self.bus_lock['max_wait'], wait)
+
+  def add_hold(self, hold):
+    """
+    BusLockを保持した時間を記録
+
+    Args:
+      hold: ロックを保持した時間[s]
+    """
+    with self.lock:
+      self.bus_lock['max_hold'] = max(self.bus_lock['max_hold'], hold)
+
+  def summary(self, wall=None):
+    """
+    統計をまとめる. 時間はミリ秒.
+
+    Args:
+      wall: 実行時間[s]. 指定するとI2C転送以外の時間も計算する.
+
+    Returns:
+      dict: transactions, bus_ms, wall_ms, outside_ms, registers, histogram, bus_lockをキーとした辞書
+    """
+    with self.lock:
+      registers = []
+      for addr in sorted(self.registers):
+        reg = self.registers[addr]
+        count = reg['read'] + reg['write'] + reg['rdwr']
+        registers.append({
+            'register': '0x{:02X}'.format(addr),
+            'read': reg['read'],
+            'write': reg['write'],
+            'rdwr': reg['rdwr'],
+            'bytes': reg['bytes'],
+            'errors': reg['errors'],
+            'mean_ms': reg['time'] / count * 1000,
+            'max_ms': reg['max'] * 1000,
+        })
+      labels = ['<{}'.format(b) for b in stats_buckets] + ['>={}'.format(stats_buckets[-1])]
+      bus = sum(reg['time'] for reg in self.registers.values())
+      result = {
+          'transactions': sum(reg['read'] + reg['write'] + reg['rdwr'] for reg in self.registers.values()),
+          'bus_ms': bus * 1000,
+          'wall_ms': None,
+          'outside_ms': None,
+          'registers': registers,
+          'histogram': list(zip(labels, self.histogram)),
+          'bus_lock': {
+              'acquired': self.bus_lock['acquired'],
+              'contended': self.bus_lock['contended'],
+              'timeouts': self.bus_lock['timeouts'],
+              'wait_ms': self.bus_lock['wait'] * 1000,
+              'max_wait_ms': self.bus_lock['max_wait'] * 1000,
+              'max_hold_ms': self.bus_lock['max_hold'] * 1000,
+          },
+      }
+      if wall != None:
+        result['wall_ms'] = wall * 1000
+        result['outside_ms'] = (wall - bus) * 1000
+      return result
+
+
+class BusLock:
+  """
+  ロックファイルのflockで, インデックスの書き込みと読み出しの組や, 登録番号に依存する一連の操作を
+  同じボードを使う他のプロセスと排他する. with文で使用する. 同じスレッド内ではネストでき, 最も外側でだけロックを取る.
+  flockはプロセス内で共有されるので, 同じBusLockを使う他のスレッドとはthreading.RLockで排他する.
+  ロックファイルを開けない場合は他のプロセスとは排他しない.
+  """
+
+  def __init__(self, pm, directory=bus_lock_dir, timeout=bus_lock_timeout):
+    """
+    Args:
+      pm: 統計を記録するPowerMGR. ロックファイル名にI2Cバス番号とアドレスを使う.
+      directory: ロックファイルのディレクトリ
+      timeout: 他のプロセスのロックの解放を待つ最大の時間[s]
+    """
+    self.pm = pm
+    self.path = os.path.join(directory, 'cgpmgr-i2c{}-0x{:02X}.lock'.format(pm.bus if isinstance(pm.bus, int) else 0,
+                                                                            pm.address))
+    self.timeout = timeout
+    self.fd = None
+    self.depth = 0  # ネストの深さ. thread_lockを持つスレッドだけが変更する.
+    self.acquired = None
+    import threading
+    self.thread_lock = threading.RLock()
+
+  def __enter__(self):
+    if not self.thread_lock.acquire(timeout=self.timeout):
+      raise BusLockTimeoutError('他のスレッドがRPZ-PowerMGRを使用中です. アドレス0x{:02X}, {}秒待ちました. '.format(
+          self.pm.address, self.timeout))
+    try:
+      if self.depth == 0:
+        self.acquire()
+    except:
+      self.thread_lock.release()
+      raise
+    self.depth += 1
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    # with文の中でclose()した場合はdepthが0になっている
+    if self.depth > 0:
+      self.depth -= 1
+      if self.depth == 0:
+        self.release()
+    self.thread_lock.release()
+
+  def acquire(self):
+    """
+    ロックを取る. 他のプロセスがロックしている場合は間隔を倍々に空けて最大timeout秒待つ.
+
+    Raises:
+      BusLockTimeoutError: timeout秒以内にロックを取れない
+    """
+    import fcntl
+
+    if self.fd == None:
+      try:
+        # 他のユーザーが作成したファイルも読み出し専用で開けばflockできる
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_CREAT, 0o666)
+      except OSError:
+        self.fd = -1
+    if self.fd < 0:
+      return
+
+    start = time.perf_counter()
+    delay = 0.0005
+    contended = False
+    while True:
+      try:
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except BlockingIOError:
+        contended = True
+        if time.perf_counter() - start >= self.timeout:
+          if self.pm.stats != None:
+            self.pm.stats.add_lock(time.perf_counter() - start, True, True)
+          raise BusLockTimeoutError('他のプロセスがRPZ-PowerMGRを使用中です. アドレス0x{:02X}, {}秒待ちました. '.format(
+              self.pm.address, self.timeout))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.01)
+    self.acquired = time.perf_counter()
+    if self.pm.stats != None:
+      self.pm.stats.add_lock(self.acquired - start, contended)
+
+  def release(self):
+    """
+    ロックを解放する
+    """
+    import fcntl
+
+    if self.fd == None or self.fd < 0:
+      return
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+    if self.pm.stats != None:
+      self.pm.stats.add_hold(time.perf_counter() - self.acquired)
+
+  def close(self):
+    """
+    ロックファイルを閉じる. ロックも解放される. with文の中で呼んだ場合, 残りのwith文の終了時には何もしない.
+    """
+    if self.fd != None and self.fd >= 0:
+      os.close(self.fd)
+    self.fd = None
+    self.depth = 0
+
+
+class PowerMGR:
+  """
+  RPZ-PowerMGRをI2Cで制御する. with文で使用するとI2Cバスを開いてデバイスを確認し, 終了時に閉じる.
+
+    with PowerMGR() as pm:
+      print(pm.current())
+
+  Attributes:
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]. check_device()で更新.
+    stats: I2C転送の統計を記録するI2CStats. Noneの場合は記録しない.
+    retries: I2C転送に失敗した場合にやり直す回数. 転送毎にも指定可能.
+    retry_delay: 1回目のやり直しまでの待ち時間[s]. やり直す毎に倍にする.
+    bus_lock: インデックス指定の読み出しや一連の操作を他のプロセスと排他するBusLock
+    rdwr: Trueの場合はインデックス指定の読み出しをI2C_RDWR転送にまとめる
+  """
+
+  def __init__(self,
+               bus=1,
+               address=0x20,
+               retries=i2c_retries,
+               retry_delay=i2c_retry_delay,
+               lock_timeout=bus_lock_timeout,
+               rdwr=i2c_rdwr):
+    """
+    Args:
+      bus: I2Cバス番号. read_i2c_block_data, write_i2c_block_dataを持つバスのオブジェクトも指定可能.
+        番号で指定した場合, 環境変数CGPMGR_EMULATORが設定されていればエミュレーターを使う.
+      address: RPZ-PowerMGRのI2Cアドレス. DSW1-6でセカンダリアドレスにした場合は0x22.
+      retries: I2C転送に失敗した場合にやり直す回数
+      retry_delay: 1回目のやり直しまでの待ち時間[s]
+      lock_timeout: 他のプロセスのロックの解放を待つ最大の時間[s]
+      rdwr: Trueの場合はインデックス指定の読み出しをI2C_RDWR転送にまとめる. 実機では未確認.
+    """
+    self.bus = bus
+    self.address = address
+    self.retries = retries
+    self.retry_delay = retry_delay
+    self.i2c = None
+    self.fw_ver = None
+    self.stats = None
+    self.bus_lock = BusLock(self, timeout=lock_timeout)
+    self.rdwr = rdwr
+
+  def __enter__(self):
+    self.open()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def open(self, check=True):
+    """
+    I2Cバスを開く
+
+    Args:
+      check: Trueの場合はcheck_device()でデバイスを確認する
+
+    Raises:
+      FileNotFoundError: I2Cバスが見つからない
+      PowerMGRError: check_device()を参照
+    """
+    if isinstance(self.bus, int):
+      self.i2c = open_bus(self.bus)
+    else:
+      self.i2c = self.bus
+    if check:
+      try:
+        self.check_device()
+      except PowerMGRError:
+        self.close()
+        raise
+
+  def close(self):
+    """
+    I2Cバスを閉じる. 番号で指定したバスのみ閉じる.
+    """
+    if self.i2c is not None and isinstance(self.bus, int):
+      self.i2c.close()
+    self.i2c = None
+    self.bus_lock.close()
+
+  def check_device(self):
+    """
+    デバイスIDとファームウェアバージョンをチェックし, fw_verを更新する.
+
+    Returns:
+      Config: チェック時に読み出したコンフィグ情報
+
+    Raises:
+      DeviceNotFoundError: RPZ-PowerMGRとの通信に失敗
+      UnsupportedFirmwareError: ファームウェアがcgpmgrより新しい
+    """
+    try:
+      cfg = self.config()
+    except (I2CError, InvalidDataError):
+      raise DeviceNotFoundError('RPZ-PowerMGRとの通信に失敗しました. ')
+    if not (cfg.fw_ver[1] in compatible_fw and cfg.fw_ver[0] <= compatible_fw[cfg.fw_ver[1]]):
+      raise UnsupportedFirmwareError('RPZ-PowerMGRに新しいファームウェアを確認しました. ')
+    self.fw_ver = cfg.fw_ver
+    return cfg
+
+  def supports(self, min_ver):
+    """
+    ファームウェアが機能に対応しているかチェック
+
+    Args:
+      min_ver: メジャーバージョンと, 機能に対応した最小のマイナーバージョンの辞書
+
+    Returns:
+      bool: 対応していればTrue
+    """
+    return fw_supports(self.fw_ver, min_ver)
+
+  #----------------------------
+  # コンフィグ
+
+  def config(self):
+    """
+    0x10-0x1Eのコンフィグ領域を1回の転送で読み出す
+
+    Returns:
+      Config: 読み出したコンフィグ情報
+
+    Raises:
+      I2CError: 通信に失敗
+      InvalidDataError: デバイスIDが一致しない
+    """
+    return decode_config(self.i2c_read(0x10, 15, valid_dev_id))
+
+  def write_config(self, **values):
+    """
+    コンフィグを書き込む. 指定した項目のみ書き込む.
+
+    Args:
+      values: Configの項目名と値. startup_timer, sd_timer, sig_sd_request, sig_sd_complete,
+        time_zone, auto_run, usba_wake_up, reboot_sequenceを指定可能. SIG番号はGPIO番号ではない.
+
+    Raises:
+      UnsupportedFirmwareError: ファームウェアが項目に対応していない
+      ValueError: 不明な項目, またはシャットダウン要求と完了信号が同じ番号
+    """
+    for key in values:
+      if key not in config_addr:
+        raise ValueError('不明なコンフィグ項目 {} です. '.format(key))
+    if ('auto_run' in values or 'usba_wake_up' in values) and not self.supports(fw_power_options):
+      raise UnsupportedFirmwareError('現在のファームウェアでは電源自動リカバリー, USB Type-Aウェイクアップを設定できません. ')
+    if 'reboot_sequence' in values and not self.supports(fw_reboot_option):
+      raise UnsupportedFirmwareError('現在のファームウェアでは再起動処理を設定できません. ')
+
+    r = values.get('sig_sd_request')
+    c = values.get('sig_sd_complete')
+    if r != None and c != None and r != 0 and r == c:
+      raise ValueError('シャットダウン要求と完了信号を同じ番号に割り付けることはできません. ')
+
+    with self.bus_lock:
+      if r != None and c != None:
+        self.i2c_write(0x19, [0])  # 番号が重なる可能性があるので一度無効化
+
+      for key in config_addr:
+        if key not in values:
+          continue
+        if key == 'time_zone':
+          self.i2c_write(config_addr[key], list(struct.pack('<h', values[key])))
+        else:
+          self.i2c_write(config_addr[key], [values[key]])
+
+  #----------------------------
+  # スケジュール
+
+  def schedule_count(self):
+    """
+    Returns:
+      int: 登録済みスケジュールの数
+    """
+    return self.i2c_read(0x30, 1, lambda data: data[0] <= max_schedules)[0]
+
+  def schedules(self):
+    """
+    登録済みスケジュールを全て読み出す
+
+    Returns:
+      list: RPZ-PowerMGRの4バイトのスケジュールデータのリスト. 登録番号順.
+    """
+    schedules = []
+    with self.bus_lock:
+      count = self.schedule_count()
+      for i in range(1, count + 1, rdwr_chunk):
+        indexes = [[n] for n in range(i, min(i + rdwr_chunk, count + 1))]
+        schedules += self.i2c_read_indexed(0x31, indexes, 0x32, 4, check=valid_schedule)
+    return schedules
+
+  def add_schedules(self, sch_list, count=None, atomic=False):
+    """
+    スケジュールを追加する. 登録数が上限を超える場合は1つも追加しない.
+
+    Args:
+      sch_list: RPZ-PowerMGRの4バイトのスケジュールデータのリスト
+      count: 登録済みスケジュールの数. Noneの場合は読み出す.
+      atomic: Trueの場合, 途中で失敗したら追加したスケジュールを削除して元に戻す
+
+    Raises:
+      PowerMGRError: 登録数が上限を超えるか, 通信に失敗した
+    """
+    with self.bus_lock:
+      if count == None:
+        count = self.schedule_count()
+      if count + len(sch_list) > max_schedules:
+        raise PowerMGRError('スケジュールは合計{}個を超えて登録できません. '.format(max_schedules))
+      # 追加, 削除は失敗してもやり直すと重複する可能性があるのでやり直さない
+      try:
+        for sch in sch_list:
+          self.i2c_write(0x32, sch, retries=0)
+      except PowerMGRError:
+        if atomic:
+          self.rollback_schedules(count)
+        raise
+
+  def rollback_schedules(self, count):
+    """
+    count個より後に追加されたスケジュールを番号の大きい方から削除する. 削除に失敗しても例外を出さない.
+
+    Args:
+      count: 残すスケジュールの数
+    """
+    try:
+      with self.bus_lock:
+        for num in range(self.schedule_count(), count, -1):
+          self.i2c_write(0x36, [num])
+    except PowerMGRError:
+      pass
+
+  def delete_schedule(self, num):
+    """
+    スケジュールを削除する
+
+    Args:
+      num: 削除するスケジュール番号. 0xFFで全て削除.
+    """
+    self.i2c_write(0x36, [num], retries=0)
+
+  def sync_schedules(self, target):
+    """
+    登録済みスケジュールがtargetと一致するように, 差分だけを削除, 追加する.
+    番号の大きい方から削除するので, 残りのスケジュールの番号は変わらない.
+
+    Args:
+      target: 一致させたいスケジュールのリスト
+
+    Returns:
+      tuple: (削除したスケジュール番号のリスト, 追加したスケジュールのリスト)
+
+    Raises:
+      PowerMGRError: 登録数が上限を超える
+    """
+    if len(target) > max_schedules:
+      raise PowerMGRError('スケジュールは合計{}個を超えて登録できません. '.format(max_schedules))
+    with self.bus_lock:
+      delete, add = diff_schedules(self.schedules(), target)
+      for num in delete:
+        self.delete_schedule(num)
+      for sch in add:
+        self.i2c_write(0x32, sch, retries=0)
+    return delete, add
+
+  #----------------------------
+  # 電流測定
+
+  def current(self):
+    """
+    Returns:
+      int: 直近の電流測定値[mA]
+    """
+    curr = self.i2c_read(0x20, 2)
+    return (curr[1] << 8) + curr[0]
+
+  def watch_current(self, hz):
+    """
+    直近の電流測定値を一定周期で読み出し続けるジェネレータ.
+    読み出し時刻はtime.monotonic()で開始時からの周期の整数倍に合わせるので, 処理時間による遅れは蓄積しない.
+    周期に間に合わなかった場合は, その分の読み出しを飛ばして次の周期に合わせる.
+
+    Args:
+      hz: 読み出す周波数[Hz]
+
+    Yields:
+      tuple: (読み出した時刻 time.time(), 電流値[mA], 前回から飛ばした読み出しの回数)
+    """
+    for delay, missed in periodic_ticks(hz):
+      if delay > 0:
+        time.sleep(delay)
+      yield time.time(), self.current(), missed
+
+  def log_count(self):
+    """
+    Returns:
+      int: 記録されている電流値の数. 電源ONから1秒ごとに最大3600.
+    """
+    count = self.i2c_read(0x22, 2, lambda data: data[0] + (data[1] << 8) <= max_log)
+    return count[0] + (count[1] << 8)
+
+  def read_log(self, start=0, length=None, chunk=rdwr_chunk):
+    """
+    記録されている電流値をstartからlength個読み出すジェネレータ.
+    chunk個ずつ読み出し, 読み出す度に電流値[mA]のリストを返す.
+
+    Args:
+      start: 読み出しを開始するインデックス
+      length: 読み出すサンプル数. Noneの場合は記録されている最後まで.
+      chunk: まとめて読み出すサンプル数. rdwrが有効な場合は1回の転送にまとめる. 0の場合は1サンプルずつ読み出す.
+
+    Yields:
+      list: 電流値[mA]のリスト
+    """
+    if length == None:
+      length = self.log_count() - start
+    i = start
+    while i < start + length:
+      n = min(max(chunk, 1), start + length - i)
+      data = self.i2c_read_indexed(0x24, [[j & 0xFF, j >> 8] for j in range(i, i + n)], 0x26, 2,
+                                   None if chunk > 0 else False)
+      yield [(curr[1] << 8) + curr[0] for curr in data]
+      i += n
+
+  def log(self, start=0):
+    """
+    記録されている電流値を全て読み出す
+
+    Args:
+      start: 読み出しを開始するインデックス
+
+    Returns:
+      list: 電流値[mA]のリスト. 1秒ごと.
+    """
+    data = []
+    for chunk in self.read_log(start):
+      data += chunk
+    return data
+
+  def reset_log(self):
+    """
+    電流値の記録をリセットして再スタート
+    """
+    self.i2c_write(0x24, [0xFF, 0xFF])
+
+  #----------------------------
+  # RTC, 電源
+
+  def read_rtc(self, utc=False):
+    """
+    RTCの時刻を読み出してdatetimeに変換. タイムゾーンはRPZ-PowerMGRの設定値を読み出して計算.
+
+    Args:
+      utc: Trueの場合はタイムゾーン補正せず, UTCのaware datetimeで返す
+
+    Returns:
+      datetime: タイムゾーン補正後のRTC時刻
+    """
+    import datetime
+
+    if utc:
+      return bcd2datetime(self.i2c_read(0x0, 7, valid_bcd))
+
+    # RTCはUTCなのでタイムゾーン設定で補正. 0x07-0x0Fは未定義のレジスタなので, まとめて読み出さずに2回に分ける.
+    dt = bcd2datetime(self.i2c_read(0x0, 7, valid_bcd)).replace(tzinfo=None)
+    time_zone_min = self.i2c_read(0x1A, 2)
+    return dt + datetime.timedelta(minutes=struct.unpack('<h', bytes(time_zone_min))[0])
+
+  def write_rtc(self, dt=None):
+    """
+    RTCに時刻を書き込む. 省略した場合はシステム時刻の次の秒の境目まで待ってその時刻を書き込むので,
+    RTCの秒の境目がシステム時刻とほぼ一致する.
+
+    Args:
+      dt: 書き込む時刻. UTCのaware datetime. Noneの場合はシステム時刻.
+
+    Returns:
+      datetime: 書き込んだ時刻. UTCのaware datetime.
+    """
+    import datetime
+
+    if dt == None:
+      target = int(time.time()) + 1
+      dt = datetime.datetime.fromtimestamp(target, datetime.timezone.utc)
+      bcd = make_bcd(dt.year, dt.month, dt.day, dt.isoweekday() % 7 + 1, dt.hour, dt.minute, dt.second)
+      delay = target - time.time()
+      if delay > 0:
+        time.sleep(delay)
+    else:
+      dt = dt.astimezone(datetime.timezone.utc)
+      bcd = make_bcd(dt.year, dt.month, dt.day, dt.isoweekday() % 7 + 1, dt.hour, dt.minute, dt.second)
+    self.i2c_write(0x0, bcd)
+    return dt
+
+  def rtc_offset(self, timeout=1.5):
+    """
+    RTCの秒が変わるまで読み出しを繰り返し, その瞬間のRTC時刻とシステム時刻の差を求める.
+    RTCは秒単位だが, 秒の境目を捉えるので読み出し1回分程度の精度で求まる.
+
+    Args:
+      timeout: 秒が変わるのを待つ最大の時間[s]
+
+    Returns:
+      float: RTC時刻 - システム時刻[s]
+
+    Raises:
+      InvalidDataError: timeout以内にRTCの秒が変わらない
+    """
+    prev = self.i2c_read(0x0, 7, valid_bcd)
+    prev_time = time.time()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+      bcd = self.i2c_read(0x0, 7, valid_bcd)
+      now = time.time()
+      if bcd != prev:
+        # 前回と今回の読み出しの間に秒が変わった
+        return bcd2datetime(bcd).timestamp() - (prev_time + now) / 2
+      prev = bcd
+      prev_time = now
+    raise InvalidDataError('RTCの時刻が進んでいません. ')
+
+  def request_shutdown(self):
+    """
+    すぐにシャットダウン要求を開始する
+
+    Raises:
+      UnsupportedFirmwareError: ファームウェアが対応していない
+    """
+    if not self.supports(fw_shutdown_request):
+      raise UnsupportedFirmwareError('現在のファームウェアではシャットダウン要求を開始できません. ')
+    self.i2c_write(0x40, [0xFF])
+
+  #----------------------------
+  # I2C
+
+  def i2c_read(self, addr, length, check=None, retries=None):
+    """
+    I2Cで指定アドレスから読み出す
+
+    Args:
+      addr: 読み出しアドレス. 8bit.
+      length: 読み出しデータの長さ. バイト数.
+      check: 読み出しデータが正しければTrueを返す関数. 正しくない場合はやり直す.
+      retries: やり直す回数. Noneの場合はself.retries.
+
+    Returns:
+      list: 読み出しデータのリスト
+
+    Raises:
+      I2CError: 通信に失敗
+      InvalidDataError: 読み出した値が正しくない
+    """
+    return self.transfer(lambda: self.i2c.read_i2c_block_data(self.address, addr, length), addr, 'read',
+                         length, check, retries)
+
+  def i2c_write(self, addr, data, retries=None):
+    """
+    I2Cで指定アドレスに書き込む
+
+    Args:
+      addr: 書き込みアドレス. 8bit.
+      data(list): 書き込みデータのリスト. [1バイト目, 2バイト目, ...]
+      retries: やり直す回数. Noneの場合はself.retries.
+
+    Raises:
+      I2CError: 通信に失敗
+    """
+    self.transfer(lambda: self.i2c.write_i2c_block_data(self.address, addr, data), addr, 'write', len(data),
+                  None, retries)
+
+  def transfer(self, func, addr, kind, length, check=None, retries=None):
+    """
+    I2C転送を実行し, 統計を記録する. 通信に失敗するか, 読み出した値が正しくない場合は,
+    retry_delayから倍々に間隔を空けてやり直す.
+
+    Args:
+      func: 転送を実行する関数. 読み出しの場合は読み出しデータを返す.
+      addr: レジスタのアドレス
+      kind: read, write, rdwr のいずれか
+      length: 転送するデータのバイト数
+      check: 読み出しデータが正しければTrueを返す関数. Noneの場合は確認しない.
+      retries: やり直す回数. Noneの場合はself.retries.
+
+    Returns:
+      funcの戻り値
+
+    Raises:
+      I2CError: 通信に失敗
+      InvalidDataError: 読み出した値が正しくない
+    """
+    if retries == None:
+      retries = self.retries
+    for attempt in range(retries + 1):
+      if attempt > 0:
+        time.sleep(self.retry_delay * 2**(attempt - 1))
+      t = time.perf_counter()
+      try:
+        data = func()
+      except IOError as e:
+        self.record(addr, kind, length, t, True)
+        error = I2CError('I2C通信に失敗しました. アドレス0x{:02X}, レジスタ0x{:02X}, {}回試行. {}'.format(
+            self.address, addr, attempt + 1, e))
+        continue
+      self.record(addr, kind, length, t)
+      if check == None or check(data):
+        return data
+      error = InvalidDataError('読み出した値が正しくありません. アドレス0x{:02X}, レジスタ0x{:02X}, {}回試行. {}'.format(
+          self.address, addr, attempt + 1, data))
+    raise error
+
+  def record(self, addr, kind, length, start, error=False):
+    """
+    statsが設定されていれば転送を記録する
+
+    Args:
+      addr: レジスタのアドレス
+      kind: read, write, rdwr のいずれか
+      length: 転送したデータのバイト数
+      start: 転送を開始したtime.perf_counter()の値
+      error: 通信に失敗した場合はTrue
+    """
+    if self.stats != None:
+      self.stats.add(addr, kind, length, time.perf_counter() - start, error)
+
+  def i2c_read_indexed(self, index_addr, indexes, addr, length, rdwr=None, check=None):
+    """
+    index_addrにインデックスを書き込んでからaddrを読み出す操作を, 各インデックスについて順に行う.
+    rdwrがTrueの場合は1回のI2C_RDWR転送にまとめ, やり直しても失敗した場合は1つずつ読み出す.
+    I2C_RDWRに対応していないバスでは1つずつ読み出す. I2C_RDWR転送はカーネルがバスを占有するので他のプロセスの転送は割り込まないが,
+    1つずつ読み出す場合は間に他のプロセスがインデックスを書き込まないようにbus_lockを取る.
+
+    Args:
+      index_addr: インデックスの書き込みアドレス. 8bit.
+      indexes: 書き込むインデックスのリスト. rdwrがTrueの場合は最大14個. [[1バイト目, 2バイト目, ...], ...]
+      addr: 読み出しアドレス. 8bit.
+      length: 1回の読み出しデータの長さ. バイト数.
+      rdwr: Trueの場合はI2C_RDWRでまとめて読み出す. Noneの場合はself.rdwr.
+      check: 1つの読み出しデータが正しければTrueを返す関数. 正しくない場合はやり直す.
+
+    Returns:
+      list: インデックス毎の読み出しデータのリスト
+
+    Raises:
+      I2CError: 通信に失敗
+      InvalidDataError: 読み出した値が正しくない
+    """
+    if rdwr == None:
+      rdwr = self.rdwr
+    if rdwr and hasattr(self.i2c, 'i2c_rdwr'):
+      # インデックスの書き込み, 読み出しアドレスの書き込み, 読み出しをリピーテッドスタートで続けて送るので,
+      # ファームウェアがSTOPを待たずにインデックスを反映する必要がある. 実機では未確認なのでデフォルトは無効.
+      from smbus2 import i2c_msg
+      msgs = []
+      reads = []
+      for index in indexes:
+        msgs.append(i2c_msg.write(self.address, [index_addr] + index))
+        msgs.append(i2c_msg.write(self.address, [addr]))
+        reads.append(i2c_msg.read(self.address, length))
+        msgs.append(reads[-1])
+      def rdwr_read():
+        self.i2c.i2c_rdwr(*msgs)
+        return [list(msg) for msg in reads]
+
+      size = sum(len(index) + 2 + length for index in indexes)
+      try:
+        return self.transfer(rdwr_read, addr, 'rdwr', size,
+                             None if check == None else lambda data: all(check(d) for d in data))
+      except (I2CError, InvalidDataError):
+        pass
+
+    data = []
+    with self.bus_lock:
+      for index in indexes:
+        self.i2c_write(index_addr, index)
+        data.append(self.i2c_read(addr, length, check))
+    return data
+
+
+def open_bus(bus):
+  """
+  I2Cバスを開く. 環境変数CGPMGR_EMULATORが設定されている場合はエミュレーターを返す.
+
+  Args:
+    bus: I2Cバス番号
+
+  Returns:
+    smbus2.SMBusかEmulator
+
+  Raises:
+    FileNotFoundError: I2Cバスが見つからない
+  """
+  from . import emulator
+  if emulator.enabled():
+    return emulator.open_emulator(bus)
+
+  import smbus2
+  return smbus2.SMBus(bus)
+
+
+def periodic_ticks(hz):
+  """
+  一定周期で処理するための待ち時間を返すジェネレータ. 処理の後に次の値を取り出す.
+  処理時刻はtime.monotonic()で開始時からの周期の整数倍に合わせるので, 処理時間による遅れは蓄積しない.
+  周期に間に合わなかった場合は, その分の処理を飛ばして次の周期に合わせる.
+
+  Args:
+    hz: 処理する周波数[Hz]
+
+  Yields:
+    tuple: (次の処理までの待ち時間[s], 前回から飛ばした処理の回数)
+  """
+  period = 1 / hz
+  start = time.monotonic()
+  n = 0
+  missed = 0
+  while True:
+    yield max(0, start + n * period - time.monotonic()), missed
+
+    n += 1
+    missed = 0
+    late = time.monotonic() - (start + n * period)
+    if late > period:
+      missed = int(late // period)
+      n += missed
+
+
+def bcd2datetime(bcd):
+  """
+  RTCの7バイトのBCDデータをdatetimeに変換
+
+  Args:
+    bcd: BCDフォーマットの7バイトデータのリスト. 秒, 分, 時, 曜日, 日, 月, 年の順.
+
+  Returns:
+    datetime: UTCのaware datetime
+  """
+  import datetime
+
+  year = (bcd[6] & 0xF) + (bcd[6] >> 4) * 10 + 2000
+  month = (bcd[5] & 0xF) + (bcd[5] >> 4) * 10
+  day = (bcd[4] & 0xF) + (bcd[4] >> 4) * 10
+  hour = (bcd[2] & 0xF) + (bcd[2] >> 4) * 10
+  minute = (bcd[1] & 0xF) + (bcd[1] >> 4) * 10
+  second = (bcd[0] & 0xF) + (bcd[0] >> 4) * 10
+  return datetime.datetime(year=year,
+                           month=month,
+                           day=day,
+                           hour=hour,
+                           minute=minute,
+                           second=second,
+                           tzinfo=datetime.timezone.utc)
+
+
+def make_bcd(year, month, date, dow, hour, minute, second):
+  """
+  指定日時から, BCDフォーマットの7バイトのデータを生成
+
+  Args:
+    year: 年
+    month: 月
+    date: 日
+    dow: 曜日. 日曜日が1, 土曜日が7
+    hour: 時
+    minute: 分
+    second: 秒
+  
+  Returns:
+    list: BCDフォーマットの7バイトデータのリスト
+  """
+  bcd = [0] * 7
+  bcd[0] = second % 10 + (second // 10 << 4)
+  bcd[1] = minute % 10 + (minute // 10 << 4)
+  bcd[2] = hour % 10 + (hour // 10 << 4)
+  bcd[3] = dow
+  bcd[4] = date % 10 + (date // 10 << 4)
+  bcd[5] = month % 10 + (month // 10 << 4)
+  year %= 100
+  bcd[6] = year % 10 + (year // 10 << 4)
+  return bcd
+
+
+def valid_dev_id(data):
+  """
+  読み出したデータの先頭4バイトがRPZ-PowerMGRのデバイスIDならTrue
+  """
+  return data[0:4] == list(struct.pack('<I', 0x52474D50))
+
+
+def valid_schedule(sch):
+  """
+  4バイトのスケジュールデータの分, 時, 月が範囲内ならTrue. ワイルドカードは0x80.
+  """
+  return (sch[0] & 0x3F) <= 59 and (sch[1] == 0x80 or sch[1] <= 23) and (sch[3] == 0x80 or 1 <= sch[3] <= 12)
+
+
+def valid_bcd(bcd):
+  """
+  RTCの7バイトのBCDデータの各桁が0-9で, 存在する日時ならTrue
+  """
+  if not all((b & 0xF) <= 9 and (b >> 4) <= 9 for b in bcd):
+    return False
+  try:
+    bcd2datetime(bcd)
+  except ValueError:
+    return False
+  return True
+
+
+def discover(buses=None, addresses=(0x20, 0x22)):
+  """
+  I2Cバスを探索し, デバイスIDが一致するRPZ-PowerMGRを探す
+
+  Args:
+    buses: 探索するI2Cバス番号のリスト. Noneの場合は/dev/i2c-*の全て. エミュレーター使用時は1のみ.
+    addresses: 探索するI2Cアドレス
+
+  Returns:
+    list: 見つかった(I2Cバス番号, I2Cアドレス)のリスト
+  """
+  from . import emulator
+  if buses == None and emulator.enabled():
+    buses = [1]
+  elif buses == None:
+    import glob
+
+    names = [path[len('/dev/i2c-'):] for path in glob.glob('/dev/i2c-*')]
+    buses = sorted(int(name) for name in names if name.isdigit())
+
+  found = []
+  for bus in buses:
+    for adr in addresses:
+      pm = PowerMGR(bus, adr)
+      try:
+        pm.open(check=False)
+      except OSError:
+        break
+      try:
+        if valid_dev_id(pm.i2c_read(0x10, 4, retries=0)):
+          found.append((bus, adr))
+      except PowerMGRError:
+        pass
+      finally:
+        pm.close()
+  return found
+
+
+def decode_config(data):
+  """
+  0x10-0x1Eのレジスタの値をConfigに変換. ファームウェアが対応していない項目はNoneにする.
+
+  Args:
+    data: 0x10から読み出した15バイトのデータのリスト
+
+  Returns:
+    Config: コンフィグ情報
+  """
+  (dev_id, ver_minor, ver_major, startup_timer, sd_timer, sig_sd_request, sig_sd_complete,
+   time_zone) = struct.unpack('<IBBBBBBh', bytes(data[:12]))
+  ver = [ver_minor, ver_major]
+  auto_run = usba_wake_up = reboot_sequence = None
+  if fw_supports(ver, fw_power_options):
+    auto_run = data[0x1C - 0x10]
+    usba_wake_up = data[0x1D - 0x10]
+  if fw_supports(ver, fw_reboot_option):
+    reboot_sequence = data[0x1E - 0x10]
+  return Config(dev_id, ver, startup_timer, sd_timer, sig_sd_request, sig_sd_complete, time_zone,
+                auto_run, usba_wake_up, reboot_sequence)
+
+
+def fw_supports(ver, min_ver):
+  """
+  ファームウェアバージョンが機能に対応しているかチェック
+
+  Args:
+    ver: ファームウェアバージョン. [マイナー, メジャー]
+    min_ver: メジャーバージョンと, 機能に対応した最小のマイナーバージョンの辞書
+
+  Returns:
+    bool: 対応していればTrue
+  """
+  return ver[1] in min_ver and ver[0] >= min_ver[ver[1]]
+
+
+def diff_schedules(current, target):
+  """
+  登録済みスケジュールをtargetに一致させるために必要な削除, 追加を求める.
+  同じスケジュールが複数ある場合は個数も一致させる.
+
+  Args:
+    current: 登録済みスケジュールのリスト. 登録番号順.
+    target: 一致させたいスケジュールのリスト
+
+  Returns:
+    tuple: (削除するスケジュール番号の降順のリスト, 追加するスケジュールのリスト)
+  """
+  remain = collections.Counter(tuple(sch) for sch in target)
+  delete = []
+  for i, sch in enumerate(current):
+    if remain[tuple(sch)] > 0:
+      remain[tuple(sch)] -= 1
+    else:
+      delete.append(i + 1)
+
+  add = []
+  for sch in target:
+    if remain[tuple(sch)] > 0:
+      remain[tuple(sch)] -= 1
+      add.append(list(sch))
+
+  delete.reverse()
+  return delete, add
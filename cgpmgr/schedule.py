@@ -0,0 +1,573 @@
+"""
+電源ON/OFFスケジュールの評価, 最適化, cron/OnCalendar形式からの変換
+Indoor Corgi, https://www.indoorcorgielec.com
+GitHub: https://github.com/IndoorCorgi/cgpmgr
+"""
+
+import collections
+from .pmgr import fw_supports, fw_date_wildcard
+
+schedule_horizon = 366 * 8 + 1  # 次の日時を探す最大の日数. 2/29のスケジュールも見つかるように8年.
+
+# デコードしたスケジュール. month, day, dow, hourはワイルドカードの場合None. dowは日曜日が0.
+# 日付を曜日で指定した場合はday, 日付で指定した場合はdowがNone.
+Schedule = collections.namedtuple('Schedule', ['off', 'onetime', 'month', 'day', 'dow', 'hour', 'minute'])
+
+month_days = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]  # 各月の最大日数
+
+# 最適化でまとめるフィールドと, 全て揃えばワイルドカードにできる値. 日の値は月によって変わる.
+merge_fields = [('dow', range(7)), ('day', None), ('hour', range(24)), ('month', range(1, 13))]
+
+month_names = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+dow_names = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+# cronの@から始まる指定と, OnCalendarの省略形
+cron_macros = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+calendar_macros = {
+    'minutely': '*-*-* *:*:00',
+    'hourly': '*-*-* *:00:00',
+    'daily': '*-*-* 00:00:00',
+    'weekly': 'Mon *-*-* 00:00:00',
+    'monthly': '*-*-01 00:00:00',
+    'yearly': '*-01-01 00:00:00',
+    'annually': '*-01-01 00:00:00',
+    'quarterly': '*-01,04,07,10-01 00:00:00',
+    'semiannually': '*-01,07-01 00:00:00',
+}
+
+
+class ScheduleError(ValueError):
+  """
+  cron/OnCalendar形式の指定が正しくないか, スケジュールで表現できない
+  """
+
+
+def decode_schedule(sch):
+  """
+  4バイトのスケジュールデータをデコードする
+
+  Args:
+    sch: RPZ-PowerMGRの4バイトのスケジュールデータのリスト. ファームウェア仕様書参照.
+
+  Returns:
+    Schedule: デコードしたスケジュール
+  """
+  return Schedule(off=(sch[0] & 0x40) != 0,
+                  onetime=(sch[0] & 0x80) != 0,
+                  month=None if sch[3] & 0x80 else sch[3],
+                  day=None if sch[2] & 0xC0 else sch[2],
+                  dow=(sch[2] & 0x7) - 1 if (sch[2] & 0xC0) == 0x40 else None,
+                  hour=None if sch[1] & 0x80 else sch[1],
+                  minute=sch[0] & 0x3F)
+
+
+def encode_schedule(sch):
+  """
+  decode_schedule()の逆変換
+
+  Args:
+    sch: Schedule
+
+  Returns:
+    list: RPZ-PowerMGRの4バイトのスケジュールデータのリスト
+  """
+  if sch.dow != None:
+    day = 0x40 | (sch.dow + 1)
+  else:
+    day = 0x80 if sch.day == None else sch.day
+  return [
+      sch.minute | (0x40 if sch.off else 0) | (0x80 if sch.onetime else 0), 0x80 if sch.hour == None else sch.hour, day,
+      0x80 if sch.month == None else sch.month
+  ]
+
+
+class ScheduleIndex:
+  """
+  スケジュールを月と日付/曜日で索引し, 1日ずつ一致するものだけを調べて電源ON/OFFの日時を列挙する.
+  1分ずつ全てのスケジュールと比較しないので, 1年分でも短時間で計算できる.
+
+    index = ScheduleIndex(pm.schedules())
+    for dt, num, sch in index.events(pm.read_rtc()):
+      print(dt, num, sch.off)
+
+  Attributes:
+    schedules: Scheduleのリスト. 登録順.
+  """
+
+  def __init__(self, schedules):
+    """
+    Args:
+      schedules: 4バイトのスケジュールデータのリスト
+    """
+    self.schedules = [decode_schedule(sch) for sch in schedules]
+    self.index = collections.defaultdict(list)  # (月, 日) か (月, 'dow', 曜日) -> スケジュールのインデックス
+    for i, sch in enumerate(self.schedules):
+      key = (sch.month, sch.day) if sch.dow == None else (sch.month, 'dow', sch.dow)
+      self.index[key].append(i)
+
+  def on_date(self, date):
+    """
+    日付に一致するスケジュールを探す
+
+    Args:
+      date: datetime.date
+
+    Returns:
+      list: (時, 分, スケジュールのインデックス)のリスト. 時刻順.
+    """
+    return self.on_day(date.month, date.day, date.isoweekday() % 7)
+
+  def on_day(self, month, day, dow):
+    """
+    月, 日, 曜日に一致するスケジュールを探す
+
+    Args:
+      month: 月
+      day: 日
+      dow: 曜日. 日曜日が0.
+
+    Returns:
+      list: (時, 分, スケジュールのインデックス)のリスト. 時刻順.
+    """
+    times = []
+    for m in (month, None):
+      for key in ((m, day), (m, None), (m, 'dow', dow)):
+        for i in self.index.get(key, []):
+          sch = self.schedules[i]
+          for hour in (range(24) if sch.hour == None else [sch.hour]):
+            times.append((hour, sch.minute, i))
+    times.sort()
+    return times
+
+  def events(self, start, end=None):
+    """
+    startより後, end未満の電源ON/OFFを時刻順に列挙するジェネレータ. 同時刻の場合は登録順.
+    OneTimeのスケジュールは最初の1回だけ. endを省略するとschedule_horizon日先まで.
+
+    Args:
+      start: 開始日時. RTCと同じタイムゾーンのnaive datetime.
+      end: 終了日時. Noneの場合は制限しない.
+
+    Yields:
+      tuple: (datetime, スケジュール番号. 1から, Schedule)
+    """
+    import datetime
+
+    fired = set()  # 実行済みのOneTimeスケジュール
+    date = start.date()
+    last = date + datetime.timedelta(days=schedule_horizon)
+    if end != None:
+      last = min(last, end.date())
+    one_day = datetime.timedelta(days=1)
+    while date <= last and len(fired) < len(self.schedules):
+      base = datetime.datetime(date.year, date.month, date.day)
+      for hour, minute, i in self.on_date(date):
+        if i in fired:
+          continue
+        dt = base.replace(hour=hour, minute=minute)
+        if dt <= start:
+          continue
+        if end != None and dt >= end:
+          return
+        if self.schedules[i].onetime:
+          fired.add(i)
+        yield dt, i + 1, self.schedules[i]
+      date += one_day
+
+  def next_events(self, start, count):
+    """
+    startより後の電源ON/OFFをcount個求める
+
+    Args:
+      start: 開始日時. RTCと同じタイムゾーンのnaive datetime.
+      count: 求める数
+
+    Returns:
+      list: (datetime, スケジュール番号. 1から, Schedule)のリスト
+    """
+    events = []
+    for event in self.events(start):
+      if len(events) >= count:
+        break
+      events.append(event)
+    return events
+
+
+def optimize_schedules(schedules, fw_ver=None):
+  """
+  電源ON/OFFする日時が同じになる, より少ないスケジュールを求める.
+  重複, 存在しない日付, 他のRepeatスケジュールに含まれるRepeatスケジュールを削除し,
+  全ての曜日, 日, 時, 月が揃ったRepeatスケジュールをワイルドカードの1個にまとめる.
+  OneTimeのスケジュールは重複の削除のみ行う.
+
+  Args:
+    schedules: 4バイトのスケジュールデータのリスト
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]. 指定すると対応していないワイルドカードの組み合わせにはまとめない.
+
+  Returns:
+    list: 最適化した4バイトのスケジュールデータのリスト. 最初に現れた位置の順.
+  """
+  date_wc = fw_ver == None or fw_supports(fw_ver, fw_date_wildcard)
+  result = []
+  for sch in map(decode_schedule, schedules):
+    if sch not in result and possible(sch):
+      result.append(sch)
+
+  changed = True
+  while changed:
+    changed = False
+    for field, values in merge_fields:
+      merged = merge_schedules(result, field, values, date_wc)
+      if merged != None:
+        result = merged
+        changed = True
+
+    # 同じスケジュールが残った場合は先の方を残す
+    kept = [
+        sch for i, sch in enumerate(result)
+        if not any(j != i and covers(other, sch) and (other != sch or j < i) for j, other in enumerate(result))
+    ]
+    if len(kept) < len(result):
+      result = kept
+      changed = True
+  return [encode_schedule(sch) for sch in result]
+
+
+def merge_schedules(schedules, field, values, date_wc=True):
+  """
+  fieldだけが異なり, 全ての値が揃ったRepeatスケジュールを1組探してワイルドカードの1個にまとめる
+
+  Args:
+    schedules: Scheduleのリスト
+    field: dow, day, hour, month のいずれか
+    values: 全ての値. Noneの場合は月の日数.
+    date_wc: 時, 日のワイルドカードと月日の指定を組み合わせられる場合はTrue
+
+  Returns:
+    list: まとめたScheduleのリスト. まとめられるものがなければNone.
+  """
+  groups = collections.OrderedDict()  # fieldをワイルドカードにしたSchedule -> インデックスのリスト
+  for i, sch in enumerate(schedules):
+    if sch.onetime or getattr(sch, field) == None:
+      continue
+    groups.setdefault(sch._replace(**{field: None}), []).append(i)
+
+  for merged, members in groups.items():
+    full = range(1, 32 if merged.month == None else month_days[merged.month - 1] + 1) if values == None else values
+    if not set(full) <= set(getattr(schedules[i], field) for i in members) or not encodable(merged, date_wc):
+      continue
+    result = [sch for i, sch in enumerate(schedules) if i not in members]
+    result.insert(members[0], merged)
+    return result
+  return None
+
+
+def covers(outer, inner):
+  """
+  innerが電源ON/OFFする日時が全てouterに含まれ, innerを削除してもよい場合はTrue. 両方Repeatの場合のみ.
+  """
+  if outer.onetime or inner.onetime or outer.off != inner.off or outer.minute != inner.minute:
+    return False
+  if outer.hour not in (None, inner.hour) or outer.month not in (None, inner.month):
+    return False
+  if outer.dow != None:
+    return outer.dow == inner.dow
+  return outer.day in (None, inner.day) and (outer.day == None or inner.dow == None)
+
+
+def possible(sch):
+  """
+  スケジュールに一致する日付が存在すればTrue. 2/30, 4/31などはFalse.
+  """
+  if sch.dow != None:
+    return 0 <= sch.dow <= 6
+  if sch.day == None:
+    return True
+  return 1 <= sch.day <= (31 if sch.month == None else month_days[sch.month - 1])
+
+
+def encodable(sch, date_wc=True):
+  """
+  ファームウェアが対応している組み合わせならTrue. 古いファームウェアでは時, 日のワイルドカードより上位に
+  月日を指定できない. csv2sch()と同じ制限.
+
+  Args:
+    sch: Schedule
+    date_wc: 時, 日のワイルドカードと月日の指定を組み合わせられる場合はTrue
+  """
+  if date_wc:
+    return True
+  if sch.hour == None and sch.day != None:
+    return False
+  return not ((sch.hour == None or (sch.day == None and sch.dow == None)) and sch.month != None)
+
+
+def equivalent_schedules(a, b):
+  """
+  2つのスケジュールのリストが全ての日付で同じ時刻に電源ON/OFFするか確かめる.
+  一致するスケジュールは月, 日, 曜日だけで決まるので, 存在する全ての組み合わせ(366日 x 7曜日)を調べる.
+
+  Args:
+    a: 4バイトのスケジュールデータのリスト
+    b: 4バイトのスケジュールデータのリスト
+
+  Returns:
+    bool: 同じならTrue
+  """
+  indexes = [ScheduleIndex(a), ScheduleIndex(b)]
+  for month in range(1, 13):
+    for day in range(1, month_days[month - 1] + 1):
+      for dow in range(7):
+        events = []
+        for index in indexes:
+          events.append(
+              set((hour, minute, index.schedules[i].off, index.schedules[i].onetime)
+                  for hour, minute, i in index.on_day(month, day, dow)))
+        if events[0] != events[1]:
+          return False
+  return True
+
+
+def parse_field(text, low, high, names=None, sep='-'):
+  """
+  cron/OnCalendarの1フィールドを値の集合にする. カンマ区切りのリスト, 範囲, /による間隔に対応.
+
+  Args:
+    text: フィールドの文字列
+    low: 値の下限
+    high: 値の上限
+    names: 値の名前のリスト. low番目から対応する.
+    sep: 範囲の区切り. cronは-, OnCalendarは..
+
+  Returns:
+    list: 値の昇順のリスト. *の場合はNone.
+
+  Raises:
+    ScheduleError: 正しくない
+  """
+  if text in ['*', '?']:
+    return None
+
+  def value(item):
+    if names != None and item.lower()[:3] in names:
+      return names.index(item.lower()[:3]) + low
+    if not item.isdigit() or not low <= int(item) <= high:
+      raise ScheduleError('{} は {} - {} の範囲で指定してください. '.format(item, low, high))
+    return int(item)
+
+  values = set()
+  for item in text.split(','):
+    item, slash, step = item.partition('/')
+    if slash and (not step.isdigit() or int(step) == 0):
+      raise ScheduleError('間隔 /{} が正しくありません. '.format(step))
+    if item == '*':
+      first, last = low, high
+    elif sep in item:
+      first, last = (value(v) for v in item.split(sep, 1))
+    else:
+      first = value(item)
+      last = high if slash else first
+    if first > last:
+      raise ScheduleError('範囲 {} が正しくありません. '.format(item))
+    values.update(range(first, last + 1, int(step) if slash else 1))
+  return sorted(values)
+
+
+def parse_cron(expr):
+  """
+  cron形式(分 時 日 月 曜日)を解析する. 日と曜日の両方を指定した場合はcronと同じくどちらかに一致すればよい.
+  ただし, どちらかが*で始まる場合は両方に一致する必要があるので, 全ての日か曜日に一致する場合以外は表現できない.
+
+  Args:
+    expr: cron形式の文字列. @dailyなども使用可能.
+
+  Returns:
+    tuple: (分のリスト, 時のリスト, 日のリスト, 月のリスト, 曜日のリスト, 日と曜日のどちらかに一致すればよい場合True).
+      *はNone. 曜日は日曜日が0.
+
+  Raises:
+    ScheduleError: 正しくないか, 表現できない
+  """
+  expr = cron_macros.get(expr.strip().lower(), expr.strip())
+  if expr.startswith('@'):
+    raise ScheduleError('{} は表現できません. '.format(expr))
+  fields = expr.split()
+  if len(fields) != 5:
+    raise ScheduleError('cron形式は 分 時 日 月 曜日 の5つを指定してください. ')
+  for field in fields[2:5:2]:
+    for item in field.replace('/', ',').replace('-', ',').split(','):
+      if '#' in item or item.upper() in ['L', 'LW'] or (item[:-1].isdigit() and item[-1:].upper() in ['L', 'W']):
+        raise ScheduleError('{} は表現できません. '.format(field))
+  minutes = parse_field(fields[0], 0, 59)
+  hours = parse_field(fields[1], 0, 23)
+  days = parse_field(fields[2], 1, 31)
+  months = parse_field(fields[3], 1, 12, month_names)
+  dows = parse_field(fields[4], 0, 7, dow_names)
+  if dows != None:
+    dows = sorted(set(d % 7 for d in dows))
+  if days != None and dows != None and (fields[2].startswith('*') or fields[4].startswith('*')):
+    # cronは日か曜日が*で始まる場合(*/2など), どちらかではなく両方に一致する日だけ実行する
+    if len(days) == 31:
+      days = None
+    elif len(dows) == 7:
+      dows = None
+    else:
+      raise ScheduleError('日 {} と曜日 {} の両方に一致する指定は表現できません. '.format(fields[2], fields[4]))
+  return minutes, hours, days, months, dows, days != None and dows != None
+
+
+def parse_calendar(spec):
+  """
+  systemdのOnCalendar形式([曜日] [年-]月-日 時:分[:秒])を解析する. 範囲は.., 曜日の範囲はMon..Friのように指定.
+
+  Args:
+    spec: OnCalendar形式の文字列. dailyなども使用可能.
+
+  Returns:
+    tuple: parse_cron()と同じ. 日と曜日の両方を指定すると表現できないので, 最後の要素は常にFalse.
+
+  Raises:
+    ScheduleError: 正しくないか, 表現できない
+  """
+  spec = calendar_macros.get(spec.strip().lower(), spec.strip())
+  if '~' in spec:
+    raise ScheduleError('月末からの日付 ~ は表現できません. ')
+  tokens = spec.split()
+  dows = None
+  if len(tokens) > 0 and tokens[0][0].isalpha():
+    dows = []
+    for item in tokens.pop(0).split(','):
+      first, sep, last = item.partition('..')
+      values = parse_field(first, 0, 6, dow_names)
+      if sep:
+        values = list(range(values[0], parse_field(last, 0, 6, dow_names)[0] + 1))
+      dows += values
+    dows = sorted(set(dows))
+
+  date = ['*', '*']
+  time = ['0', '0']
+  for token in tokens:
+    if '-' in token and date == ['*', '*']:
+      parts = token.split('-')
+      if len(parts) == 3:
+        if parts[0] != '*':
+          raise ScheduleError('年 {} は指定できません. '.format(parts[0]))
+        parts = parts[1:]
+      if len(parts) != 2:
+        raise ScheduleError('日付 {} が正しくありません. '.format(token))
+      date = parts
+    elif ':' in token and time == ['0', '0']:
+      parts = token.split(':')
+      if len(parts) == 3:
+        if parse_field(parts[2], 0, 59, sep='..') != [0]:
+          raise ScheduleError('秒 {} は指定できません. 0のみ可能です. '.format(parts[2]))
+        parts = parts[:2]
+      if len(parts) != 2:
+        raise ScheduleError('時刻 {} が正しくありません. '.format(token))
+      time = parts
+    else:
+      raise ScheduleError('{} は表現できません. '.format(token))
+
+  days = parse_field(date[1], 1, 31, sep='..')
+  if days != None and dows != None:
+    raise ScheduleError('曜日と日付の両方に一致する指定は表現できません. ')
+  return (parse_field(time[1], 0, 59, sep='..'), parse_field(time[0], 0, 23, sep='..'), days,
+          parse_field(date[0], 1, 12, month_names, sep='..'), dows, False)
+
+
+def expand_spec(fields, off=False, fw_ver=None):
+  """
+  parse_cron(), parse_calendar()の結果をスケジュールにする. 分はワイルドカードにできないので全て展開する.
+  ファームウェアが対応していないワイルドカードの組み合わせは, 時か日を展開して表現する.
+
+  Args:
+    fields: parse_cron(), parse_calendar()の結果
+    off: 電源OFFのスケジュールならTrue
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]
+
+  Returns:
+    list: Scheduleのリスト
+  """
+  minutes, hours, days, months, dows, either = fields
+  date_wc = fw_ver == None or fw_supports(fw_ver, fw_date_wildcard)
+  if days == None and dows == None:
+    dates = [(None, None)]
+  elif days == None:
+    dates = [(None, dow) for dow in dows]
+  elif dows == None or either:
+    dates = [(day, None) for day in days] + [(None, dow) for dow in (dows or [])]
+  else:
+    dates = []
+
+  result = []
+  for month in (months or [None]):
+    for day, dow in dates:
+      for hour in (hours or [None]):
+        for minute in (minutes or range(60)):
+          sch = Schedule(off, False, month, day, dow, hour, minute)
+          if possible(sch):
+            result += expand_encodable(sch, date_wc)
+  return result
+
+
+def expand_encodable(sch, date_wc=True):
+  """
+  ファームウェアが対応していない組み合わせの場合, 時か日のワイルドカードを展開して対応するスケジュールにする
+  """
+  if encodable(sch, date_wc):
+    return [sch]
+  if sch.hour == None:
+    return sum((expand_encodable(sch._replace(hour=hour), date_wc) for hour in range(24)), [])
+  return sum((expand_encodable(sch._replace(day=day), date_wc)
+              for day in range(1, month_days[sch.month - 1] + 1)), [])
+
+
+def import_schedules(lines, fw_ver=None):
+  """
+  cron/OnCalendar形式の行からできるだけ少ないスケジュールを作成する.
+  各行は "on|off <cron形式かOnCalendar形式>". 5つのフィールドならcron形式, それ以外はOnCalendar形式.
+  空行と#から始まる行は無視する.
+
+  Args:
+    lines: 行のリスト
+    fw_ver: ファームウェアバージョン. [マイナー, メジャー]
+
+  Returns:
+    list: 4バイトのスケジュールデータのリスト
+
+  Raises:
+    ScheduleError: 正しくないか表現できない行がある. メッセージに行番号を含む.
+  """
+  expanded = []
+  for num, line in enumerate(lines, 1):
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+      continue
+    action, _, spec = line.partition(' ')
+    try:
+      if action.lower() not in ['on', 'off']:
+        raise ScheduleError('行の先頭に on か off を指定してください. ')
+      spec = spec.strip()
+      if spec.startswith('@') or len(spec.split()) == 5:
+        fields = parse_cron(spec)
+      else:
+        fields = parse_calendar(spec)
+      schedules = expand_spec(fields, action.lower() == 'off', fw_ver)
+      if len(schedules) == 0:
+        raise ScheduleError('一致する日時がありません. ')
+    except ScheduleError as e:
+      raise ScheduleError('{}行目: {} {}'.format(num, line, e))
+    expanded += [encode_schedule(sch) for sch in schedules]
+
+  optimized = optimize_schedules(expanded, fw_ver)
+  if not equivalent_schedules(expanded, optimized):
+    raise ScheduleError('最適化前後で電源ON/OFFする日時が一致しませんでした. ')
+  return optimized
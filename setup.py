@@ -9,7 +9,16 @@ setup(
     url='https://github.com/IndoorCorgi/cgpmgr',
     license='Apache License 2.0',
     packages=['cgpmgr'],
-    install_requires=['docopt', 'smbus2'],
-    entry_points={'console_scripts': ['cgpmgr=cgpmgr:cli',]},
+    install_requires=['smbus2'],
+    extras_require={'analysis': ['numpy']},
+    entry_points={
+        'console_scripts': [
+            'cgpmgr=cgpmgr:cli',
+            'cgpmgrd=cgpmgr:daemon',
+            'cgpmgr-exporter=cgpmgr:exporter',
+            'cgpmgr-archive=cgpmgr:archive',
+            'cgpmgr-archiver=cgpmgr:archiver',
+        ]
+    },
     python_requires='>=3.6',
 )
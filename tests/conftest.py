@@ -0,0 +1,23 @@
+"""
+cgpmgrのテスト共通の設定. RPZ-PowerMGRの代わりにエミュレーターを使う.
+"""
+
+import os
+import tempfile
+
+import pytest
+
+# ロックファイルを/run/lockに作らないように, cgpmgrを読み込む前に設定する
+os.environ.setdefault('CGPMGR_LOCK_DIR', tempfile.mkdtemp(prefix='cgpmgr-lock-'))
+os.environ.pop('CGPMGR_EMULATOR', None)
+
+import cgpmgr
+
+
+@pytest.fixture
+def pm():
+  """
+  エミュレーターに接続して確認済みのPowerMGR
+  """
+  with cgpmgr.PowerMGR(cgpmgr.Emulator()) as pm:
+    yield pm
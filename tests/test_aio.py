@@ -0,0 +1,64 @@
+"""
+AsyncPowerMGRがI2Cバス毎に操作を実行することをエミュレーターで確認する
+"""
+
+import asyncio
+import time
+
+import cgpmgr
+
+
+def slow(log, name, seconds=0.1):
+  """
+  I2C転送に時間がかかる操作の代わり. 開始と終了の時刻を記録する.
+  """
+  start = time.monotonic()
+  time.sleep(seconds)
+  log.append((name, start, time.monotonic()))
+
+
+def test_buses_run_in_parallel():
+
+  async def main():
+    log = []
+    async with cgpmgr.AsyncPowerMGR(cgpmgr.Emulator()) as busy, cgpmgr.AsyncPowerMGR(cgpmgr.Emulator()) as idle:
+      # 1つのバスに溜まった操作が, 他のバスの操作を待たせない
+      queued = [asyncio.ensure_future(busy.call(slow, log, 'busy')) for i in range(6)]
+      await asyncio.sleep(0.01)
+      start = time.monotonic()
+      assert await idle.current() >= 0
+      elapsed = time.monotonic() - start
+      await asyncio.gather(*queued)
+    return elapsed
+
+  assert asyncio.run(main()) < 0.1
+
+
+def test_same_bus_is_serialized():
+
+  async def main():
+    log = []
+    emulator = cgpmgr.Emulator()
+    async with cgpmgr.AsyncPowerMGR(emulator) as a, cgpmgr.AsyncPowerMGR(emulator) as b:
+      await asyncio.gather(*[apm.call(slow, log, i, 0.05) for i, apm in enumerate([a, b, a, b])])
+    return log
+
+  log = asyncio.run(main())
+  assert [name for name, start, end in log] == [0, 1, 2, 3]
+  for prev, cur in zip(log, log[1:]):
+    assert cur[1] >= prev[2]
+
+
+def test_watch_current():
+
+  async def main():
+    samples = []
+    async with cgpmgr.AsyncPowerMGR(cgpmgr.Emulator()) as apm:
+      async for t, curr, missed in apm.watch_current(50):
+        samples.append(t)
+        if len(samples) == 5:
+          break
+    return samples
+
+  samples = asyncio.run(main())
+  assert 0.06 < samples[-1] - samples[0] < 0.2
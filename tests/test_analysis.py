@@ -0,0 +1,52 @@
+"""
+電流値の解析がNumPyの有無で同じ結果になることを確認する
+"""
+
+import pytest
+
+from cgpmgr.analysis import analyze_log
+
+# 平常時の変動, 単独と連続したスパイク, 最後まで続くスパイクを含む電流値
+samples = [400 + (i * 37) % 23 for i in range(500)]
+for start, length in [(50, 1), (120, 4), (300, 12), (495, 5)]:
+  for i in range(start, start + length):
+    samples[i] = 900 + i % 7 * 10
+
+
+def flatten(value):
+  """
+  リストやタプルを入れ子にした値を数値のリストにする
+  """
+  if isinstance(value, (list, tuple)):
+    return [v for item in value for v in flatten(item)]
+  return [value]
+
+
+def compare(a, b):
+  """
+  2つのLogStatsが浮動小数点の誤差を除いて一致することを確認する
+  """
+  assert a._fields == b._fields
+  for name, x, y in zip(a._fields, a, b):
+    assert flatten(x) == pytest.approx(flatten(y)), name
+
+
+def test_analyze_without_numpy():
+  stats = analyze_log(samples, voltage=5, resolution=60, numpy=False)
+  assert (stats.count, stats.min, stats.max) == (500, 400, 960)
+  assert [(s, n) for s, n, peak in stats.spikes] == [(50, 1), (120, 4), (300, 12), (495, 5)]
+  assert stats.charge == pytest.approx(sum(samples) / 3600)
+  assert stats.energy == pytest.approx(stats.charge * 5 / 1000)
+  assert len(stats.resampled) == 9 and stats.resampled[-1][0] == 480
+  assert analyze_log([], numpy=False) == None
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'voltage': 5, 'resolution': 60},
+    {'spike': 800, 'interval': 2, 'resolution': 7},
+    {'spike': 2000},
+])
+def test_numpy_matches_pure_python(options):
+  numpy = pytest.importorskip('numpy')
+  compare(analyze_log(samples, numpy=numpy, **options), analyze_log(samples, numpy=False, **options))
@@ -0,0 +1,56 @@
+"""
+アーカイブの書き込みと読み出しが一致することを確認する
+"""
+
+import random
+
+import pytest
+
+from cgpmgr.archive import (LogArchive, ArchiveError, encode_samples, decode_samples, write_block, csv_to_archive,
+                            archive_to_csv)
+
+
+@pytest.mark.parametrize('encoding', ['raw', 'varint'])
+def test_samples_round_trip(encoding):
+  rng = random.Random(1)
+  samples = [rng.randrange(0, 65536) for i in range(500)] + [0, 65535, 0, 300, 301, 299]
+  data = encode_samples(samples, encoding)
+  assert list(decode_samples(data, len(samples), encoding)) == samples
+
+
+def test_varint_is_compact():
+  samples = [300 + i % 5 for i in range(3600)]
+  assert len(encode_samples(samples, 'varint')) < len(samples) + 4
+
+
+def test_truncated_varint_is_rejected():
+  data = encode_samples([300, 1000, 70000 % 65536], 'varint')
+  with pytest.raises(ArchiveError):
+    decode_samples(data[:-1], 3, 'varint')
+
+
+def test_blocks_round_trip(tmp_path):
+  path = str(tmp_path / 'log.cgpl')
+  with open(path, 'ab') as f:
+    write_block(f, [300, 310, 305], 1700000000, 1, 'raw', fw_ver=(7, 2), time_zone=540, bus=1, address=0x20)
+  with open(path, 'ab') as f:
+    write_block(f, [400, 390], 1700000100, 2, 'varint', bus=3, address=0x22)
+
+  with LogArchive(path) as archive:
+    assert len(archive.blocks) == 2
+    first, second = archive.blocks
+    assert (first.bus, first.address, first.time_zone, first.start, first.count) == (1, 0x20, 540, 1700000000, 3)
+    assert (second.bus, second.address, second.interval, second.encoding) == (3, 0x22, 2, 'varint')
+    assert archive.samples() == [300, 310, 305, 400, 390]
+    assert list(archive) == [(1700000000, 300), (1700000001, 310), (1700000002, 305), (1700000100, 400),
+                             (1700000102, 390)]
+
+
+def test_csv_round_trip(tmp_path):
+  src = tmp_path / 'log.csv'
+  src.write_text('時間[s], 電流[mA]\n0, 300\n1, 320\n2, 310\n')
+  archive = str(tmp_path / 'log.cgpl')
+  assert csv_to_archive(str(src), archive, start=1700000000) == 3
+  dst = tmp_path / 'out.csv'
+  assert archive_to_csv(archive, str(dst)) == 3
+  assert dst.read_text() == src.read_text()
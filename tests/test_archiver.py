@@ -0,0 +1,65 @@
+"""
+LogArchiverが記録のリセットを検出して続きから保存することを確認する
+"""
+
+import time
+
+import cgpmgr
+
+
+def test_archiver_detects_external_reset(pm, tmp_path):
+  board = pm.bus.boards[pm.address]
+  board.log_start = time.time() - 100.5
+  archiver = cgpmgr.LogArchiver(pm, str(tmp_path))
+  assert archiver.poll() == 100
+  first_start = archiver.log_start
+
+  # 外部でリセットされ, 次の確認までに記録数がカーソルを超えた
+  board.log_start = time.time() - 200.5
+  assert archiver.poll() == 200
+  assert archiver.cursor == 200
+  assert abs(archiver.log_start - (first_start - 100)) <= 1
+
+  # 変化がなければ続きから
+  assert archiver.poll() == 0
+
+
+def test_archiver_resumes_from_state(pm, tmp_path):
+  board = pm.bus.boards[pm.address]
+  board.log_start = time.time() - 50.5
+  assert cgpmgr.LogArchiver(pm, str(tmp_path)).poll() == 50
+  # 10秒経過したのと同じにする. 記録開始時刻は変わらない.
+  board.log_start -= 10
+  board.rtc_offset += 10
+  restarted = cgpmgr.LogArchiver(pm, str(tmp_path))
+  assert restarted.cursor == 50
+  assert restarted.poll() == 10
+
+  samples = []
+  for path in sorted(tmp_path.glob('*.cgpl')):
+    with cgpmgr.LogArchive(str(path)) as archive:
+      samples += [t for t, curr in archive]
+  assert samples == list(range(int(samples[0]), int(samples[0]) + 60))
+
+
+def test_archiver_keeps_start_when_log_is_full(pm, tmp_path, capsys):
+  board = pm.bus.boards[pm.address]
+  board.log_start = time.time() - 1000.5
+  archiver = cgpmgr.LogArchiver(pm, str(tmp_path), reset_at=cgpmgr.max_log + 1)
+  assert archiver.poll() == 1000
+  log_start = archiver.log_start
+
+  # 停止中に記録数が上限に達した. 記録は止まったまま時刻だけが進む.
+  for elapsed in [3000, 60]:
+    board.log_start -= elapsed
+    board.rtc_offset += elapsed
+    archiver.poll()
+    assert archiver.cursor == cgpmgr.max_log
+    assert archiver.log_start == log_start
+  assert 'リセットされていました' not in capsys.readouterr().out
+
+  samples = []
+  for path in sorted(tmp_path.glob('*.cgpl')):
+    with cgpmgr.LogArchive(str(path)) as archive:
+      samples += [t for t, curr in archive]
+  assert samples == [log_start + i for i in range(cgpmgr.max_log)]
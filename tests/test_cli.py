@@ -0,0 +1,112 @@
+"""
+parse_args()とusage_patternsが__doc__のUsageと一致することを確認する
+"""
+
+import itertools
+import re
+import sys
+
+import pytest
+
+import cgpmgr
+
+cli = sys.modules['cgpmgr.cli']
+
+
+def doc_patterns():
+  """
+  __doc__のUsageの各行を(コマンド, 必須要素, 省略可能な要素)に変換する. [a | b]はどちらか一方なので別の行に展開する.
+
+  Returns:
+    list: (コマンド, 必須要素のfrozenset, 省略可能な要素のfrozenset)のリスト
+  """
+  doc = cli.__doc__
+  usage = doc[doc.index('Usage:'):doc.index('\n\n', doc.index('Usage:'))]
+  patterns = []
+  for line in usage.splitlines()[1:]:
+    tokens = line.split()[1:]
+    if tokens[0] not in cli.commands:
+      continue
+    command = tokens[0]
+    text = ' '.join(tokens[1:])
+    required = []
+    groups = []
+    for optional, choice, word in re.findall(r'\[([^\]]*)\]|\(([^)]*)\)|(\S+)', text):
+      if optional:
+        groups.append([alt.split()[0] for alt in optional.split('|')])
+      elif choice:
+        required.append('on|off')
+      elif word.startswith('-') or word == '<time>':
+        required.append(word)
+    for selected in itertools.product(*groups):
+      patterns.append((command, frozenset(required), frozenset(selected)))
+  return patterns
+
+
+def accepted(patterns):
+  """
+  パターンの組が受け付ける(コマンド, 指定した要素)の集合
+  """
+  result = set()
+  for command, required, optional in patterns:
+    optional = sorted(set(optional))
+    for n in range(len(optional) + 1):
+      for extra in itertools.combinations(optional, n):
+        names = frozenset(required) | frozenset(extra)
+        if not any(set(group) <= names for group in cli.exclusive_options):
+          result.add((command, names))
+  return result
+
+
+def test_usage_patterns_match_doc():
+  assert accepted(cli.usage_patterns) == accepted(doc_patterns())
+
+
+def test_every_documented_combination_parses():
+  values = {'on|off': ['on'], '<time>': ['7:30']}
+  for command, names in accepted(doc_patterns()):
+    argv = [command]
+    for name in sorted(names, key=lambda name: name == 'on|off'):
+      if name in cli.value_options:
+        argv += [name, '1']
+      else:
+        argv += values.get(name, [name])
+    args = cli.parse_args(argv)
+    assert args[command]
+
+
+@pytest.mark.parametrize('argv', [
+    ['sc', 'on', '7:30'],
+    ['me', '--target', '1', '--discover'],
+    ['rtc', '--sync', '--restore'],
+    ['sc', '-L'],
+    ['fw'],
+])
+def test_undocumented_usage_is_rejected(argv):
+  with pytest.raises(SystemExit):
+    cli.parse_args(argv)
+
+
+def test_combined_short_options():
+  args = cli.parse_args(['me', '-aLf', 'log.csv'])
+  assert args['-a'] and args['-L'] and args['-f'] == 'log.csv'
+  assert not cli.daemon_allowed(args)
+  assert cli.daemon_allowed(cli.parse_args(['me', '-a']))
+
+
+def test_run_boards_shares_input_file(tmp_path, monkeypatch, capsys):
+  monkeypatch.setenv('CGPMGR_EMULATOR', '1')
+  monkeypatch.setattr(sys.modules['cgpmgr.emulator'], 'emulated_buses', {})
+  csv = tmp_path / 'x.csv'
+  csv.write_text('header\n' + cli.sch2csv([30, 7, 0x80, 0x80]) + '\n')
+  targets = [(1, 0x20), (2, 0x20)]
+  for argv in [['sc', '--next', '3', '-f', str(csv)], ['sc', '--simulate', '2030/1/1,2030/1/2', '-f', str(csv)]]:
+    cli.run_boards(targets, cli.parse_args(argv))
+    out = capsys.readouterr().out
+    assert '読み込みに失敗' not in out
+    assert out.count('07:30') >= 2
+
+  # 追加する場合は同じファイルを読み込み, 保存する場合はボード毎のファイルになる
+  cli.run_boards(targets, cli.parse_args(['sc', '-i', '-f', str(csv)]))
+  cli.run_boards(targets, cli.parse_args(['sc', '-f', str(tmp_path / 'saved.csv')]))
+  assert sorted(p.name for p in tmp_path.glob('saved*')) == ['saved-i2c1-0x20.csv', 'saved-i2c2-0x20.csv']
@@ -0,0 +1,102 @@
+"""
+cgpmgrとcgpmgrdの依頼と応答を一時的なソケットとエミュレーターで確認する
+"""
+
+import socket
+import sys
+import threading
+
+import pytest
+
+cli = sys.modules['cgpmgr.cli']
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+  """
+  一時的なソケットで待ち受けるcgpmgrd. serve(n)でn個の依頼を処理する.
+  """
+  monkeypatch.setenv('CGPMGR_EMULATOR', '1')
+  monkeypatch.setattr(sys.modules['cgpmgr.emulator'], 'emulated_buses', {})
+  path = str(tmp_path / 'cgpmgr.sock')
+  monkeypatch.setattr(cli, 'daemon_socket', path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.bind(path)
+  sock.listen(1)
+  devices = {}
+  threads = []
+
+  def serve(n, handler=None):
+
+    def loop():
+      for i in range(n):
+        conn, _ = sock.accept()
+        with conn:
+          if handler == None:
+            cli.handle_request(conn, 1, devices, {})
+          else:
+            handler(conn)
+
+    threads.append(threading.Thread(target=loop, daemon=True))
+    threads[-1].start()
+
+  yield serve
+  for thread in threads:
+    thread.join(5)
+  sock.close()
+  for pm in devices.values():
+    pm.close()
+
+
+def test_round_trip(server, capsys):
+  server(2)
+  assert cli.request_daemon(['sc', '7:30', 'on'])
+  assert 'スケジュールを登録しました' in capsys.readouterr().out
+  assert cli.request_daemon(['sc'])
+  out = capsys.readouterr().out
+  assert 'スケジュールが1個' in out and '07:30' in out
+
+
+def test_unexpected_error_is_returned(server, capsys, monkeypatch):
+
+  def broken(pm, args):
+    raise RuntimeError('broken')
+
+  server(2)
+  with monkeypatch.context() as m:
+    m.setattr(cli, 'run', broken)
+    assert cli.request_daemon(['me'])
+  assert 'RuntimeError: broken' in capsys.readouterr().out
+
+  # cgpmgrdは次の依頼も処理する
+  assert cli.request_daemon(['me'])
+  assert 'mA' in capsys.readouterr().out
+
+
+def test_stderr_is_returned(server, capsys, monkeypatch):
+
+  def warn(pm, args):
+    print('warning', file=sys.stderr)
+
+  server(1)
+  monkeypatch.setattr(cli, 'run', warn)
+  assert cli.request_daemon(['me'])
+  assert capsys.readouterr().out == 'warning\n'
+
+
+def test_lost_reply_is_not_retried(server):
+
+  def die(conn):
+    conn.makefile('rb').read()
+
+  # 依頼を受け取った後に応答せず切断した. 自身で処理し直すとスケジュールが重複する.
+  server(1, die)
+  with pytest.raises(SystemExit):
+    cli.request_daemon(['sc', '7:30', 'on'])
+
+
+def test_no_daemon(tmp_path, monkeypatch):
+  path = tmp_path / 'cgpmgr.sock'
+  path.touch()
+  monkeypatch.setattr(cli, 'daemon_socket', str(path))
+  assert not cli.request_daemon(['me'])
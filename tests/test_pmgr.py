@@ -0,0 +1,279 @@
+"""
+PowerMGRのレジスタ操作とロックをエミュレーターで確認する
+"""
+
+import time
+
+import pytest
+
+import cgpmgr
+from cgpmgr.pmgr import diff_schedules
+
+
+def test_diff_schedules_deletes_from_highest_number():
+  a = [30, 7, 0x80, 0x80]
+  b = [0, 22, 0x80, 0x80]
+  c = [15, 12, 0x80, 0x80]
+  delete, add = diff_schedules([a, b, a, c, b], [b, a, [0, 8, 0x80, 0x80]])
+  # 番号の大きい方から削除するので, 残りの番号は変わらない
+  assert delete == [5, 4, 3]
+  assert add == [[0, 8, 0x80, 0x80]]
+
+
+def test_diff_schedules_matches_duplicate_counts():
+  a = [30, 7, 0x80, 0x80]
+  assert diff_schedules([a], [a, a]) == ([], [a])
+  assert diff_schedules([a, a], [a]) == ([2], [])
+
+
+def test_sync_schedules(pm):
+  current = [[30, 7, 0x80, 0x80], [0, 22, 0x80, 0x80], [15, 12, 0x80, 0x80], [0, 22, 0x80, 0x80]]
+  target = [[0, 22, 0x80, 0x80], [45, 6, 0x41, 0x80], [15, 12, 0x80, 0x80]]
+  pm.add_schedules(current)
+  delete, add = pm.sync_schedules(target)
+  assert delete == [4, 1]
+  assert add == [[45, 6, 0x41, 0x80]]
+  assert sorted(pm.schedules()) == sorted(target)
+  assert pm.sync_schedules(target) == ([], [])
+
+
+def locked_elsewhere(path):
+  """
+  別のファイル記述からflockしてみて, 他のプロセスがロックしていればTrue
+  """
+  import fcntl
+  import os
+
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    return False
+  except BlockingIOError:
+    return True
+  finally:
+    os.close(fd)
+
+
+def rdwr_count(stats):
+  return sum(reg['rdwr'] for reg in stats.summary()['registers'])
+
+
+@pytest.mark.parametrize('rdwr', [False, True])
+def test_indexed_reads(rdwr):
+  with cgpmgr.PowerMGR(cgpmgr.Emulator(), rdwr=rdwr) as pm:
+    pm.stats = cgpmgr.I2CStats()
+    sch_list = [[n, 7, 0x80, 0x80] for n in range(20)]
+    pm.add_schedules(sch_list)
+    assert pm.schedules() == sch_list
+    assert [curr for data in pm.read_log(0, 30) for curr in data] == pm.log()[:30]
+    # デフォルトは1つずつ読み出し, rdwr=Trueの場合だけまとめる
+    assert (rdwr_count(pm.stats) > 0) == rdwr
+
+
+class FailingRdwr(cgpmgr.Emulator):
+  """
+  I2C_RDWR転送が常に失敗するバス
+  """
+
+  def i2c_rdwr(self, *i2c_msgs):
+    raise OSError('rdwr not supported')
+
+
+def test_indexed_read_falls_back_to_pairs():
+  with cgpmgr.PowerMGR(FailingRdwr(), retries=1, retry_delay=0, rdwr=True) as pm:
+    pm.stats = cgpmgr.I2CStats()
+    pm.add_schedules([[30, 7, 0x80, 0x80]])
+    assert pm.schedules() == [[30, 7, 0x80, 0x80]]
+    assert len(pm.log()) == pm.log_count()
+    errors = sum(reg['errors'] for reg in pm.stats.summary()['registers'])
+    assert errors > 0
+
+
+def test_bus_lock_nesting(pm, tmp_path):
+  lock = cgpmgr.BusLock(pm, str(tmp_path))
+  pm.stats = cgpmgr.I2CStats()
+  with lock:
+    assert locked_elsewhere(lock.path)
+    with lock:
+      assert locked_elsewhere(lock.path)
+    # 内側を抜けてもロックしたまま
+    assert locked_elsewhere(lock.path)
+  assert not locked_elsewhere(lock.path)
+  assert pm.stats.summary()['bus_lock']['acquired'] == 1
+  lock.close()
+
+
+def test_bus_lock_close_inside_with(pm, tmp_path):
+  lock = cgpmgr.BusLock(pm, str(tmp_path))
+  with lock:
+    with lock:
+      lock.close()
+      assert not locked_elsewhere(lock.path)
+  # 閉じた後も使える
+  with lock:
+    assert locked_elsewhere(lock.path)
+  assert not locked_elsewhere(lock.path)
+  lock.close()
+
+
+def test_bus_lock_excludes_threads(pm, tmp_path):
+  import threading
+
+  lock = cgpmgr.BusLock(pm, str(tmp_path))
+  inside = []
+  overlap = []
+
+  def work():
+    for i in range(50):
+      with lock:
+        with lock:
+          inside.append(1)
+          if len(inside) > 1:
+            overlap.append(1)
+          time.sleep(0.0001)
+          inside.pop()
+
+  threads = [threading.Thread(target=work) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert overlap == []
+  assert lock.depth == 0
+  assert not locked_elsewhere(lock.path)
+  lock.close()
+
+
+def test_bus_lock_timeout(pm, tmp_path):
+  import fcntl
+  import os
+
+  pm.stats = cgpmgr.I2CStats()
+  lock = cgpmgr.BusLock(pm, str(tmp_path), timeout=0.05)
+  fd = os.open(lock.path, os.O_RDONLY | os.O_CREAT)
+  fcntl.flock(fd, fcntl.LOCK_EX)
+  try:
+    with pytest.raises(cgpmgr.BusLockTimeoutError):
+      lock.acquire()
+  finally:
+    os.close(fd)
+  summary = pm.stats.summary()['bus_lock']
+  assert (summary['acquired'], summary['contended'], summary['timeouts']) == (0, 1, 1)
+  with lock:
+    pass
+  lock.close()
+
+
+def test_bus_lock_without_directory(pm, tmp_path):
+  lock = cgpmgr.BusLock(pm, str(tmp_path / 'missing'))
+  with lock:
+    with lock:
+      pass
+  lock.close()
+
+
+def test_schedule_batch_holds_lock(pm):
+  pm.stats = cgpmgr.I2CStats()
+  pm.add_schedules([[30, 7, 0x80, 0x80], [0, 22, 0x80, 0x80]])
+  pm.schedules()
+  # add_schedules, schedulesでそれぞれ1回. 中のschedule_countやi2c_read_indexedはネストするので取り直さない.
+  assert pm.stats.summary()['bus_lock']['acquired'] == 2
+
+
+class FaultyBus(cgpmgr.Emulator):
+  """
+  指定したレジスタの転送を失敗させるか, 範囲外の値を返すバス
+
+  Attributes:
+    failures: レジスタ -> 残りの失敗させる回数
+    values: レジスタ -> 読み出しデータの代わりに返す値
+    calls: レジスタ -> 転送した回数
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.failures = {}
+    self.values = {}
+    self.calls = {}
+
+  def fault(self, register):
+    self.calls[register] = self.calls.get(register, 0) + 1
+    if self.failures.get(register, 0) > 0:
+      self.failures[register] -= 1
+      raise OSError(121, 'Remote I/O error')
+
+  def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+    self.fault(register)
+    data = super().read_i2c_block_data(i2c_addr, register, length, force)
+    return self.values.get(register, data)
+
+  def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+    self.fault(register)
+    super().write_i2c_block_data(i2c_addr, register, data, force)
+
+
+@pytest.fixture
+def faulty():
+  with cgpmgr.PowerMGR(FaultyBus(), retries=2, retry_delay=0) as pm:
+    pm.stats = cgpmgr.I2CStats()
+    yield pm
+
+
+def test_transfer_retries_until_success(faulty):
+  faulty.i2c.failures[0x20] = 2
+  assert faulty.current() >= 0
+  assert faulty.i2c.calls[0x20] == 3
+  reg = [r for r in faulty.stats.summary()['registers'] if r['register'] == '0x20'][0]
+  assert reg['errors'] == 2
+
+
+def test_transfer_raises_after_retries(faulty):
+  faulty.i2c.failures[0x20] = 3
+  with pytest.raises(cgpmgr.I2CError, match='3回試行'):
+    faulty.current()
+  assert faulty.i2c.calls[0x20] == 3
+
+  # 転送毎にやり直す回数を指定できる
+  faulty.i2c.failures[0x20] = 1
+  with pytest.raises(cgpmgr.I2CError, match='1回試行'):
+    faulty.i2c_read(0x20, 2, retries=0)
+
+
+def test_schedule_writes_are_not_retried(faulty):
+  # やり直すと重複して登録される可能性がある
+  faulty.i2c.failures[0x32] = 1
+  with pytest.raises(cgpmgr.I2CError):
+    faulty.add_schedules([[30, 7, 0x80, 0x80]])
+  assert faulty.i2c.calls[0x32] == 1
+
+
+@pytest.mark.parametrize('register, data, read', [
+    (0x30, [cgpmgr.max_schedules + 1], lambda pm: pm.schedule_count()),
+    (0x22, [0x11, 0x0E], lambda pm: pm.log_count()),
+    (0x00, [0x60, 0x00, 0x00, 0x01, 0x01, 0x01, 0x25], lambda pm: pm.read_rtc()),
+    (0x00, [0x00, 0x00, 0x00, 0x01, 0x30, 0x02, 0x25], lambda pm: pm.read_rtc()),
+    (0x00, [0x00, 0x00, 0x00, 0x01, 0x01, 0x01, 0x2A], lambda pm: pm.read_rtc()),
+    (0x10, [0, 0, 0, 0] + [0] * 15, lambda pm: pm.config()),
+])
+def test_out_of_range_values_are_rejected(faulty, register, data, read):
+  faulty.i2c.values[register] = data
+  faulty.i2c.calls.clear()
+  with pytest.raises(cgpmgr.InvalidDataError):
+    read(faulty)
+  # 正しい値を読み出せるまでやり直した
+  assert faulty.i2c.calls[register] == 3
+
+
+def test_invalid_schedule_record_is_rejected(faulty):
+  faulty.add_schedules([[30, 7, 0x80, 0x80]])
+  faulty.i2c.values[0x32] = [60, 7, 0x80, 0x80]
+  with pytest.raises(cgpmgr.InvalidDataError):
+    faulty.schedules()
+
+
+def test_write_config_rejects_invalid_values(pm):
+  with pytest.raises(ValueError):
+    pm.write_config(unknown=1)
+  with pytest.raises(ValueError):
+    pm.write_config(sig_sd_request=2, sig_sd_complete=2)
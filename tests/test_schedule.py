@@ -0,0 +1,148 @@
+"""
+スケジュールのエンコード, 最適化, cron/OnCalendar形式からのインポートを確認する
+"""
+
+import random
+
+import pytest
+
+from cgpmgr.schedule import (Schedule, ScheduleError, decode_schedule, encode_schedule, optimize_schedules,
+                             equivalent_schedules, encodable, ScheduleIndex, parse_cron, import_schedules)
+
+fw_old = [2, 1]  # Ver1.2. 時, 日のワイルドカードと月日の指定を組み合わせられない
+
+
+def random_schedule(rng, repeat_only=False):
+  """
+  月, 日, 曜日, 時をワイルドカードも含めてランダムに選んだスケジュール
+  """
+  dow = rng.choice([None, None, rng.randrange(7)])
+  return Schedule(off=rng.random() < 0.5,
+                  onetime=not repeat_only and rng.random() < 0.1,
+                  month=rng.choice([None, rng.randrange(1, 13)]),
+                  day=None if dow != None else rng.choice([None, rng.randrange(1, 32)]),
+                  dow=dow,
+                  hour=rng.choice([None, rng.randrange(24)]),
+                  minute=rng.choice([0, 30, rng.randrange(60)]))
+
+
+def test_encode_decode_round_trip():
+  rng = random.Random(1)
+  for i in range(2000):
+    sch = random_schedule(rng)
+    data = encode_schedule(sch)
+    assert all(0 <= b <= 0xFF for b in data)
+    assert decode_schedule(data) == sch
+
+
+def test_decode_register_format():
+  # OneTime, OFF, 45分, 時はワイルドカード, 水曜日(日曜日が1), 12月
+  sch = decode_schedule([0x80 | 0x40 | 45, 0x80, 0x40 | 4, 12])
+  assert sch == Schedule(off=True, onetime=True, month=12, day=None, dow=3, hour=None, minute=45)
+
+
+def test_optimize_merges_full_hours():
+  hourly = [encode_schedule(Schedule(False, False, None, None, None, hour, 0)) for hour in range(24)]
+  optimized = optimize_schedules(hourly)
+  assert optimized == [encode_schedule(Schedule(False, False, None, None, None, None, 0))]
+  assert equivalent_schedules(hourly, optimized)
+
+
+def test_optimize_removes_duplicates_and_impossible_dates():
+  a = encode_schedule(Schedule(False, False, 5, 10, None, 7, 30))
+  feb30 = encode_schedule(Schedule(False, False, 2, 30, None, 7, 30))
+  assert optimize_schedules([a, feb30, a]) == [a]
+
+
+def test_optimize_keeps_onetime():
+  once = encode_schedule(Schedule(False, True, 5, 10, None, 7, 30))
+  daily = encode_schedule(Schedule(False, False, None, None, None, 7, 30))
+  assert optimize_schedules([once, daily]) == [once, daily]
+
+
+def test_optimize_is_equivalent():
+  rng = random.Random(2)
+  for n in range(20):
+    schedules = [encode_schedule(random_schedule(rng)) for i in range(rng.randrange(1, 40))]
+    optimized = optimize_schedules(schedules)
+    assert len(optimized) <= len(schedules)
+    assert equivalent_schedules(schedules, optimized)
+
+
+def test_optimize_respects_old_firmware():
+  rng = random.Random(3)
+  for n in range(10):
+    schedules = [
+        sch for sch in (random_schedule(rng, True) for i in range(rng.randrange(1, 40))) if encodable(sch, False)
+    ]
+    optimized = optimize_schedules([encode_schedule(sch) for sch in schedules], fw_old)
+    assert all(encodable(decode_schedule(sch), False) for sch in optimized)
+    assert equivalent_schedules([encode_schedule(sch) for sch in schedules], optimized)
+
+
+def test_equivalent_schedules_detects_difference():
+  a = [encode_schedule(Schedule(False, False, None, None, 1, 7, 30))]
+  b = [encode_schedule(Schedule(False, False, None, None, 2, 7, 30))]
+  assert not equivalent_schedules(a, b)
+
+
+def test_index_lists_day_in_time_order():
+  import datetime
+
+  schedules = [
+      encode_schedule(Schedule(True, False, None, None, None, 22, 0)),
+      encode_schedule(Schedule(False, False, None, None, 1, 7, 30)),
+      encode_schedule(Schedule(False, False, 1, 5, None, 6, 0)),
+  ]
+  index = ScheduleIndex(schedules)
+  # 2026/1/5は月曜日
+  assert index.on_date(datetime.date(2026, 1, 5)) == [(6, 0, 2), (7, 30, 1), (22, 0, 0)]
+  assert index.on_date(datetime.date(2026, 1, 6)) == [(22, 0, 0)]
+
+
+def test_import_weekdays():
+  schedules = import_schedules(['on 30 7 * * 1-5', 'off Mon..Fri *-*-* 22:00', '# comment', ''])
+  expected = [encode_schedule(Schedule(False, False, None, None, dow, 7, 30)) for dow in range(1, 6)]
+  expected += [encode_schedule(Schedule(True, False, None, None, dow, 22, 0)) for dow in range(1, 6)]
+  assert equivalent_schedules(schedules, expected)
+  assert len(schedules) == 10
+
+
+def test_import_daily_uses_wildcard():
+  assert import_schedules(['on @daily', 'off daily']) == [
+      encode_schedule(Schedule(False, False, None, None, None, 0, 0)),
+      encode_schedule(Schedule(True, False, None, None, None, 0, 0)),
+  ]
+
+
+def test_cron_day_or_weekday():
+  # 日と曜日の両方を指定した場合はどちらかに一致すればよい
+  minutes, hours, days, months, dows, either = parse_cron('0 7 1,15 * 1')
+  assert (days, dows, either) == ([1, 15], [1], True)
+  schedules = import_schedules(['on 0 7 1,15 * 1'])
+  assert len(schedules) == 3
+
+
+@pytest.mark.parametrize('expr', ['0 7 */2 * 1', '0 7 1 * */2'])
+def test_cron_star_field_requires_both(expr):
+  # *で始まる場合は日と曜日の両方に一致する必要があるので表現できない
+  with pytest.raises(ScheduleError):
+    parse_cron(expr)
+
+
+def test_cron_full_star_field_is_wildcard():
+  assert parse_cron('0 7 */1 * 1')[2:] == (None, None, [1], False)
+
+
+@pytest.mark.parametrize('line', [
+    'on 0 7 L * *',
+    'on 0 7 * * 1#2',
+    'on *-*-1~3 07:00',
+    'on 2026-*-* 07:00',
+    'on *-*-* 07:00:30',
+    'reboot 0 7 * * *',
+])
+def test_import_rejects_unrepresentable(line):
+  with pytest.raises(ScheduleError) as e:
+    import_schedules(['on 0 6 * * *', line])
+  assert str(e.value).startswith('2行目')